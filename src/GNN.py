@@ -14,7 +14,7 @@ class GNN(BaseGNN):
     time_tensor = torch.tensor([0, self.T]).to(device)
     self.odeblock = block(self.f, self.regularization_fns, opt, dataset.data, device, t=time_tensor).to(device)
 
-  def forward(self, x, pos_encoding=None):
+  def encode(self, x, pos_encoding=None):
     # Encode each node based on its feature.
     if self.opt['use_labels']:
       y = x[:, -self.num_classes:]
@@ -46,16 +46,11 @@ class GNN(BaseGNN):
     if self.opt['augment']:
       c_aux = torch.zeros(x.shape).to(self.device)
       x = torch.cat([x, c_aux], dim=1)
+    return x
 
-    self.odeblock.set_x0(x)
-
-    if self.training and self.odeblock.nreg > 0:
-      z, self.reg_states = self.odeblock(x)
-    else:
-      z = self.odeblock(x)
-
+  def decode(self, z):
     if self.opt['augment']:
-      z = torch.split(z, x.shape[1] // 2, dim=1)[0]
+      z = torch.split(z, z.shape[1] // 2, dim=1)[0]
 
     # Activation.
     z = F.relu(z)
@@ -70,3 +65,14 @@ class GNN(BaseGNN):
     # Decode each node embedding to get node label.
     z = self.m2(z)
     return z
+
+  def forward(self, x, pos_encoding=None):
+    x = self.encode(x, pos_encoding)
+    self.odeblock.set_x0(x)
+
+    if self.training and self.odeblock.nreg > 0:
+      z, self.reg_states = self.odeblock(x)
+    else:
+      z = self.odeblock(x)
+
+    return self.decode(z)
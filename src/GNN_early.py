@@ -29,8 +29,9 @@ class GNNEarly(BaseGNN):
       self.set_solver_data(dataset.data)
 
   def set_solver_m2(self):
-    self.odeblock.test_integrator.m2_weight = self.m2.weight.data.detach().clone().to(self.device)
-    self.odeblock.test_integrator.m2_bias = self.m2.bias.data.detach().clone().to(self.device)
+    # views of the decoder parameters rather than copies, the integrator only reads them without gradients
+    self.odeblock.test_integrator.m2_weight = self.m2.weight.detach()
+    self.odeblock.test_integrator.m2_bias = self.m2.bias.detach()
 
   def set_solver_data(self, data):
     self.odeblock.test_integrator.data = data
@@ -139,6 +140,10 @@ class GNNEarly(BaseGNN):
       z, self.reg_states = self.odeblock(x)
     else:
       z = self.odeblock(x)
+      if not self.training:
+        # the state at the best val time, which the early stopping integrator kept, rather than the state at the end
+        # of its solve past T
+        z = self.odeblock.test_integrator.best_state
 
     if self.opt['augment']:
       z = torch.split(z, x.shape[1] // 2, dim=1)[0]
@@ -262,6 +267,9 @@ if __name__ == '__main__':
   parser.add_argument('--ppr_alpha', type=float, default=0.05, help="teleport probability")
   parser.add_argument('--heat_time', type=float, default=3., help="time to run gdc heat kernal diffusion for")
   parser.add_argument('--earlystopxT', type=float, default=3, help='multiplier for T used to evaluate best model')
+  parser.add_argument('--earlystop_points', type=int, default=1,
+                      help='number of evenly spaced times in each step of the early stopping solver at which the '
+                           'accuracy is evaluated, on the interpolant of the step')
 
   args = parser.parse_args()
 
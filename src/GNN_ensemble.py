@@ -0,0 +1,243 @@
+"""
+An ensemble of GNN replicas, e.g. the random initialisations or the random splits of a ray trial, trained and evaluated
+together. Their parameters are stacked with torch.func, the encoders and decoders of all the members run in one vmapped
+call and their ODEs are integrated as a single state by one solver.
+"""
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+from torchdiffeq import odeint_adjoint
+from torchdiffeq._impl.odeint import SOLVERS
+from torchdiffeq._impl.rk_common import RKAdaptiveStepsizeODESolver
+from torchdiffeq._impl.solvers import FixedGridODESolver
+from GNN import GNN
+from utils import CSRCache
+
+# the solvers that need more of the ODE function than its evaluations, which the blocks pass in add_func_options
+FUNC_OPTION_METHODS = ['etdrk2', 'etdrk4', 'ars222', 'imex', 'multirate']
+
+
+def member_rms_norm(state):
+  """The largest rms norm of the members of a [num_nodes, members, d] ensemble state. The step size controller of the
+  shared solver accepts a step when it is accurate enough for every member, as if each one was solved alone."""
+  return state.pow(2).mean(dim=(0, 2)).sqrt().max()
+
+
+class _GNNStage(nn.Module):
+  """Calls a method of a GNN, so that functional_call can run it with the parameters of one member"""
+  def __init__(self, gnn, stage):
+    super(_GNNStage, self).__init__()
+    self.gnn = gnn
+    self.stage = stage
+
+  def forward(self, *args):
+    return getattr(self.gnn, self.stage)(*args)
+
+
+class EnsembleODEFunc(nn.Module):
+  """The ODE function of the ensemble on the [num_nodes, members, d] state. The function of the base GNN is vmapped
+  over the members with their parameters and x0, which GNNEnsemble sets before each solve, and the graph they share is
+  multiplied once for all of them"""
+  def __init__(self, odefunc):
+    super(EnsembleODEFunc, self).__init__()
+    # not a submodule, the parameters that are used are the stacked ones
+    self.__dict__['odefunc'] = odefunc
+    # the members multiply the graph they share through a csr matrix that is built once
+    odefunc.csr_cache = CSRCache()
+    self.params = None
+    self.buffers = None
+    self.x0 = None
+    self.member_forward = vmap(self.forward_member, in_dims=(0, 0, 1, None, 1), out_dims=1)
+
+  def forward_member(self, params, buffers, x0, t, x):
+    return functional_call(self.odefunc, (params, buffers, {'x0': x0}), (t, x))
+
+  def forward(self, t, x):
+    return self.member_forward(self.params, self.buffers, self.x0, t, x)
+
+
+class GNNEnsemble(nn.Module):
+  def __init__(self, models):
+    """
+    :param models: GNNs with the same options, whose parameters become the members of the ensemble. After this the
+    parameters of the ensemble are trained and the models are only updated by unstack.
+    """
+    super(GNNEnsemble, self).__init__()
+    base = models[0]
+    self.opt = base.opt
+    self.check_options(base)
+    self.size = len(models)
+    self.num_classes = base.num_classes
+    self.device = base.device
+    self.fm, self.bm, self.cm = base.fm, base.bm, base.cm
+    # the models aren't submodules, the parameters of the ensemble are the stacked ones
+    self.__dict__['models'] = models
+    self.__dict__['base'] = base
+    self.__dict__['odeblock'] = base.odeblock
+    self.__dict__['encoder'] = _GNNStage(base, 'encode')
+    self.__dict__['decoder'] = _GNNStage(base, 'decode')
+    self.func = EnsembleODEFunc(self.odeblock.odefunc)
+
+    params, buffers = stack_module_state(models)
+    # parameter names can't contain dots
+    self.param_names = list(params)
+    self.buffer_names = list(buffers)
+    for name, param in params.items():
+      self.register_parameter(name.replace('.', '__'), nn.Parameter(param))
+    for name, buffer in buffers.items():
+      self.register_buffer(name.replace('.', '__'), buffer)
+
+    self.encode = vmap(self.encode_member, in_dims=(0, 0, None, None), out_dims=1, randomness='different')
+    self.encode_each = vmap(self.encode_member, in_dims=(0, 0, 0, None), out_dims=1, randomness='different')
+    self.decode = vmap(self.decode_member, in_dims=(0, 0, 1), randomness='different')
+
+  def check_options(self, base):
+    if not isinstance(base, GNN) or self.opt['block'] != 'constant' or self.opt['function'] != 'laplacian':
+      raise NotImplementedError('ensembles are only implemented for GNNs with a constant block and the laplacian '
+                                'function, whose members share their graph')
+    if base.odeblock.nreg > 0:
+      raise NotImplementedError('ensembles are not implemented with regularisation')
+    methods = [self.opt['method']] + ([self.opt['adjoint_method']] if self.opt['adjoint'] else [])
+    for method in methods:
+      solver = SOLVERS.get(method)
+      if solver is None or not issubclass(solver, (FixedGridODESolver, RKAdaptiveStepsizeODESolver)) \
+          or method in FUNC_OPTION_METHODS:
+        raise NotImplementedError('ensembles are not implemented with the {} solver'.format(method))
+
+  def stacked(self, prefix=''):
+    """The stacked parameters and buffers of the members, named as in the base GNN"""
+    params = {prefix + name: getattr(self, name.replace('.', '__')) for name in self.param_names}
+    buffers = {prefix + name: getattr(self, name.replace('.', '__')) for name in self.buffer_names}
+    return params, buffers
+
+  def encode_member(self, params, buffers, x, pos_encoding):
+    return functional_call(self.encoder, (params, buffers), (x, pos_encoding))
+
+  def decode_member(self, params, buffers, z):
+    return functional_call(self.decoder, (params, buffers), (z,))
+
+  def set_func_params(self, params, buffers, x0):
+    prefix = 'odeblock.odefunc.'
+    self.func.params = {name[len(prefix):]: param for name, param in params.items() if name.startswith(prefix)}
+    self.func.buffers = {name[len(prefix):]: buffer for name, buffer in buffers.items() if name.startswith(prefix)}
+    self.func.x0 = x0
+
+  def solve(self, x):
+    odeblock = self.odeblock
+    t = odeblock.t.type_as(x)
+    options = dict(step_size=self.opt['step_size'], max_iters=self.opt['max_iters'], norm=member_rms_norm)
+    options = odeblock.add_step_options(options)
+    if self.opt['adjoint'] and self.training:
+      adjoint_options = odeblock.add_step_options(dict(step_size=self.opt['adjoint_step_size'],
+                                                       max_iters=self.opt['max_iters']), adjoint=True)
+      state_dt = odeint_adjoint(self.func, x, t, method=self.opt['method'], options=options,
+                                adjoint_method=self.opt['adjoint_method'], adjoint_options=adjoint_options,
+                                atol=odeblock.atol, rtol=odeblock.rtol, adjoint_atol=odeblock.atol_adjoint,
+                                adjoint_rtol=odeblock.rtol_adjoint,
+                                adjoint_params=tuple(p for p in self.func.params.values() if p.requires_grad))
+    else:
+      integrator = odeblock.train_integrator if self.training else odeblock.test_integrator
+      state_dt = odeblock.integrate(integrator, self.func, x, t, options)
+    return state_dt[1]
+
+  def forward(self, x, pos_encoding=None):
+    """
+    :param x: the features shared by the members, or stacked for each of them
+    :return: the logits of the members, with shape [members, num_nodes, num_classes]
+    """
+    # the base GNN, which runs the members, is in the mode of the ensemble
+    self.base.train(self.training)
+    params, buffers = self.stacked('gnn.')
+    encode = self.encode_each if x.dim() == 3 else self.encode
+    x = encode(params, buffers, x, pos_encoding)
+    params, buffers = self.stacked()
+    self.set_func_params(params, buffers, x.detach())
+    z = self.solve(x)
+    params, buffers = self.stacked('gnn.')
+    return self.decode(params, buffers, z)
+
+  def member_state_dict(self, k):
+    """The state dict of member k, which can be loaded into a GNN"""
+    params, buffers = self.stacked()
+    return {name: tensor[k].detach().clone() for name, tensor in {**params, **buffers}.items()}
+
+  @torch.no_grad()
+  def load_member_state_dict(self, state_dict):
+    """Loads the state dict of a GNN into every member"""
+    params, buffers = self.stacked()
+    for name, tensor in {**params, **buffers}.items():
+      tensor.copy_(state_dict[name].expand_as(tensor))
+
+  @torch.no_grad()
+  def unstack(self):
+    """Copies the parameters of the members back into their GNNs and returns them"""
+    for k, model in enumerate(self.models):
+      model.load_state_dict(self.member_state_dict(k))
+    return self.models
+
+  def getNFE(self, split=False):
+    return self.base.getNFE(split)
+
+  def resetNFE(self):
+    self.base.resetNFE()
+
+  def __repr__(self):
+    return self.__class__.__name__ + '(' + str(self.size) + ' x ' + repr(self.base) + ')'
+
+
+def stack_masks(datas, name):
+  masks = []
+  for data in datas:
+    mask = getattr(data, name)
+    if mask.dtype != torch.bool:
+      # the ogb splits are indices
+      mask = torch.zeros(data.num_nodes, dtype=torch.bool, device=mask.device).index_fill_(0, mask, True)
+    masks.append(mask)
+  return torch.stack(masks)
+
+
+def member_losses(logits, y, masks):
+  """The mean cross entropy of each member on its mask"""
+  members, num_nodes, num_classes = logits.shape
+  losses = F.cross_entropy(logits.reshape(-1, num_classes), y.reshape(-1).repeat(members),
+                           reduction='none').view(members, num_nodes)
+  return (losses * masks).sum(dim=1) / masks.sum(dim=1)
+
+
+def train_ensemble(ensemble, optimizer, datas, pos_encoding=None):
+  """A training step of every member on its data. The data of the members have the same graph, features and labels
+  and can differ by their splits.
+  :return: the mean loss of the members
+  """
+  ensemble.train()
+  optimizer.zero_grad()
+  data = datas[0]
+  logits = ensemble(data.x, pos_encoding)
+  losses = member_losses(logits, data.y, stack_masks(datas, 'train_mask'))
+
+  ensemble.cm.update(ensemble.getNFE(split=True)[1])
+  ensemble.fm.update(ensemble.getNFE())
+  ensemble.resetNFE()
+  # the members are independent, so the gradient of the sum is the gradient of each loss for its member
+  losses.sum().backward()
+  optimizer.step()
+  ensemble.bm.update(ensemble.getNFE())
+  ensemble.resetNFE()
+  return losses.mean().item()
+
+
+@torch.no_grad()
+def test_ensemble(ensemble, datas, pos_encoding=None):
+  """
+  :return: the lists of the train, val and test accuracies of the members
+  """
+  ensemble.eval()
+  data = datas[0]
+  correct = ensemble(data.x, pos_encoding).argmax(dim=-1).eq(data.y.view(-1))
+  accs = []
+  for name in ['train_mask', 'val_mask', 'test_mask']:
+    masks = stack_masks(datas, name)
+    accs.append(((correct & masks).sum(dim=1) / masks.sum(dim=1)).tolist())
+  return accs
@@ -1,7 +1,14 @@
+import functools
 import torch
 from torch import nn
 from torch_geometric.nn.conv import MessagePassing
-from utils import Meter
+from torch_geometric.utils import sort_edge_index
+from utils import Meter, get_rw_adj
+from torchdiffeq import odeint, odeint_checkpoint, ODESolverPlan
+from torchdiffeq._impl.odeint import SOLVERS
+from torchdiffeq._impl.rk_common import RKAdaptiveStepsizeODESolver, StepSizeMemory
+from torchdiffeq._impl.fixed_adams import AdamsBashforthMoulton
+from torchdiffeq._impl.solvers import FixedGridODESolver
 from regularized_ODE_function import RegularizedODEfunc
 import regularized_ODE_function as reg_lib
 import six
@@ -14,6 +21,21 @@ REGULARIZATION_FNS = {
     "directional_penalty": reg_lib.directional_derivative
 }
 
+# the gains (pcoeff, icoeff, dcoeff) of the step size controllers of the adaptive solvers
+STEP_CONTROLLERS = {
+    "i": (0., 1., 0.),
+    # the PI controller of Hairer's dopri5, with beta = 0.04
+    "pi": (0.2, 0.65, 0.),
+    "pid": (0.3, 0.6, 0.05)
+}
+
+# the solver options that are fixed by opt, the solver plans of a block are cached on them while the other options,
+# which depend on the parameters or the state of the block, are passed to each solve
+PLAN_OPTIONS = ('step_size', 'max_iters')
+# the solver plans kept by a block, e.g. for the train and test functions, the times and the batch sizes of mini-batch
+# training, the least recently used one is dropped first
+MAX_SOLVER_PLANS = 8
+
 
 def create_regularization_fns(args):
     regularization_fns = []
@@ -48,6 +70,143 @@ class ODEblock(nn.Module):
     self.train_integrator = odeint
     self.test_integrator = None
     self.set_tol()
+    self.set_grad_mode()
+    # accepted step sizes of the last solve, kept apart for the train and test integrators and the forward and adjoint
+    # passes, whose dynamics and tolerances differ
+    self.warm_start = not opt['no_warm_start'] if 'no_warm_start' in opt else True
+    self.step_memory = {(training, adjoint): StepSizeMemory() for training in (True, False) for adjoint in (False, True)}
+    self.solver_plans = {}
+    self.check_method()
+
+  def check_method(self):
+    """Rejects the solvers that need more of the block or its function than they provide, when the block is built
+    rather than at the first solve"""
+    # the checkpointed solves replace the adjoint method as the train integrator, and take none of its arguments
+    if self.opt['adjoint'] and 'grad_mode' in self.opt and self.opt['grad_mode'] == 'checkpoint':
+      raise ValueError("--adjoint and --grad_mode checkpoint are two ways of computing the gradients, choose one")
+    if self.opt['adjoint'] and self.opt['adjoint_method'] == 'chebyshev':
+      raise NotImplementedError("the chebyshev solver can't solve the adjoint, which isn't a linear diffusion")
+    # the mixed attention isn't symmetric, its spectrum can be complex and the truncation of the chebyshev expansion
+    # would underestimate its error
+    if self.opt['method'] == 'chebyshev' and (self.opt['block'] != 'constant'
+                                             or not hasattr(self.odefunc, 'spectral_interval')):
+      raise NotImplementedError('the chebyshev solver needs the real spectral interval of a fixed linear diffusion, '
+                                'which is only implemented for the constant block with the laplacian function')
+    if 'buffered' in self.opt and self.opt['buffered']:
+      # add_step_options passes buffered to the fixed grid adjoint solvers too, the adaptive ones just aren't buffered
+      methods = [self.opt['method']]
+      if self.opt['adjoint'] and issubclass(SOLVERS.get(self.opt['adjoint_method'], object), FixedGridODESolver):
+        methods.append(self.opt['adjoint_method'])
+      for method in methods:
+        if getattr(SOLVERS.get(method), 'n_stage_buffers', None) is None:
+          raise NotImplementedError('the {} solver has no buffered mode, only euler, midpoint and rk4 have one'.format(
+            method))
+    has_linear_part = hasattr(self.odefunc, 'linear_part')
+    if self.opt['method'] in ['etdrk2', 'etdrk4'] and not has_linear_part:
+      raise NotImplementedError('the {} solver needs the linear_part of the function, which {} does not provide'.format(
+        self.opt['method'], self.odefunc))
+    if self.opt['method'] in ['ars222', 'imex'] and not has_linear_part \
+        and type(self.odefunc).imex_options is ODEFunc.imex_options:
+      raise NotImplementedError('the {} solver needs the imex_options or the linear_part of the function, which {} does '
+                                'not provide'.format(self.opt['method'], self.odefunc))
+
+  def integrate(self, integrator, func, state, t, options):
+    """Solves with the train or test integrator outside of the adjoint method. The solves with odeint go through an
+    ODESolverPlan, which is cached on the function, the shapes of the state, the times, the tolerances and the
+    PLAN_OPTIONS, and checks the inputs and builds the wrappers and the time grid once. At most MAX_SOLVER_PLANS are
+    kept"""
+    if integrator is not odeint:
+      return integrator(func, state, t, method=self.opt['method'], options=options, atol=self.atol, rtol=self.rtol)
+    plan_options = {name: options[name] for name in PLAN_OPTIONS if name in options}
+    states = state if isinstance(state, tuple) else (state,)
+    # the plans keep self.t alive, so that its id identifies it
+    key = (func, isinstance(state, tuple), tuple(s.shape for s in states), states[0].dtype, t.device, id(self.t),
+           self.opt['method'], self.atol, self.rtol, tuple(sorted(plan_options.items())))
+    try:
+      # reinserted, so that the dict is ordered from the least to the most recently used plan
+      plan = self.solver_plans.pop(key)[1]
+    except KeyError:
+      plan = ODESolverPlan(func, state, t, rtol=self.rtol, atol=self.atol, method=self.opt['method'],
+                           options=plan_options)
+      if len(self.solver_plans) >= MAX_SOLVER_PLANS:
+        del self.solver_plans[next(iter(self.solver_plans))]
+    self.solver_plans[key] = (self.t, plan)
+    return plan.solve(state, {name: value for name, value in options.items() if name not in plan_options})
+
+  def add_step_options(self, options, adjoint=False):
+    """Adds the step size memory of the current integrator, the gains of its step size controller and the fused error
+    norm to the solver options for adaptive Runge-Kutta methods, and the buffered mode and the evaluation budget of
+    the Adams corrector for fixed grid methods"""
+    method = self.opt['adjoint_method'] if adjoint else self.opt['method']
+    solver = SOLVERS.get(method)
+    if solver is None:
+      return options
+    if issubclass(solver, FixedGridODESolver):
+      if 'buffered' in self.opt and self.opt['buffered']:
+        # only used by the solves that don't build a graph, i.e. at inference and in the forward pass of the adjoint
+        options = dict(options, buffered=True)
+      if issubclass(solver, AdamsBashforthMoulton) and not adjoint:
+        # the corrector stops iterating before the evaluations of the solve exceed max_nfe
+        options = dict(options, nfe_budget=self.opt['max_nfe'] - self.odefunc.nfe)
+      return options
+    if not issubclass(solver, RKAdaptiveStepsizeODESolver):
+      return options
+    pcoeff, icoeff, dcoeff = STEP_CONTROLLERS[self.opt['step_controller'] if 'step_controller' in self.opt else 'i']
+    options = dict(options, pcoeff=pcoeff, icoeff=icoeff, dcoeff=dcoeff)
+    if 'fused_norm' in self.opt and self.opt['fused_norm']:
+      options['fused_norm'] = True
+    if self.warm_start:
+      options['step_memory'] = self.step_memory[(self.training, adjoint)]
+    return options
+
+  def add_func_options(self, options, state):
+    """Adds the parts of the function that the exponential and imex integrators treat exactly or implicitly, and the
+    options of the multirate and parareal integrators, to the solver options"""
+    if self.opt['method'] in ['etdrk2', 'etdrk4']:
+      if isinstance(state, tuple):
+        # the regularisation states have no linear part
+        return dict(options, linear_part=(self.odefunc.linear_part(),) + (0.,) * (len(state) - 1))
+      return dict(options, linear_part=self.odefunc.linear_part())
+    if self.opt['method'] in ['ars222', 'imex']:
+      imex_options = self.odefunc.imex_options()
+      if isinstance(state, tuple):
+        implicit_part = imex_options['implicit_part']
+        imex_options['implicit_part'] = lambda t, s, *tensors: (implicit_part(t, s[0], *tensors),) + tuple(
+          torch.zeros_like(reg_state) for reg_state in s[1:])
+      return dict(options, **imex_options)
+    if self.opt['method'] == 'multirate' and not isinstance(state, tuple):
+      # with regularisation states the rows of the flattened state are not nodes, and the solver evaluates all of them
+      options = dict(options, row_func=self.odefunc.forward_rows)
+      if hasattr(self.odefunc, 'row_sources'):
+        options['row_sources'] = self.odefunc.row_sources
+      return options
+    if self.opt['method'] == 'parareal':
+      # step_size is the step of the coarse solver, the fine solver uses the tolerances of the block
+      parareal_options = {}
+      for option in ['fine_method', 'slices', 'workers']:
+        if 'parareal_' + option in self.opt and self.opt['parareal_' + option] is not None:
+          parareal_options[option] = self.opt['parareal_' + option]
+      return dict(options, **parareal_options)
+    return options
+
+  def get_step_stats(self, reset=False):
+    """
+    :return: the number of rejected steps and the number of solves that were warm started, each of which saved the
+    function evaluation of _select_initial_step
+    """
+    n_rejected = sum(memory.n_rejected for memory in self.step_memory.values())
+    n_warm_starts = sum(memory.n_warm_starts for memory in self.step_memory.values())
+    if reset:
+      for memory in self.step_memory.values():
+        memory.reset_counts()
+    return n_rejected, n_warm_starts
+
+  def set_grad_mode(self):
+    """With grad_mode checkpoint the training solves keep the states at accepted step boundaries, or at most
+    opt['checkpoints'] of them, and recompute the graph of each step in the backward pass"""
+    if 'grad_mode' in self.opt and self.opt['grad_mode'] == 'checkpoint':
+      checkpoints = self.opt['checkpoints'] if 'checkpoints' in self.opt else None
+      self.train_integrator = functools.partial(odeint_checkpoint, checkpoints=checkpoints)
 
   def set_x0(self, x0):
     self.odefunc.x0 = x0.clone().detach()
@@ -66,8 +225,24 @@ class ODEblock(nn.Module):
     self.atol_adjoint = 1e-7
     self.rtol_adjoint = 1e-9
 
+  def set_graph(self, data):
+    """Sets the graph of the ODE functions to the random walk normalised adjacency of data with self loops, sorted by
+    source so that row normalised attention can use CSR segments without permuting. The blocks set the graph of the
+    dataset when they are built, and mini-batch training sets the subgraph of each batch."""
+    edge_index, edge_weight = get_rw_adj(data.edge_index, edge_weight=data.edge_attr, norm_dim=1,
+                                         fill_value=self.opt['self_loop_weight'],
+                                         num_nodes=data.num_nodes,
+                                         dtype=data.x.dtype)
+    edge_index, edge_weight = sort_edge_index(edge_index, edge_weight, data.num_nodes)
+    self.odefunc.edge_index = edge_index.to(self.odefunc.device)
+    self.odefunc.edge_weight = edge_weight.to(self.odefunc.device)
+    self.reg_odefunc.odefunc.edge_index, self.reg_odefunc.odefunc.edge_weight = self.odefunc.edge_index, self.odefunc.edge_weight
+    if 'multihead_att_layer' in self._modules and self.multihead_att_layer.edge_weights is not None:
+      self.multihead_att_layer.edge_weights = self.odefunc.edge_weight
+
   def set_time(self, time):
     self.t = torch.tensor([0, time]).to(self.device)
+    self.solver_plans = {}
 
   def __repr__(self):
     return self.__class__.__name__ + '( Time Interval ' + str(self.t[0].item()) + ' -> ' + str(self.t[1].item()) \
@@ -88,9 +263,28 @@ class ODEFunc(MessagePassing):
     self.beta_train = nn.Parameter(torch.tensor(0.0))
     self.x0 = None
     self.nfe = 0
+    self.nfe_cached = 0  # evaluations that reused cached attention instead of recomputing it
     self.alpha_sc = nn.Parameter(torch.ones(1))
     self.beta_sc = nn.Parameter(torch.ones(1))
 
+  def forward_rows(self, t, x, rows):
+    """
+    :return: the function on the given rows (nodes) only, for the multirate solver. By default the function is
+    evaluated on every node, functions that aggregate over edges can aggregate over the edges into `rows` only.
+    """
+    return self(t, x)[rows]
+
+  def imex_options(self):
+    """
+    :return: the options of the imex solver: implicit_part(t, x, *implicit_tensors), the part of the function that is
+    linear in x and treated implicitly, the tensors it is built from and the linear_solver. By default this is the
+    diagonal linear_part(), the diagonal of the linear part L of the function broadcastable to x, which the
+    exponential integrators etdrk2 and etdrk4 integrate exactly while treating f(t, x) - L x explicitly, and the rest
+    of the function is treated explicitly. The functions that provide neither are rejected by ODEblock.check_method.
+    """
+    return dict(implicit_part=lambda t, x, linear_part: linear_part * x, implicit_tensors=(self.linear_part(),),
+                linear_solver='cg')
+
   def __repr__(self):
     return self.__class__.__name__
 
@@ -106,6 +300,7 @@ class BaseGNN(MessagePassing):
     self.device = device
     self.fm = Meter()
     self.bm = Meter()
+    self.cm = Meter()
 
     if opt['beltrami']:
       self.mx = nn.Linear(self.num_features, opt['feat_hidden_dim'])
@@ -131,12 +326,22 @@ class BaseGNN(MessagePassing):
 
     self.regularization_fns, self.regularization_coeffs = create_regularization_fns(self.opt)
 
-  def getNFE(self):
-    return self.odeblock.odefunc.nfe + self.odeblock.reg_odefunc.odefunc.nfe
+  def getNFE(self, split=False):
+    """
+    :param split: if True return a tuple of the evaluations that computed attention in full and the ones that reused
+    cached attention weights
+    """
+    nfe = self.odeblock.odefunc.nfe + self.odeblock.reg_odefunc.odefunc.nfe
+    if split:
+      nfe_cached = self.odeblock.odefunc.nfe_cached + self.odeblock.reg_odefunc.odefunc.nfe_cached
+      return nfe - nfe_cached, nfe_cached
+    return nfe
 
   def resetNFE(self):
     self.odeblock.odefunc.nfe = 0
     self.odeblock.reg_odefunc.odefunc.nfe = 0
+    self.odeblock.odefunc.nfe_cached = 0
+    self.odeblock.reg_odefunc.odefunc.nfe_cached = 0
 
   def reset(self):
     self.m1.reset_parameters()
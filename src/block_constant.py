@@ -1,6 +1,6 @@
 from base_classes import ODEblock
 import torch
-from utils import get_rw_adj, gcn_norm_fill_val
+from utils import get_rw_adj, gcn_norm_fill_val, spectral_radius_bound
 
 
 class ConstantODEblock(ODEblock):
@@ -9,19 +9,7 @@ class ConstantODEblock(ODEblock):
 
     self.aug_dim = 2 if opt['augment'] else 1
     self.odefunc = odefunc(self.aug_dim * opt['hidden_dim'], self.aug_dim * opt['hidden_dim'], opt, data, device)
-    if opt['data_norm'] == 'rw':
-      edge_index, edge_weight = get_rw_adj(data.edge_index, edge_weight=data.edge_attr, norm_dim=1,
-                                                                   fill_value=opt['self_loop_weight'],
-                                                                   num_nodes=data.num_nodes,
-                                                                   dtype=data.x.dtype)
-    else:
-      edge_index, edge_weight = gcn_norm_fill_val(data.edge_index, edge_weight=data.edge_attr,
-                                           fill_value=opt['self_loop_weight'],
-                                           num_nodes=data.num_nodes,
-                                           dtype=data.x.dtype)
-    self.odefunc.edge_index = edge_index.to(device)
-    self.odefunc.edge_weight = edge_weight.to(device)
-    self.reg_odefunc.odefunc.edge_index, self.reg_odefunc.odefunc.edge_weight = self.odefunc.edge_index, self.odefunc.edge_weight
+    self.set_graph(data)
 
     if opt['adjoint']:
       from torchdiffeq import odeint_adjoint as odeint
@@ -31,6 +19,24 @@ class ConstantODEblock(ODEblock):
     self.train_integrator = odeint
     self.test_integrator = odeint
     self.set_tol()
+    self.set_grad_mode()
+
+  def set_graph(self, data):
+    if self.opt['data_norm'] == 'rw':
+      edge_index, edge_weight = get_rw_adj(data.edge_index, edge_weight=data.edge_attr, norm_dim=1,
+                                                                   fill_value=self.opt['self_loop_weight'],
+                                                                   num_nodes=data.num_nodes,
+                                                                   dtype=data.x.dtype)
+    else:
+      edge_index, edge_weight = gcn_norm_fill_val(data.edge_index, edge_weight=data.edge_attr,
+                                           fill_value=self.opt['self_loop_weight'],
+                                           num_nodes=data.num_nodes,
+                                           dtype=data.x.dtype)
+    self.odefunc.edge_index = edge_index.to(self.odefunc.device)
+    self.odefunc.edge_weight = edge_weight.to(self.odefunc.device)
+    # the operator is fixed, so the spectral bound used by the chebyshev solver is computed once per graph
+    self.adj_bound = spectral_radius_bound(edge_index, edge_weight, data.num_nodes)
+    self.reg_odefunc.odefunc.edge_index, self.reg_odefunc.odefunc.edge_weight = self.odefunc.edge_index, self.odefunc.edge_weight
 
   def forward(self, x):
     t = self.t.type_as(x)
@@ -42,24 +48,27 @@ class ConstantODEblock(ODEblock):
     func = self.reg_odefunc if self.training and self.nreg > 0 else self.odefunc
     state = (x,) + reg_states if self.training and self.nreg > 0 else x
 
+    options = dict(step_size=self.opt['step_size'], max_iters=self.opt['max_iters'])
+    if self.opt['method'] == 'chebyshev':
+      options['spectral_interval'] = self.odefunc.spectral_interval(self.adj_bound)
+      # beta_train starts at 0, where the source term still has a gradient
+      options['source'] = self.opt['add_source']
+
+    options = self.add_step_options(self.add_func_options(options, state))
     if self.opt["adjoint"] and self.training:
       state_dt = integrator(
         func, state, t,
         method=self.opt['method'],
-        options=dict(step_size=self.opt['step_size'], max_iters=self.opt['max_iters']),
+        options=options,
         adjoint_method=self.opt['adjoint_method'],
-        adjoint_options=dict(step_size = self.opt['adjoint_step_size'], max_iters=self.opt['max_iters']),
+        adjoint_options=self.add_step_options(dict(step_size=self.opt['adjoint_step_size'], max_iters=self.opt['max_iters']),
+                                              adjoint=True),
         atol=self.atol,
         rtol=self.rtol,
         adjoint_atol=self.atol_adjoint,
         adjoint_rtol=self.rtol_adjoint)
     else:
-      state_dt = integrator(
-        func, state, t,
-        method=self.opt['method'],
-        options=dict(step_size=self.opt['step_size'], max_iters=self.opt['max_iters']),
-        atol=self.atol,
-        rtol=self.rtol)
+      state_dt = self.integrate(integrator, func, state, t, options)
 
     if self.training and self.nreg > 0:
       z = state_dt[0][1]
@@ -33,6 +33,7 @@ class ConstantODEblock(ODEblock):
     self.train_integrator = odeint
     self.test_integrator = odeint
     self.set_tol()
+    self.set_grad_mode()
 
 
   def add_random_edges(self):
@@ -113,24 +114,22 @@ class ConstantODEblock(ODEblock):
     func = self.reg_odefunc if self.training and self.nreg > 0 else self.odefunc
     state = (x,) + reg_states if self.training and self.nreg > 0 else x
 
+    options = dict(step_size=self.opt['step_size'], max_iters=self.opt['max_iters'])
+    options = self.add_step_options(self.add_func_options(options, state))
     if self.opt["adjoint"] and self.training:
       state_dt = integrator(
         func, state, t,
         method=self.opt['method'],
-        options=dict(step_size=self.opt['step_size'], max_iters=self.opt['max_iters']),
+        options=options,
         adjoint_method=self.opt['adjoint_method'],
-        adjoint_options=dict(step_size = self.opt['adjoint_step_size'], max_iters=self.opt['max_iters']),
+        adjoint_options=self.add_step_options(dict(step_size=self.opt['adjoint_step_size'], max_iters=self.opt['max_iters']),
+                                              adjoint=True),
         atol=self.atol,
         rtol=self.rtol,
         adjoint_atol=self.atol_adjoint,
         adjoint_rtol=self.rtol_adjoint)
     else:
-      state_dt = integrator(
-        func, state, t,
-        method=self.opt['method'],
-        options=dict(step_size=self.opt['step_size'], max_iters=self.opt['max_iters']),
-        atol=self.atol,
-        rtol=self.rtol)
+      state_dt = self.integrate(integrator, func, state, t, options)
 
     if self.training and self.nreg > 0:
       z = state_dt[0][1]
@@ -2,7 +2,6 @@ import torch
 from torch import nn
 from function_transformer_attention import SpGraphTransAttentionLayer
 from base_classes import ODEblock
-from utils import get_rw_adj
 
 
 class MixedODEblock(ODEblock):
@@ -11,13 +10,7 @@ class MixedODEblock(ODEblock):
 
     self.odefunc = odefunc(self.aug_dim * opt['hidden_dim'], self.aug_dim * opt['hidden_dim'], opt, data, device)
     # self.odefunc.edge_index, self.odefunc.edge_weight = data.edge_index, edge_weight=data.edge_attr
-    edge_index, edge_weight = get_rw_adj(data.edge_index, edge_weight=data.edge_attr, norm_dim=1,
-                                         fill_value=opt['self_loop_weight'],
-                                         num_nodes=data.num_nodes,
-                                         dtype=data.x.dtype)
-    self.odefunc.edge_index = edge_index.to(device)
-    self.odefunc.edge_weight = edge_weight.to(device)
-    self.reg_odefunc.odefunc.edge_index, self.reg_odefunc.odefunc.edge_weight = self.odefunc.edge_index, self.odefunc.edge_weight
+    self.set_graph(data)
 
     if opt['adjoint']:
       from torchdiffeq import odeint_adjoint as odeint
@@ -26,6 +19,7 @@ class MixedODEblock(ODEblock):
     self.train_integrator = odeint
     self.test_integrator = odeint
     self.set_tol()
+    self.set_grad_mode()
     # parameter trading off between attention and the Laplacian
     self.gamma = nn.Parameter(gamma * torch.ones(1))
     self.multihead_att_layer = SpGraphTransAttentionLayer(opt['hidden_dim'], opt['hidden_dim'], opt,
@@ -44,25 +38,24 @@ class MixedODEblock(ODEblock):
   def forward(self, x):
     t = self.t.type_as(x)
     self.odefunc.attention_weights = self.get_mixed_attention(x)
+    # the Laplacian part of the mixed attention, which the imex solver treats implicitly
+    self.odefunc.fixed_weights = self.odefunc.edge_weight * torch.sigmoid(self.gamma)
     integrator = self.train_integrator if self.training else self.test_integrator
+    options = {'step_size': self.opt['step_size']}
+    options = self.add_step_options(self.add_func_options(options, x))
     if self.opt["adjoint"] and self.training:
       z = integrator(
         self.odefunc, x, t,
         method=self.opt['method'],
-        options={'step_size': self.opt['step_size']},
+        options=options,
         adjoint_method=self.opt['adjoint_method'],
-        adjoint_options={'step_size': self.opt['adjoint_step_size']},
+        adjoint_options=self.add_step_options({'step_size': self.opt['adjoint_step_size']}, adjoint=True),
         atol=self.atol,
         rtol=self.rtol,
         adjoint_atol=self.atol_adjoint,
         adjoint_rtol=self.rtol_adjoint)[1]
     else:
-      z = integrator(
-        self.odefunc, x, t,
-        method=self.opt['method'],
-        options={'step_size': self.opt['step_size']},
-        atol=self.atol,
-        rtol=self.rtol)[1]
+      z = self.integrate(integrator, self.odefunc, x, t, options)[1]
 
     return z
 
@@ -1,7 +1,6 @@
 import torch
 from function_transformer_attention import SpGraphTransAttentionLayer
 from base_classes import ODEblock
-from utils import get_rw_adj
 
 
 class AttODEblock(ODEblock):
@@ -10,13 +9,7 @@ class AttODEblock(ODEblock):
 
     self.odefunc = odefunc(self.aug_dim * opt['hidden_dim'], self.aug_dim * opt['hidden_dim'], opt, data, device)
     # self.odefunc.edge_index, self.odefunc.edge_weight = data.edge_index, edge_weight=data.edge_attr
-    edge_index, edge_weight = get_rw_adj(data.edge_index, edge_weight=data.edge_attr, norm_dim=1,
-                                         fill_value=opt['self_loop_weight'],
-                                         num_nodes=data.num_nodes,
-                                         dtype=data.x.dtype)
-    self.odefunc.edge_index = edge_index.to(device)
-    self.odefunc.edge_weight = edge_weight.to(device)
-    self.reg_odefunc.odefunc.edge_index, self.reg_odefunc.odefunc.edge_weight = self.odefunc.edge_index, self.odefunc.edge_weight
+    self.set_graph(data)
 
     if opt['adjoint']:
       from torchdiffeq import odeint_adjoint as odeint
@@ -25,6 +18,7 @@ class AttODEblock(ODEblock):
     self.train_integrator = odeint
     self.test_integrator = odeint
     self.set_tol()
+    self.set_grad_mode()
     # parameter trading off between attention and the Laplacian
     self.multihead_att_layer = SpGraphTransAttentionLayer(opt['hidden_dim'], opt['hidden_dim'], opt,
                                                           device, edge_weights=self.odefunc.edge_weight).to(device)
@@ -44,24 +38,20 @@ class AttODEblock(ODEblock):
     func = self.reg_odefunc if self.training and self.nreg > 0 else self.odefunc
     state = (x,) + reg_states if self.training and self.nreg > 0 else x
 
+    options = self.add_step_options(self.add_func_options({'step_size': self.opt['step_size']}, state))
     if self.opt["adjoint"] and self.training:
       state_dt = integrator(
         func, state, t,
         method=self.opt['method'],
-        options={'step_size': self.opt['step_size']},
+        options=options,
         adjoint_method=self.opt['adjoint_method'],
-        adjoint_options={'step_size': self.opt['adjoint_step_size']},
+        adjoint_options=self.add_step_options({'step_size': self.opt['adjoint_step_size']}, adjoint=True),
         atol=self.atol,
         rtol=self.rtol,
         adjoint_atol=self.atol_adjoint,
         adjoint_rtol=self.rtol_adjoint)
     else:
-      state_dt = integrator(
-        func, state, t,
-        method=self.opt['method'],
-        options={'step_size': self.opt['step_size']},
-        atol=self.atol,
-        rtol=self.rtol)
+      state_dt = self.integrate(integrator, func, state, t, options)
 
     if self.training and self.nreg > 0:
       z = state_dt[0][1]
@@ -1,8 +1,7 @@
 import torch
 from function_transformer_attention import SpGraphTransAttentionLayer
 from base_classes import ODEblock
-from utils import get_rw_adj
-from torch_scatter import scatter
+from utils import get_edge_csr
 import numpy as np
 import torch_sparse
 from torch_geometric.utils import remove_self_loops
@@ -14,15 +13,8 @@ class RewireAttODEblock(ODEblock):
     self.opt = opt
     self.odefunc = odefunc(self.aug_dim * opt['hidden_dim'], self.aug_dim * opt['hidden_dim'], opt, data, device)
     # self.odefunc.edge_index, self.odefunc.edge_weight = data.edge_index, edge_weight=data.edge_attr
-    self.num_nodes = data.num_nodes
-    edge_index, edge_weight = get_rw_adj(data.edge_index, edge_weight=data.edge_attr, norm_dim=1,
-                                         fill_value=opt['self_loop_weight'],
-                                         num_nodes=data.num_nodes,
-                                         dtype=data.x.dtype)
-    self.data_edge_index = edge_index.to(device)
-    self.odefunc.edge_index = edge_index.to(device)  # this will be changed by attention scores
-    self.odefunc.edge_weight = edge_weight.to(device)
-    self.reg_odefunc.odefunc.edge_index, self.reg_odefunc.odefunc.edge_weight = self.odefunc.edge_index, self.odefunc.edge_weight
+    self.edge_csr = None
+    self.set_graph(data)
 
     if opt['adjoint']:
       from torchdiffeq import odeint_adjoint as odeint
@@ -31,11 +23,17 @@ class RewireAttODEblock(ODEblock):
     self.train_integrator = odeint
     self.test_integrator = odeint
     self.set_tol()
+    self.set_grad_mode()
     # parameter trading off between attention and the Laplacian
     if opt['function'] not in {'GAT', 'transformer'}:
       self.multihead_att_layer = SpGraphTransAttentionLayer(opt['hidden_dim'], opt['hidden_dim'], opt,
                                                           device, edge_weights=self.odefunc.edge_weight).to(device)
 
+  def set_graph(self, data):
+    super(RewireAttODEblock, self).set_graph(data)
+    self.num_nodes = data.num_nodes
+    self.data_edge_index = self.odefunc.edge_index  # odefunc.edge_index will be changed by attention scores
+
   def get_attention_weights(self, x):
     if self.opt['function'] not in {'GAT', 'transformer'}:
       attention, values = self.multihead_att_layer(x, self.data_edge_index)
@@ -44,8 +42,8 @@ class RewireAttODEblock(ODEblock):
     return attention
 
   def renormalise_attention(self, attention):
-    index = self.odefunc.edge_index[self.opt['attention_norm_idx']]
-    att_sums = scatter(attention, index, dim=0, dim_size=self.num_nodes, reduce='sum')[index]
+    self.edge_csr = get_edge_csr(self.edge_csr, self.odefunc.edge_index, self.num_nodes)
+    att_sums = self.edge_csr.segment_sum(attention, self.opt['attention_norm_idx'])
     return attention / (att_sums + 1e-16)
 
 
@@ -213,24 +211,20 @@ class RewireAttODEblock(ODEblock):
     func = self.reg_odefunc if self.training and self.nreg > 0 else self.odefunc
     state = (x,) + reg_states if self.training and self.nreg > 0 else x
 
+    options = self.add_step_options(self.add_func_options({'step_size': self.opt['step_size']}, state))
     if self.opt["adjoint"] and self.training:
       state_dt = integrator(
         func, state, t,
         method=self.opt['method'],
-        options={'step_size': self.opt['step_size']},
+        options=options,
         adjoint_method=self.opt['adjoint_method'],
-        adjoint_options={'step_size': self.opt['adjoint_step_size']},
+        adjoint_options=self.add_step_options({'step_size': self.opt['adjoint_step_size']}, adjoint=True),
         atol=self.atol,
         rtol=self.rtol,
         adjoint_atol=self.atol_adjoint,
         adjoint_rtol=self.rtol_adjoint)
     else:
-      state_dt = integrator(
-        func, state, t,
-        method=self.opt['method'],
-        options={'step_size': self.opt['step_size']},
-        atol=self.atol,
-        rtol=self.rtol)
+      state_dt = self.integrate(integrator, func, state, t, options)
 
     if self.training and self.nreg > 0:
       z = state_dt[0][1]
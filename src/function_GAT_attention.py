@@ -30,19 +30,21 @@ class ODEFuncAtt(ODEFunc):
     self.d_k = self.attention_dim // opt['heads']
 
   def multiply_attention(self, x, attention, wx):
+    # every head aggregates the same features, so the mean over the heads is one spmm with the mean attention
+    mean_attention = attention.mean(dim=1)
     if self.opt['mix_features']:
-      wx = torch.mean(torch.stack(
-        [torch_sparse.spmm(self.edge_index, attention[:, idx], wx.shape[0], wx.shape[0], wx) for idx in
-         range(self.opt['heads'])], dim=0),
-        dim=0)
+      wx = torch_sparse.spmm(self.edge_index, mean_attention, wx.shape[0], wx.shape[0], wx)
       ax = torch.mm(wx, self.multihead_att_layer.Wout)
     else:
-      ax = torch.mean(torch.stack(
-        [torch_sparse.spmm(self.edge_index, attention[:, idx], x.shape[0], x.shape[0], x) for idx in
-         range(self.opt['heads'])], dim=0),
-        dim=0)
+      ax = torch_sparse.spmm(self.edge_index, mean_attention, x.shape[0], x.shape[0], x)
     return ax
 
+  def linear_part(self):
+    # the -alpha x term, the attention coupling alpha A(x) x is treated explicitly
+    if not self.opt['no_alpha_sigmoid']:
+      return -torch.sigmoid(self.alpha_train)
+    return -self.alpha_train
+
   def forward(self, t, x):  # t is needed when called by the integrator
 
     if self.nfe > self.opt["max_nfe"]:
@@ -52,7 +54,6 @@ class ODEFuncAtt(ODEFunc):
 
     attention, wx = self.multihead_att_layer(x, self.edge_index)
     ax = self.multiply_attention(x, attention, wx)
-    # todo would be nice if this was more efficient
 
     if not self.opt['no_alpha_sigmoid']:
       alpha = torch.sigmoid(self.alpha_train)
@@ -107,10 +108,12 @@ class SpGraphAttentionLayer(nn.Module):
     h = wx.view(-1, self.h, self.d_k)
     h = h.transpose(1, 2)
 
-    # Self-attention on the nodes - Shared attention mechanism
-    edge_h = torch.cat((h[edge[0, :], :, :], h[edge[1, :], :, :]), dim=1).transpose(0, 1).to(
-      self.device)  # edge: 2*D x E
-    edge_e = self.leakyrelu(torch.sum(self.a * edge_h, dim=0)).to(self.device)
+    # Self-attention on the nodes - Shared attention mechanism. a^T [h_i || h_j] = a_src^T h_i + a_dst^T h_j, so
+    # score the nodes first and gather one scalar per edge and head for each end instead of the 2*D x E x H edge_h
+    a = self.a.view(1, 2 * self.d_k, 1)
+    src_score = torch.sum(a[:, :self.d_k] * h, dim=1)  # N x H
+    dst_score = torch.sum(a[:, self.d_k:] * h, dim=1)
+    edge_e = self.leakyrelu(src_score[edge[0, :]] + dst_score[edge[1, :]]).to(self.device)
     attention = softmax(edge_e, edge[self.opt['attention_norm_idx']])
     return attention, wx
 
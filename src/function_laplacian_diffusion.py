@@ -3,7 +3,7 @@ from torch import nn
 import torch_sparse
 
 from base_classes import ODEFunc
-from utils import MaxNFEException
+from utils import MaxNFEException, shared_spmm
 
 
 # Define the ODE function.
@@ -24,26 +24,114 @@ class LaplacianODEFunc(ODEFunc):
     self.d = nn.Parameter(torch.zeros(opt['hidden_dim']) + 1)
     self.alpha_sc = nn.Parameter(torch.ones(1))
     self.beta_sc = nn.Parameter(torch.ones(1))
+    # the part of the mixed attention that doesn't depend on x, set by the mixed block
+    self.fixed_weights = None
+    # the csr matrices of the graph shared by the members of a GNNEnsemble, set by the ensemble, which vmaps the function
+    self.csr_cache = None
 
-  def sparse_multiply(self, x):
+    # the edges into the rows last evaluated by forward_rows, and the rows they read
+    self.rows = None
+    self.row_edges = None
+    self.row_edge_index = None
+    self.source_rows = None
+    self.source_edge_index = None
+    self.row_positions = None
+
+  def adjacency_weights(self):
     if self.opt['block'] in ['attention']:  # adj is a multihead attention
-      mean_attention = self.attention_weights.mean(dim=1)
-      ax = torch_sparse.spmm(self.edge_index, mean_attention, x.shape[0], x.shape[0], x)
+      return self.attention_weights.mean(dim=1)
     elif self.opt['block'] in ['mixed', 'hard_attention']:  # adj is a torch sparse matrix
-      ax = torch_sparse.spmm(self.edge_index, self.attention_weights, x.shape[0], x.shape[0], x)
+      return self.attention_weights
     else:  # adj is a torch sparse matrix
-      ax = torch_sparse.spmm(self.edge_index, self.edge_weight, x.shape[0], x.shape[0], x)
-    return ax
+      return self.edge_weight
+
+  def sparse_multiply(self, x):
+    if self.csr_cache is None:
+      return torch_sparse.spmm(self.edge_index, self.adjacency_weights(), x.shape[0], x.shape[0], x)
+    # vmapped over the members of a GNNEnsemble the graph is shared, and this is a single spmm
+    return shared_spmm(self.edge_index, self.adjacency_weights(), x.shape[0], x, self.csr_cache)
+
+  def select_rows(self, rows, num_nodes):
+    """Keeps the edges into `rows`, with their targets numbered by position in `rows`, and the rows they read: the
+    rows and the sources of the edges, with the sources also numbered by position among those rows"""
+    row_mask = torch.zeros(num_nodes, dtype=torch.bool, device=rows.device)
+    row_mask[rows] = True
+    self.row_edges = torch.nonzero(row_mask[self.edge_index[0]]).squeeze(1)
+    position = torch.empty(num_nodes, dtype=torch.long, device=rows.device)
+    position[rows] = torch.arange(len(rows), device=rows.device)
+    targets, sources = position[self.edge_index[0, self.row_edges]], self.edge_index[1, self.row_edges]
+    self.row_edge_index = torch.stack([targets, sources])
+    row_mask[sources] = True
+    self.source_rows = torch.nonzero(row_mask).squeeze(1)
+    position[self.source_rows] = torch.arange(len(self.source_rows), device=rows.device)
+    self.source_edge_index = torch.stack([targets, position[sources]])
+    self.row_positions = position[rows]
+    self.rows = rows
+
+  def row_sources(self, rows, num_nodes):
+    """The rows that forward_rows reads to evaluate `rows`, for the multirate solver"""
+    if self.rows is not rows:
+      self.select_rows(rows, num_nodes)
+    return self.source_rows
+
+  def forward_rows(self, t, x, rows):
+    """The function on `rows` only, aggregating over the edges into them. x is the state on every node, or only on
+    the rows given by row_sources"""
+    if self.nfe > self.opt["max_nfe"]:
+      raise MaxNFEException
+    self.nfe += 1
+    if self.rows is not rows:
+      self.select_rows(rows, x.shape[0])
+    weights = self.adjacency_weights()[self.row_edges]
+    if x.shape[0] == len(self.source_rows):
+      # also the case of a state on every node when the rows read all of them, as the positions are then the nodes
+      edge_index, x_rows = self.source_edge_index, x[self.row_positions]
+    else:
+      edge_index, x_rows = self.row_edge_index, x[rows]
+    ax = torch_sparse.spmm(edge_index, weights, len(rows), x.shape[0], x)
+    f = self.get_alpha() * (ax - x_rows)
+    if self.opt['add_source']:
+      f = f + self.beta_train * self.x0[rows]
+    return f
+
+  def get_alpha(self):
+    if not self.opt['no_alpha_sigmoid']:
+      return torch.sigmoid(self.alpha_train)
+    return self.alpha_train
+
+  def spectral_interval(self, adj_bound):
+    """An interval containing the (assumed real) spectrum of alpha (A - I), given a bound on the spectral radius of A.
+    This is what the chebyshev solver needs in its options."""
+    alpha = self.get_alpha().item()
+    ends = (alpha * (-adj_bound - 1), alpha * (adj_bound - 1))
+    return min(ends), max(ends)
+
+  def linear_part(self):
+    # the -alpha x term, the graph coupling alpha A x is treated explicitly
+    return -self.get_alpha()
+
+  def imex_options(self):
+    """The imex solver treats alpha (A_fixed - I) x implicitly, where A_fixed is the part of the adjacency that doesn't
+    depend on x: all of it for the constant blocks, the gamma weighted Laplacian for the mixed block and none of it
+    for attention"""
+    if self.opt['block'] in ['attention', 'hard_attention']:
+      return super(LaplacianODEFunc, self).imex_options()
+    weights = self.fixed_weights if self.opt['block'] == 'mixed' else self.edge_weight
+
+    def implicit_part(t, x, alpha, weights):
+      return alpha * (torch_sparse.spmm(self.edge_index, weights, x.shape[0], x.shape[0], x) - x)
+
+    # only the symmetrically normalised adjacency of the constant blocks is symmetric
+    symmetric = self.opt['block'] != 'mixed' and self.opt['data_norm'] != 'rw'
+    return dict(implicit_part=implicit_part, implicit_tensors=(self.get_alpha(), weights),
+                linear_solver='cg' if symmetric else 'gmres')
 
   def forward(self, t, x):  # the t param is needed by the ODE solver.
     if self.nfe > self.opt["max_nfe"]:
       raise MaxNFEException
     self.nfe += 1
     ax = self.sparse_multiply(x)
-    if not self.opt['no_alpha_sigmoid']:
-      alpha = torch.sigmoid(self.alpha_train)
-    else:
-      alpha = self.alpha_train
+    alpha = self.get_alpha()
 
     f = alpha * (ax - x)
     if self.opt['add_source']:
@@ -2,10 +2,11 @@ import torch
 from torch import nn
 from torch_geometric.utils import softmax
 import torch_sparse
+from torch_scatter import scatter
 from torch_geometric.utils.loop import add_remaining_self_loops
 import numpy as np
 from data import get_dataset
-from utils import MaxNFEException, squareplus
+from utils import MaxNFEException, squareplus, get_multihead_index, multihead_spmm, get_edge_csr
 from base_classes import ODEFunc
 
 
@@ -21,26 +22,105 @@ class ODEFuncTransformerAtt(ODEFunc):
       self.edge_index, self.edge_weight = data.edge_index, data.edge_attr
     self.multihead_att_layer = SpGraphTransAttentionLayer(in_features, out_features, opt,
                                                           device, edge_weights=self.edge_weight).to(device)
+    self.multihead_index = None
+    self.multihead_edge_index = None
+    # 'always' recomputes attention on every evaluation, 'nfe' every attention_refresh_k evaluations, 'step' once
+    # per accepted solver step and 'threshold' when x has moved by more than attention_refresh_tol relative to the
+    # x the cached attention was computed from
+    try:
+      self.attention_refresh = opt['attention_refresh']
+    except KeyError:
+      self.attention_refresh = 'always'
+    assert self.attention_refresh in {'always', 'nfe', 'step', 'threshold'}, \
+      "unknown attention_refresh {}".format(self.attention_refresh)
+    self.refresh_k = opt['attention_refresh_k'] if 'attention_refresh_k' in opt else 1
+    self.refresh_tol = opt['attention_refresh_tol'] if 'attention_refresh_tol' in opt else 0.01
+    self.reset_attention_cache()
+
+  def get_multihead_index(self):
+    # the expanded index only depends on the graph, so rebuild it only when a block replaces edge_index
+    if self.multihead_index is None or self.multihead_edge_index is not self.edge_index:
+      self.multihead_index = get_multihead_index(self.edge_index, self.opt['heads'])
+      self.multihead_edge_index = self.edge_index
+    return self.multihead_index
 
   def multiply_attention(self, x, attention, v=None):
-    # todo would be nice if this was more efficient
     if self.opt['mix_features']:
-      vx = torch.mean(torch.stack(
-        [torch_sparse.spmm(self.edge_index, attention[:, idx], v.shape[0], v.shape[0], v[:, :, idx]) for idx in
-         range(self.opt['heads'])], dim=0),
-        dim=0)
+      if self.opt['heads'] > 1:
+        vx = multihead_spmm(self.get_multihead_index(), attention, v.transpose(1, 2))
+      else:
+        vx = torch_sparse.spmm(self.edge_index, attention[:, 0], v.shape[0], v.shape[0], v[:, :, 0])
       ax = self.multihead_att_layer.Wout(vx)
     else:
       mean_attention = attention.mean(dim=1)
       ax = torch_sparse.spmm(self.edge_index, mean_attention, x.shape[0], x.shape[0], x)
     return ax
 
+  def reset_attention_cache(self):
+    self.cached_attention = None
+    self.cached_x = None
+    self.cached_key = None
+    self.nfe_since_refresh = 0
+    self.step_accepted = False
+
+  def callback_accept_step(self, t0, y0, dt):
+    self.step_accepted = True
+
+  def callback_accept_step_adjoint(self, t0, y0, dt):
+    self.step_accepted = True
+
+  def attention_is_cached(self):
+    # each evaluation of the adjoint pass backpropagates through its own graph and frees it, so the attention is
+    # recomputed there instead of sharing the graph of a cached attention between evaluations
+    return self.attention_refresh != 'always' and not (self.opt['adjoint'] and torch.is_grad_enabled())
+
+  def attention_is_stale(self, x):
+    # a new solve (set_x0 replaces x0), a rewired graph or a change of grad mode, e.g. between the forward and the
+    # adjoint pass, always invalidates the cache
+    key = (self.x0, self.edge_index, torch.is_grad_enabled())
+    if self.cached_attention is None or any(a is not b for a, b in zip(key, self.cached_key)):
+      return True
+    if not self.attention_is_cached():
+      return True
+    elif self.attention_refresh == 'nfe':
+      return self.nfe_since_refresh >= self.refresh_k
+    elif self.attention_refresh == 'step':
+      return self.step_accepted
+    else:
+      return torch.linalg.norm(x - self.cached_x) > self.refresh_tol * torch.linalg.norm(self.cached_x)
+
+  def get_attention(self, x):
+    if self.attention_is_stale(x):
+      attention, (values, _) = self.multihead_att_layer(x, self.edge_index)
+      if self.attention_is_cached():
+        self.cached_attention = attention
+        # a copy, as the buffered fixed grid solvers update the state in place
+        self.cached_x = x.detach().clone() if self.attention_refresh == 'threshold' else None
+        self.cached_key = (self.x0, self.edge_index, torch.is_grad_enabled())
+        self.nfe_since_refresh = 0
+        self.step_accepted = False
+    else:
+      self.nfe_cached += 1
+      attention, values = self.cached_attention, None
+      if self.opt['mix_features']:
+        # the attention weights are reused, but the values depend on the current x
+        layer = self.multihead_att_layer
+        values = layer.V(x).view(-1, layer.h, layer.d_k).transpose(1, 2)
+    self.nfe_since_refresh += 1
+    return attention, values
+
+  def linear_part(self):
+    # the -alpha x term, the attention coupling alpha A(x) x is treated explicitly
+    if not self.opt['no_alpha_sigmoid']:
+      return -torch.sigmoid(self.alpha_train)
+    return -self.alpha_train
+
   def forward(self, t, x):  # t is needed when called by the integrator
     if self.nfe > self.opt["max_nfe"]:
       raise MaxNFEException
 
     self.nfe += 1
-    attention, values = self.multihead_att_layer(x, self.edge_index)
+    attention, values = self.get_attention(x)
     ax = self.multiply_attention(x, attention, values)
 
     if not self.opt['no_alpha_sigmoid']:
@@ -56,6 +136,94 @@ class ODEFuncTransformerAtt(ODEFunc):
     return self.__class__.__name__ + ' (' + str(self.in_features) + ' -> ' + str(self.out_features) + ')'
 
 
+# edges per chunk are chosen so that each gathered [chunk, d_k, heads] temporary holds at most this many elements
+SDDMM_CHUNK_ELEMENTS = 2 ** 22
+
+
+class EdgeScore(torch.autograd.Function):
+  """
+  Sampled dense-dense matmul (SDDMM) between node level queries and keys on the edges of a graph.
+  For every edge (i, j) and head h this computes <q_i, k_j> (dot) or ||q_i - k_j||^2 (sq_dist), with q and k
+  of shape [n_nodes, d_k, n_heads]. The edges are processed in chunks so no [n_edges, d_k, n_heads] tensor is
+  ever gathered, and only the node level q and k are saved for the backward pass.
+  """
+
+  @staticmethod
+  def forward(ctx, q, k, edge, kernel):
+    ctx.kernel = kernel
+    ctx.save_for_backward(q, k, edge)
+    n_edges = edge.shape[1]
+    chunk = max(1, SDDMM_CHUNK_ELEMENTS // (q.shape[1] * q.shape[2]))
+    out = q.new_empty((n_edges, q.shape[2]))
+    for start in range(0, n_edges, chunk):
+      src = edge[0, start:start + chunk]
+      dst = edge[1, start:start + chunk]
+      if kernel == 'dot':
+        out[start:start + chunk] = torch.sum(q[src] * k[dst], dim=1)
+      else:
+        out[start:start + chunk] = torch.sum((q[src] - k[dst]) ** 2, dim=1)
+    return out
+
+  @staticmethod
+  def backward(ctx, grad_out):
+    q, k, edge = ctx.saved_tensors
+    n_edges = edge.shape[1]
+    chunk = max(1, SDDMM_CHUNK_ELEMENTS // (q.shape[1] * q.shape[2]))
+    grad_q = torch.zeros_like(q) if ctx.needs_input_grad[0] else None
+    grad_k = torch.zeros_like(k) if ctx.needs_input_grad[1] else None
+    for start in range(0, n_edges, chunk):
+      src = edge[0, start:start + chunk]
+      dst = edge[1, start:start + chunk]
+      g = grad_out[start:start + chunk].unsqueeze(1)
+      if grad_q is not None:
+        grad_q.index_add_(0, src, g * k[dst])
+      if grad_k is not None:
+        grad_k.index_add_(0, dst, g * q[src])
+    if ctx.kernel == 'sq_dist':
+      # d||q_i - k_j||^2 = 2 (q_i - k_j), the q_i and k_j terms only need the per node sums of the edge gradients
+      if grad_q is not None:
+        grad_q = 2 * (q * scatter(grad_out, edge[0], dim=0, dim_size=q.shape[0], reduce='sum').unsqueeze(1) - grad_q)
+      if grad_k is not None:
+        grad_k = 2 * (k * scatter(grad_out, edge[1], dim=0, dim_size=k.shape[0], reduce='sum').unsqueeze(1) - grad_k)
+    return grad_q, grad_k, None, None
+
+
+def edge_dot(q, k, edge):
+  return EdgeScore.apply(q, k, edge, 'dot')
+
+
+def edge_sq_dist(q, k, edge):
+  return EdgeScore.apply(q, k, edge, 'sq_dist')
+
+
+def unit_norm(x, eps=1e-5):
+  """
+  scale each node's head vectors to unit length along dim 1, as torch.nn.CosineSimilarity does with the same eps
+  """
+  return x / torch.clamp(torch.linalg.norm(x, dim=1, keepdim=True), min=eps)
+
+
+class PackedProjection(object):
+  """
+  one of the q, k or v projections stored in a packed linear layer, with the interface of the nn.Linear it replaced
+  """
+
+  def __init__(self, packed, idx, dim):
+    self.packed = packed
+    self.rows = slice(idx * dim, (idx + 1) * dim)
+
+  @property
+  def weight(self):
+    return self.packed.weight[self.rows]
+
+  @property
+  def bias(self):
+    return self.packed.bias[self.rows]
+
+  def __call__(self, x):
+    return nn.functional.linear(x, self.weight, self.bias)
+
+
 class SpGraphTransAttentionLayer(nn.Module):
   """
   Sparse version GAT layer, similar to https://arxiv.org/abs/1710.10903
@@ -71,6 +239,7 @@ class SpGraphTransAttentionLayer(nn.Module):
     self.opt = opt
     self.h = int(opt['heads'])
     self.edge_weights = edge_weights
+    self.edge_csr = None  # CSR pointers of the last edge index seen, for the attention normalisation
 
     try:
       self.attention_dim = opt['attention_dim']
@@ -81,44 +250,59 @@ class SpGraphTransAttentionLayer(nn.Module):
       self.h, self.attention_dim)
     self.d_k = self.attention_dim // self.h
 
+    # the q, k and v projections are packed into one linear layer so each evaluation runs a single GEMM. Its output
+    # views as [n_nodes, 3, heads, d_k], so splitting out q, k and v and the heads is free
     if self.opt['beltrami'] and self.opt['attention_type'] == "exp_kernel":
       self.output_var_x = nn.Parameter(torch.ones(1))
       self.lengthscale_x = nn.Parameter(torch.ones(1))
       self.output_var_p = nn.Parameter(torch.ones(1))
       self.lengthscale_p = nn.Parameter(torch.ones(1))
-      self.Qx = nn.Linear(opt['hidden_dim']-opt['pos_enc_hidden_dim'], self.attention_dim)
-      self.init_weights(self.Qx)
-      self.Vx = nn.Linear(opt['hidden_dim']-opt['pos_enc_hidden_dim'], self.attention_dim)
-      self.init_weights(self.Vx)
-      self.Kx = nn.Linear(opt['hidden_dim']-opt['pos_enc_hidden_dim'], self.attention_dim)
-      self.init_weights(self.Kx)
-
-      self.Qp = nn.Linear(opt['pos_enc_hidden_dim'], self.attention_dim)
-      self.init_weights(self.Qp)
-      self.Vp = nn.Linear(opt['pos_enc_hidden_dim'], self.attention_dim)
-      self.init_weights(self.Vp)
-      self.Kp = nn.Linear(opt['pos_enc_hidden_dim'], self.attention_dim)
-      self.init_weights(self.Kp)
+      # features and positional encodings are projected separately, one packed layer each
+      self.QKVx = nn.Linear(opt['hidden_dim']-opt['pos_enc_hidden_dim'], 3 * self.attention_dim)
+      self.init_weights(self.QKVx)
+      self.QKVp = nn.Linear(opt['pos_enc_hidden_dim'], 3 * self.attention_dim)
+      self.init_weights(self.QKVp)
+      self.packed_projections = {'QKVx': ('Qx', 'Kx', 'Vx'), 'QKVp': ('Qp', 'Kp', 'Vp')}
 
     else:
       if self.opt['attention_type'] == "exp_kernel":
         self.output_var = nn.Parameter(torch.ones(1))
         self.lengthscale = nn.Parameter(torch.ones(1))
 
-      self.Q = nn.Linear(in_features, self.attention_dim)
-      self.init_weights(self.Q)
-
-      self.V = nn.Linear(in_features, self.attention_dim)
-      self.init_weights(self.V)
+      self.QKV = nn.Linear(in_features, 3 * self.attention_dim)
+      self.init_weights(self.QKV)
+      self.packed_projections = {'QKV': ('Q', 'K', 'V')}
 
-      self.K = nn.Linear(in_features, self.attention_dim)
-      self.init_weights(self.K)
+    self._register_load_state_dict_pre_hook(self.pack_legacy_projections)
 
     self.activation = nn.Sigmoid()  # nn.LeakyReLU(self.alpha)
 
     self.Wout = nn.Linear(self.d_k, in_features)
     self.init_weights(self.Wout)
 
+  def pack_legacy_projections(self, state_dict, prefix, *args):
+    # checkpoints from before the projections were packed store a separate Q, K and V (or Qx, ..., Vp) linear layer
+    for packed, names in self.packed_projections.items():
+      for param in ['weight', 'bias']:
+        keys = [prefix + name + '.' + param for name in names]
+        if all(key in state_dict for key in keys):
+          state_dict[prefix + packed + '.' + param] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+  def __getattr__(self, name):
+    # Q, K, V etc. read as slices of the packed layers
+    if 'packed_projections' in self.__dict__:
+      for packed, names in self.packed_projections.items():
+        if name in names:
+          return PackedProjection(getattr(self, packed), names.index(name), self.attention_dim)
+    return super(SpGraphTransAttentionLayer, self).__getattr__(name)
+
+  def project(self, x, packed):
+    """
+    :return: q, k and v with dimensions [n_nodes, attention_dim, n_heads], as views of one packed projection
+    """
+    qkv = getattr(self, packed)(x).view(-1, 3, self.h, self.d_k).transpose(2, 3)
+    return qkv[:, 0], qkv[:, 1], qkv[:, 2]
+
   def init_weights(self, m):
     if type(m) == nn.Linear:
       # nn.init.xavier_uniform_(m.weight, gain=1.414)
@@ -135,82 +319,39 @@ class SpGraphTransAttentionLayer(nn.Module):
       p = x[:, self.opt['feat_hidden_dim']: label_index]
       x = torch.cat((x[:, :self.opt['feat_hidden_dim']], x[:, label_index:]), dim=1)
 
-      qx = self.Qx(x)
-      kx = self.Kx(x)
-      vx = self.Vx(x)
-      # perform linear operation and split into h heads
-      kx = kx.view(-1, self.h, self.d_k)
-      qx = qx.view(-1, self.h, self.d_k)
-      vx = vx.view(-1, self.h, self.d_k)
-      # transpose to get dimensions [n_nodes, attention_dim, n_heads]
-      kx = kx.transpose(1, 2)
-      qx = qx.transpose(1, 2)
-      vx = vx.transpose(1, 2)
-      src_x = qx[edge[0, :], :, :]
-      dst_x = kx[edge[1, :], :, :]
-
-      qp = self.Qp(p)
-      kp = self.Kp(p)
-      vp = self.Vp(p)
-      # perform linear operation and split into h heads
-      kp = kp.view(-1, self.h, self.d_k)
-      qp = qp.view(-1, self.h, self.d_k)
-      vp = vp.view(-1, self.h, self.d_k)
-      # transpose to get dimensions [n_nodes, attention_dim, n_heads]
-      kp = kp.transpose(1, 2)
-      qp = qp.transpose(1, 2)
-      vp = vp.transpose(1, 2)
-      src_p = qp[edge[0, :], :, :]
-      dst_p = kp[edge[1, :], :, :]
+      qx, kx, vx = self.project(x, 'QKVx')
+      qp, kp, vp = self.project(p, 'QKVp')
 
       prods = self.output_var_x ** 2 * torch.exp(
-        -torch.sum((src_x - dst_x) ** 2, dim=1) / (2 * self.lengthscale_x ** 2)) \
+        -edge_sq_dist(qx, kx, edge) / (2 * self.lengthscale_x ** 2)) \
               * self.output_var_p ** 2 * torch.exp(
-        -torch.sum((src_p - dst_p) ** 2, dim=1) / (2 * self.lengthscale_p ** 2))
+        -edge_sq_dist(qp, kp, edge) / (2 * self.lengthscale_p ** 2))
 
       v = None
 
     else:
-      q = self.Q(x)
-      k = self.K(x)
-      v = self.V(x)
-
-      # perform linear operation and split into h heads
-
-      k = k.view(-1, self.h, self.d_k)
-      q = q.view(-1, self.h, self.d_k)
-      v = v.view(-1, self.h, self.d_k)
-
-      # transpose to get dimensions [n_nodes, attention_dim, n_heads]
-
-      k = k.transpose(1, 2)
-      q = q.transpose(1, 2)
-      v = v.transpose(1, 2)
-
-      src = q[edge[0, :], :, :]
-      dst_k = k[edge[1, :], :, :]
+      q, k, v = self.project(x, 'QKV')
 
+    # the scores are sampled straight from the node level q and k, the normalisations of cosine_sim and pearson
+    # are applied per node before sampling rather than per edge
     if not self.opt['beltrami'] and self.opt['attention_type'] == "exp_kernel":
-      prods = self.output_var ** 2 * torch.exp(-(torch.sum((src - dst_k) ** 2, dim=1) / (2 * self.lengthscale ** 2)))
+      prods = self.output_var ** 2 * torch.exp(-(edge_sq_dist(q, k, edge) / (2 * self.lengthscale ** 2)))
     elif self.opt['attention_type'] == "scaled_dot":
-      prods = torch.sum(src * dst_k, dim=1) / np.sqrt(self.d_k)
+      prods = edge_dot(q, k, edge) / np.sqrt(self.d_k)
     elif self.opt['attention_type'] == "cosine_sim":
-      cos = torch.nn.CosineSimilarity(dim=1, eps=1e-5)
-      prods = cos(src, dst_k)
+      prods = edge_dot(unit_norm(q), unit_norm(k), edge)
     elif self.opt['attention_type'] == "pearson":
-      src_mu = torch.mean(src, dim=1, keepdim=True)
-      dst_mu = torch.mean(dst_k, dim=1, keepdim=True)
-      src = src - src_mu
-      dst_k = dst_k - dst_mu
-      cos = torch.nn.CosineSimilarity(dim=1, eps=1e-5)
-      prods = cos(src, dst_k)
+      q = q - torch.mean(q, dim=1, keepdim=True)
+      k = k - torch.mean(k, dim=1, keepdim=True)
+      prods = edge_dot(unit_norm(q), unit_norm(k), edge)
 
     if self.opt['reweight_attention'] and self.edge_weights is not None:
       prods = prods * self.edge_weights.unsqueeze(dim=1)
+    self.edge_csr = get_edge_csr(self.edge_csr, edge, x.shape[0])
     if self.opt['square_plus']:
-      attention = squareplus(prods, edge[self.opt['attention_norm_idx']])
+      attention = self.edge_csr.normalise(squareplus, prods, self.opt['attention_norm_idx'])
     else:
-      attention = softmax(prods, edge[self.opt['attention_norm_idx']])
+      attention = self.edge_csr.normalise(softmax, prods, self.opt['attention_norm_idx'])
     return attention, (v, prods)
 
   def __repr__(self):
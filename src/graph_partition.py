@@ -0,0 +1,129 @@
+"""
+Cluster-GCN style mini-batch training. The nodes are partitioned into clusters of nearby nodes, and each batch is the
+subgraph induced by a few clusters, whose ODE is integrated on its own. The memory of the solves, i.e. the states and
+the attention of the functions, scales with the size of the batches instead of the size of the graph.
+"""
+
+import math
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+import torch
+import torch.nn.functional as F
+from torch_geometric.data import Data
+from torch_geometric.utils import subgraph, to_undirected
+
+MASKS = ['train_mask', 'val_mask', 'test_mask']
+
+
+def partition_graph(edge_index, num_nodes, num_parts):
+  """
+  Assigns the nodes to num_parts clusters with METIS if torch_sparse is compiled with it. Otherwise the nodes are
+  ordered with reverse Cuthill-McKee, which keeps neighbours close to each other, and cut into equal chunks.
+  :return: the cluster of each node
+  """
+  edge_index = to_undirected(edge_index.cpu(), num_nodes=num_nodes)
+  row, col = edge_index
+  row, col = row[row != col], col[row != col]
+  rowptr = torch.ops.torch_sparse.ind2ptr(row, num_nodes)
+  try:
+    return torch.ops.torch_sparse.partition(rowptr, col, None, num_parts, False)
+  except RuntimeError:
+    # not compiled with METIS support
+    pass
+  adj = sp.csr_matrix((np.ones(len(col)), col.numpy(), rowptr.numpy()), shape=(num_nodes, num_nodes))
+  order = torch.from_numpy(reverse_cuthill_mckee(adj, symmetric_mode=True).astype(np.int64))
+  part = torch.empty(num_nodes, dtype=torch.long)
+  part[order] = torch.arange(num_nodes) * num_parts // num_nodes
+  return part
+
+
+class ClusterLoader(object):
+  """Iterates over the batches of an epoch, which are the subgraphs of clusters_per_batch random clusters out of
+  num_parts. The edges between the clusters of different batches are dropped. Each batch has the features, labels and
+  masks of its nodes, its edges numbered by position in the batch, and the ids of its nodes in data as n_id."""
+
+  def __init__(self, data, num_parts, clusters_per_batch=1, shuffle=True):
+    self.data = data
+    self.clusters_per_batch = clusters_per_batch
+    self.shuffle = shuffle
+    part = partition_graph(data.edge_index, data.num_nodes, num_parts)
+    perm = torch.argsort(part).to(data.x.device)
+    counts = torch.bincount(part, minlength=num_parts).tolist()
+    self.clusters = [cluster for cluster in torch.split(perm, counts) if len(cluster) > 0]
+    self.masks = {}
+    for name in MASKS:
+      mask = getattr(data, name)
+      if mask.dtype != torch.bool:
+        # the ogb splits are indices
+        mask = torch.zeros(data.num_nodes, dtype=torch.bool, device=mask.device).index_fill_(0, mask, True)
+      self.masks[name] = mask
+
+  def __len__(self):
+    return math.ceil(len(self.clusters) / self.clusters_per_batch)
+
+  def __iter__(self):
+    order = torch.randperm(len(self.clusters)) if self.shuffle else torch.arange(len(self.clusters))
+    for start in range(0, len(order), self.clusters_per_batch):
+      nodes = torch.cat([self.clusters[k] for k in order[start:start + self.clusters_per_batch].tolist()])
+      yield self.subgraph(nodes)
+
+  def subgraph(self, nodes):
+    data = self.data
+    edge_index, edge_attr = subgraph(nodes, data.edge_index, data.edge_attr, relabel_nodes=True,
+                                     num_nodes=data.num_nodes)
+    batch = Data(x=data.x[nodes], y=data.y[nodes], edge_index=edge_index, edge_attr=edge_attr, n_id=nodes)
+    for name, mask in self.masks.items():
+      batch[name] = mask[nodes]
+    return batch
+
+
+def train_partitioned(model, optimizer, loader, pos_encoding=None):
+  """A training epoch of a GNN or GNNEarly with an optimizer step on each batch of the loader that has training nodes.
+  The blocks are left with the graph of the last batch, set_graph(data) sets the whole graph again.
+  :return: the mean loss over the training nodes
+  """
+  model.train()
+  total_loss = num_train = 0
+  for batch in loader:
+    batch_train = int(batch.train_mask.sum())
+    if batch_train == 0:
+      continue
+    model.odeblock.set_graph(batch)
+    optimizer.zero_grad()
+    out = model(batch.x, None if pos_encoding is None else pos_encoding[batch.n_id])
+    loss = F.cross_entropy(out[batch.train_mask], batch.y.view(-1)[batch.train_mask])
+    if model.odeblock.nreg > 0:
+      reg_states = tuple(torch.mean(rs) for rs in model.reg_states)
+      loss = loss + sum(reg_state * coeff for reg_state, coeff in zip(reg_states, model.regularization_coeffs)
+                        if coeff != 0)
+
+    model.cm.update(model.getNFE(split=True)[1])
+    model.fm.update(model.getNFE())
+    model.resetNFE()
+    loss.backward()
+    optimizer.step()
+    model.bm.update(model.getNFE())
+    model.resetNFE()
+    total_loss += loss.item() * batch_train
+    num_train += batch_train
+  return total_loss / num_train
+
+
+@torch.no_grad()
+def test_partitioned(model, loader, pos_encoding=None, opt=None):  # opt required for runtime polymorphism
+  """Predicts the nodes of each batch of the loader from its subgraph. The early stopping integrator of a GNNEarly
+  tracks its best time on each batch separately.
+  :return: the train, val and test accuracies
+  """
+  model.eval()
+  data = loader.data
+  pred = torch.empty(data.num_nodes, dtype=torch.long, device=data.x.device)
+  for batch in loader:
+    model.odeblock.set_graph(batch)
+    if hasattr(model, 'set_solver_data'):
+      model.set_solver_data(batch)
+    out = model(batch.x, None if pos_encoding is None else pos_encoding[batch.n_id])
+    pred[batch.n_id] = out.argmax(dim=-1)
+  correct = pred.eq(data.y.view(-1))
+  return [(correct[mask].sum() / mask.sum()).item() for mask in loader.masks.values()]
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import os
 from functools import partial
 
@@ -37,17 +38,56 @@ def average_test(models, datas):
     return train_accs, val_accs, tmp_test_accs
 
 
+def train_ray_ensemble(opt, dataset, datas, checkpoint_dir=None):
+    """Trains one GNN for each of datas, which share their graph, as a GNNEnsemble that solves all of them at once"""
+    # the ensembles vmap with torch.func, which needs torch 2, unlike the rest of the models
+    from GNN_ensemble import GNNEnsemble, train_ensemble, test_ensemble
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    ensemble = GNNEnsemble([GNN(opt, dataset, device) for data in datas])
+    parameters = [p for p in ensemble.parameters() if p.requires_grad]
+    optimizer = get_optimizer(opt["optimizer"], parameters, lr=opt["lr"], weight_decay=opt["decay"])
+
+    # the checkpoints hold the best member, which is loaded into every member as with the separate models
+    if checkpoint_dir:
+        checkpoint = os.path.join(checkpoint_dir, "checkpoint")
+        model_state, optimizer_state = torch.load(checkpoint)
+        ensemble.load_member_state_dict(model_state)
+        optimizer.load_state_dict(optimizer_state)
+
+    for epoch in range(1, opt["epoch"]):
+        loss = train_ensemble(ensemble, optimizer, datas)
+        train_accs, val_accs, tmp_test_accs = test_ensemble(ensemble, datas)
+        with tune.checkpoint_dir(step=epoch) as checkpoint_dir:
+            best = np.argmax(val_accs)
+            path = os.path.join(checkpoint_dir, "checkpoint")
+            torch.save((ensemble.member_state_dict(best), optimizer.state_dict()), path)
+        tune.report(loss=loss, accuracy=np.mean(val_accs), test_acc=np.mean(tmp_test_accs),
+                    train_acc=np.mean(train_accs),
+                    forward_nfe=ensemble.fm.sum,
+                    backward_nfe=ensemble.bm.sum)
+
+
 def train_ray_rand(opt, checkpoint_dir=None, data_dir="../data"):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     dataset = get_dataset(opt, data_dir, opt['not_lcc'])
 
+    if 'ensemble' in opt and opt['ensemble'] and not opt['baseline']:
+        datas = []
+        for split in range(opt["num_splits"]):
+            # the splits are set on the data they're given, so each one gets a shallow copy
+            datas.append(set_train_val_test_split(
+                np.random.randint(0, 1000), copy.copy(dataset.data),
+                num_development=5000 if opt["dataset"] == "CoauthorCS" else 1500).to(device))
+        return train_ray_ensemble(opt, dataset, datas, checkpoint_dir)
+
     models = []
     datas = []
     optimizers = []
 
     for split in range(opt["num_splits"]):
         dataset.data = set_train_val_test_split(
-            np.random.randint(0, 1000), dataset.data, num_development=5000 if opt["dataset"] == "CoauthorCS" else 1500)
+            np.random.randint(0, 1000), copy.copy(dataset.data),
+            num_development=5000 if opt["dataset"] == "CoauthorCS" else 1500)
         datas.append(dataset.data)
 
         if opt['baseline']:
@@ -103,6 +143,9 @@ def train_ray(opt, checkpoint_dir=None, data_dir="../data"):
     data = dataset.data.to(device)
     datas = [data for i in range(opt["num_init"])]
 
+    if 'ensemble' in opt and opt['ensemble'] and not opt['baseline']:
+        return train_ray_ensemble(opt, dataset, datas, checkpoint_dir)
+
     for split in range(opt["num_init"]):
         if opt['baseline']:
             opt['num_feature'] = dataset.num_node_features
@@ -673,6 +716,9 @@ if __name__ == "__main__":
     parser.add_argument("--name", type=str, default="ray_exp")
     parser.add_argument("--num_splits", type=int, default=0, help="Number of random splits >= 0. 0 for planetoid split")
     parser.add_argument("--num_init", type=int, default=1, help="Number of random initializations >= 0")
+    parser.add_argument("--ensemble", action="store_true",
+                        help="train the models of the splits or initializations of a trial as one vectorised ensemble, "
+                             "needs torch>=2.0")
 
     parser.add_argument("--max_nfe", type=int, default=300, help="Maximum number of function evaluations allowed in an epoch.")
     parser.add_argument('--metric', type=str, default='accuracy',
@@ -14,6 +14,14 @@ class RegularizedODEfunc(nn.Module):
   def before_odeint(self, *args, **kwargs):
     self.odefunc.before_odeint(*args, **kwargs)
 
+  def callback_accept_step(self, t0, y0, dt):
+    if hasattr(self.odefunc, 'callback_accept_step'):
+      self.odefunc.callback_accept_step(t0, y0[0], dt)
+
+  def callback_accept_step_adjoint(self, t0, y0, dt):
+    if hasattr(self.odefunc, 'callback_accept_step_adjoint'):
+      self.odefunc.callback_accept_step_adjoint(t0, y0, dt)
+
   def forward(self, t, state):
 
     with torch.enable_grad():
@@ -17,6 +17,7 @@ from graph_rewiring import apply_KNN, apply_beltrami, apply_edge_sampling
 from best_params import best_params_dict
 from heterophilic import get_fixed_splits
 from utils import ROOT_DIR
+from graph_partition import ClusterLoader, train_partitioned, test_partitioned
 from CGNN import CGNN, get_sym_adj
 from CGNN import train as train_cgnn
 
@@ -87,6 +88,7 @@ def train(model, optimizer, data, pos_encoding=None):
     )
     loss = loss + reg_loss
 
+  model.cm.update(model.getNFE(split=True)[1])
   model.fm.update(model.getNFE())
   model.resetNFE()
   loss.backward()
@@ -125,6 +127,7 @@ def train_OGB(model, mp, optimizer, data, pos_encoding=None):
     )
     loss = loss + reg_loss
 
+  model.cm.update(model.getNFE(split=True)[1])
   model.fm.update(model.getNFE())
   model.resetNFE()
   loss.backward()
@@ -246,6 +249,12 @@ def main(cmd_opt):
 
   this_test = test_OGB if opt['dataset'] == 'ogbn-arxiv' else test
 
+  partitioned = opt['num_parts'] > 1
+  if partitioned:
+    if opt['use_labels'] or opt['rewire_KNN'] or opt['fa_layer']:
+      raise NotImplementedError('mini-batch training is not implemented with labels or KNN rewiring')
+    loader = ClusterLoader(data, opt['num_parts'], opt['clusters_per_batch'])
+
   for epoch in range(1, opt['epoch']):
     start_time = time.time()
 
@@ -253,8 +262,12 @@ def main(cmd_opt):
       ei = apply_KNN(data, pos_encoding, model, opt)
       model.odeblock.odefunc.edge_index = ei
 
-    loss = train(model, optimizer, data, pos_encoding)
-    tmp_train_acc, tmp_val_acc, tmp_test_acc = this_test(model, data, pos_encoding, opt)
+    if partitioned:
+      loss = train_partitioned(model, optimizer, loader, pos_encoding)
+      tmp_train_acc, tmp_val_acc, tmp_test_acc = test_partitioned(model, loader, pos_encoding, opt)
+    else:
+      loss = train(model, optimizer, data, pos_encoding)
+      tmp_train_acc, tmp_val_acc, tmp_test_acc = this_test(model, data, pos_encoding, opt)
 
     best_time = opt['time']
     if tmp_val_acc > val_acc:
@@ -263,16 +276,18 @@ def main(cmd_opt):
       val_acc = tmp_val_acc
       test_acc = tmp_test_acc
       best_time = opt['time']
-    if not opt['no_early'] and model.odeblock.test_integrator.solver.best_val > val_acc:
+    # the early stopping accuracies of a batch aren't those of the whole graph
+    if not opt['no_early'] and not partitioned and model.odeblock.test_integrator.solver.best_val > val_acc:
       best_epoch = epoch
       val_acc = model.odeblock.test_integrator.solver.best_val
       test_acc = model.odeblock.test_integrator.solver.best_test
       train_acc = model.odeblock.test_integrator.solver.best_train
       best_time = model.odeblock.test_integrator.solver.best_time
 
-    log = 'Epoch: {:03d}, Runtime {:03f}, Loss {:03f}, forward nfe {:d}, backward nfe {:d}, Train: {:.4f}, Val: {:.4f}, Test: {:.4f}, Best time: {:.4f}'
+    n_rejected, n_warm_starts = model.odeblock.get_step_stats(reset=True)
+    log = 'Epoch: {:03d}, Runtime {:03f}, Loss {:03f}, forward nfe {:d} ({:d} cached), backward nfe {:d}, rejected steps {:d}, warm started solves {:d}, Train: {:.4f}, Val: {:.4f}, Test: {:.4f}, Best time: {:.4f}'
 
-    print(log.format(epoch, time.time() - start_time, loss, model.fm.sum, model.bm.sum, train_acc, val_acc, test_acc, best_time))
+    print(log.format(epoch, time.time() - start_time, loss, model.fm.sum, model.cm.sum, model.bm.sum, n_rejected, n_warm_starts, train_acc, val_acc, test_acc, best_time))
   print('best val accuracy {:03f} with test accuracy {:03f} at epoch {:d} and best time {:03f}'.format(val_acc, test_acc,
                                                                                                      best_epoch,
                                                                                                      best_time))
@@ -299,6 +314,9 @@ if __name__ == '__main__':
                       help='% of training labels to use when --use_labels is set.')
   parser.add_argument('--planetoid_split', action='store_true',
                       help='use planetoid splits for Cora/Citeseer/Pubmed')
+  parser.add_argument('--num_parts', type=int, default=1,
+                      help='train on mini-batches of the subgraphs of this many clusters of nodes, 1 for full batch')
+  parser.add_argument('--clusters_per_batch', type=int, default=1, help='number of clusters in each mini-batch')
   # GNN args
   parser.add_argument('--hidden_dim', type=int, default=16, help='Hidden dimension.')
   parser.add_argument('--fc_out', dest='fc_out', action='store_true',
@@ -327,14 +345,43 @@ if __name__ == '__main__':
   parser.add_argument('--time', type=float, default=1.0, help='End time of ODE integrator.')
   parser.add_argument('--augment', action='store_true',
                       help='double the length of the feature vector by appending zeros to stabilist ODE learning')
-  parser.add_argument('--method', type=str, help="set the numerical solver: dopri5, euler, rk4, midpoint")
+  parser.add_argument('--method', type=str,
+                      help="set the numerical solver: dopri5, euler, rk4, midpoint, implicit_euler, bdf2 (gear2) or bdf3 "
+                           "(gear3) for long, stiff diffusion, etdrk2 or etdrk4 (exact in the -alpha x term, for larger "
+                           "steps than rk4), imex (ars222, implicit in the fixed graph part, e.g. the Laplacian of "
+                           "--block mixed, explicit in attention), multirate (heun with smaller substeps on the nodes "
+                           "that need them), parareal (parallel in time over --parareal_slices, at inference), "
+                           "expm_multiply (exact for linear diffusion, e.g. --function laplacian --block constant or mixed) "
+                           "or chebyshev (exact for --function laplacian --block constant)")
   parser.add_argument('--step_size', type=float, default=1,
                       help='fixed step size when using fixed step solvers e.g. rk4')
   parser.add_argument('--max_iters', type=float, default=100, help='maximum number of integration steps')
+  parser.add_argument('--parareal_fine_method', type=str, default='dopri5',
+                      help='fine solver of --method parareal, --step_size is the step of its rk4 coarse solver')
+  parser.add_argument('--parareal_slices', type=int, default=None,
+                      help='number of time slices of --method parareal, defaults to --parareal_workers')
+  parser.add_argument('--parareal_workers', type=int, default=None,
+                      help='number of processes solving the slices of --method parareal, defaults to the number of cpus')
+  parser.add_argument('--buffered', action='store_true',
+                      help='fixed step solvers (euler, midpoint, rk4) update preallocated tensors in place when no '
+                           'graph is built, i.e. at inference and in the forward pass of the adjoint')
+  parser.add_argument('--step_controller', type=str, default='i', choices=['i', 'pi', 'pid'],
+                      help='step size controller of the adaptive solvers, pi and pid damp the step size oscillations '
+                           'that cause rejected steps')
+  parser.add_argument('--fused_norm', action='store_true',
+                      help='compute the error estimate of the adaptive solvers in the state dtype with one reduction')
+  parser.add_argument('--no_warm_start', action='store_true',
+                      help="don't start adaptive solvers from the first step size accepted in the previous solve")
   parser.add_argument("--adjoint_method", type=str, default="adaptive_heun",
                       help="set the numerical solver for the backward pass: dopri5, euler, rk4, midpoint")
   parser.add_argument('--adjoint', dest='adjoint', action='store_true',
                       help='use the adjoint ODE method to reduce memory footprint')
+  parser.add_argument('--grad_mode', type=str, default='backprop', choices=['backprop', 'adjoint', 'checkpoint'],
+                      help='backprop through the solver, solve the adjoint ODE backward in time (same as --adjoint) or '
+                           'checkpoint the accepted steps and recompute them in the backward pass, which gives exact '
+                           'gradients in memory proportional to the number of checkpoints (not with --adjoint)')
+  parser.add_argument('--checkpoints', type=int, default=None,
+                      help='maximum number of states stored with --grad_mode checkpoint, default every accepted step')
   parser.add_argument('--adjoint_step_size', type=float, default=1,
                       help='fixed step size when using fixed step adjoint solvers e.g. rk4')
   parser.add_argument('--tol_scale', type=float, default=1., help='multiplier for atol and rtol')
@@ -349,6 +396,9 @@ if __name__ == '__main__':
   parser.add_argument("--max_test_steps", type=int, default=100,
                       help="Maximum number steps for the dopri5Early test integrator. "
                            "used if getting OOM errors at test time")
+  parser.add_argument('--earlystop_points', type=int, default=1,
+                      help='number of evenly spaced times in each step of the early stopping solver at which the '
+                           'accuracy is evaluated, on the interpolant of the step')
 
   # Attention args
   parser.add_argument('--leaky_relu_slope', type=float, default=0.2,
@@ -365,6 +415,15 @@ if __name__ == '__main__':
   parser.add_argument('--attention_type', type=str, default="scaled_dot",
                       help="scaled_dot,cosine_sim,pearson, exp_kernel")
   parser.add_argument('--square_plus', action='store_true', help='replace softmax with square plus')
+  parser.add_argument('--attention_refresh', type=str, default='always',
+                      help="when the transformer ODE function recomputes attention: always, nfe (every "
+                           "attention_refresh_k evaluations), step (once per accepted solver step), threshold (when "
+                           "the relative change in x exceeds attention_refresh_tol). The backward pass of --adjoint "
+                           "always recomputes it")
+  parser.add_argument('--attention_refresh_k', type=int, default=1,
+                      help='number of function evaluations between attention refreshes with --attention_refresh nfe')
+  parser.add_argument('--attention_refresh_tol', type=float, default=0.01,
+                      help='relative change in x that triggers a refresh with --attention_refresh threshold')
 
   # regularisation args
   parser.add_argument('--jacobian_norm2', type=float, default=None, help="int_t ||df/dx||_F^2")
@@ -438,5 +497,7 @@ if __name__ == '__main__':
   args = parser.parse_args()
 
   opt = vars(args)
+  if opt['grad_mode'] == 'adjoint':
+    opt['adjoint'] = True
 
   main(opt)
@@ -1,4 +1,6 @@
 from ._impl import odeint
 from ._impl import odeint_adjoint
+from ._impl import odeint_checkpoint
 from ._impl import odeint_event
+from ._impl import ODESolverPlan
 __version__ = "0.2.2"
@@ -1,2 +1,2 @@
-from .odeint import odeint, odeint_event
-from .adjoint import odeint_adjoint
+from .odeint import odeint, odeint_event, ODESolverPlan
+from .adjoint import odeint_adjoint, odeint_checkpoint
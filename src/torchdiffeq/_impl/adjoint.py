@@ -1,9 +1,12 @@
-import warnings
+import numpy as np
 import torch
 import torch.nn as nn
 from .odeint import SOLVERS, odeint
 from .misc import _check_inputs, _flat_to_shape
-from .misc import _mixed_norm
+from .misc import _all_callback_names, _all_adjoint_callback_names
+from .rk_common import RKAdaptiveStepsizeODESolver, _runge_kutta_step
+from .interp import _interp_evaluate
+from .fixed_grid import Euler, Midpoint, RK4
 
 
 class OdeintAdjointMethod(torch.autograd.Function):
@@ -61,9 +64,22 @@ class OdeintAdjointMethod(torch.autograd.Function):
             #      Set up initial state      #
             ##################################
 
+            # The adaptive Runge-Kutta solvers integrate the parameter vjps by quadrature on the interpolant of each
+            # step they accept, outside the state, so they are neither carried through every stage nor part of the
+            # error norm. The other solvers carry them in the state, computed with the vjp wrt y from the same
+            # evaluation: the fixed grid solvers have no error norm, and the default norm of the others ignores them.
+            dense_quadrature = issubclass(SOLVERS.get(adjoint_method, type(None)), RKAdaptiveStepsizeODESolver)
+            params_in_state = bool(adjoint_params) and not dense_quadrature
+
             # [-1] because y and grad_y are both of shape (len(t), *y0.shape)
             aug_state = [torch.zeros((), dtype=y.dtype, device=y.device), y[-1], grad_y[-1]]  # vjp_t, y, vjp_y
-            aug_state.extend([torch.zeros_like(param) for param in adjoint_params])  # vjp_params
+            adj_params = [torch.zeros_like(param) for param in adjoint_params]
+            if params_in_state:
+                aug_state.extend(adj_params)
+            # returned whenever a vjp is None, instead of allocating new zeros on every evaluation
+            zero_t = torch.zeros((), dtype=t.dtype, device=t.device)
+            zero_y = torch.zeros_like(y[-1])
+            zero_params = adj_params if params_in_state else []
 
             ##################################
             #    Set up backward ODE func    #
@@ -71,39 +87,94 @@ class OdeintAdjointMethod(torch.autograd.Function):
 
             # TODO: use a nn.Module and call odeint_adjoint to implement higher order derivatives.
             def augmented_dynamics(t, y_aug):
-                # Dynamics of the original system augmented with
-                # the adjoint wrt y, and an integrator wrt t and args.
+                # Dynamics of the original system augmented with the adjoint wrt y, and an integrator wrt t.
                 y = y_aug[1]
                 adj_y = y_aug[2]
-                # ignore gradients wrt time and parameters
+                params = adjoint_params if params_in_state else ()
 
                 with torch.enable_grad():
-                    t_ = t.detach()
-                    t = t_.requires_grad_(True)
                     y = y.detach().requires_grad_(True)
-
                     # If using an adaptive solver we don't want to waste time resolving dL/dt unless we need it (which
-                    # doesn't necessarily even exist if there is piecewise structure in time), so turning off gradients
-                    # wrt t here means we won't compute that if we don't need it.
-                    func_eval = func(t if t_requires_grad else t_, y)
-
-                    # Workaround for PyTorch bug #39784
-                    _t = torch.as_strided(t, (), ())  # noqa
-                    _y = torch.as_strided(y, (), ())  # noqa
-                    _params = tuple(torch.as_strided(param, (), ()) for param in adjoint_params)  # noqa
-
-                    vjp_t, vjp_y, *vjp_params = torch.autograd.grad(
-                        func_eval, (t, y) + adjoint_params, -adj_y,
-                        allow_unused=True, retain_graph=True
-                    )
+                    # doesn't necessarily even exist if there is piecewise structure in time), so gradients wrt t are
+                    # only computed if we need them.
+                    if t_requires_grad:
+                        t = t.detach().requires_grad_(True)
+                        func_eval = func(t, y)
+                        vjp_t, vjp_y, *vjp_params = torch.autograd.grad(func_eval, (t, y) + params, -adj_y,
+                                                                        allow_unused=True)
+                    else:
+                        func_eval = func(t.detach(), y)
+                        vjp_t = None
+                        vjp_y, *vjp_params = torch.autograd.grad(func_eval, (y,) + params, -adj_y, allow_unused=True)
 
                 # autograd.grad returns None if no gradient, set to zero.
-                vjp_t = torch.zeros_like(t) if vjp_t is None else vjp_t
-                vjp_y = torch.zeros_like(y) if vjp_y is None else vjp_y
-                vjp_params = [torch.zeros_like(param) if vjp_param is None else vjp_param
-                              for param, vjp_param in zip(adjoint_params, vjp_params)]
-
-                return (vjp_t, func_eval, vjp_y, *vjp_params)
+                vjp_t = zero_t if vjp_t is None else vjp_t
+                vjp_y = zero_y if vjp_y is None else vjp_y
+                vjp_params = [zero if vjp is None else vjp for zero, vjp in zip(zero_params, vjp_params)]
+
+                return (vjp_t, func_eval.detach(), vjp_y, *vjp_params)
+
+            # Add adjoint callbacks
+            for callback_name, adjoint_callback_name in zip(_all_callback_names, _all_adjoint_callback_names):
+                try:
+                    callback = getattr(func, adjoint_callback_name)
+                except AttributeError:
+                    pass
+                else:
+                    setattr(augmented_dynamics, callback_name, callback)
+
+            def solve_interval(t_hi, t_lo, state):
+                """Solves the augmented system from t_hi back to t_lo.
+                :return: the state at t_lo
+                """
+                if not dense_quadrature or not adjoint_params:
+                    solution = odeint(augmented_dynamics, tuple(state), torch.stack([t_hi, t_lo]), rtol=adjoint_rtol,
+                                      atol=adjoint_atol, method=adjoint_method, options=adjoint_options)
+                    return [s[-1] for s in solution]
+                return solve_interval_dense(t_hi, t_lo, state)
+
+            def solve_interval_dense(t_hi, t_lo, state):
+                """Steps the adaptive solver from t_hi back to t_lo like odeint, and after each accepted step adds the
+                Gauss-Legendre quadrature of adj_y(s)^T df/dparams(s, y(s)) over the part of the step up to t_lo to
+                adj_params, reading the state at the nodes from the interpolant of the step. The rule is exact for
+                polynomials of the order of the solver, and each node builds and frees its own graph.
+                :return: the state at t_lo
+                """
+                aug_shapes, aug_func, aug_y0, t_solve, rtol, atol, method, options, _, t_is_reversed = _check_inputs(
+                    augmented_dynamics, tuple(state), torch.stack([t_hi, t_lo]), adjoint_rtol, adjoint_atol,
+                    adjoint_method, adjoint_options, None, SOLVERS)
+                solver = SOLVERS[method](func=aug_func, y0=aug_y0, rtol=rtol, atol=atol, **options)
+                nodes, weights = np.polynomial.legendre.leggauss(solver.order // 2 + 1)
+                nodes = torch.tensor(nodes, dtype=solver.dtype, device=y.device)
+                weights = torch.tensor(weights, dtype=y.dtype, device=y.device)
+
+                t_end = t_solve[-1]
+                solver._before_integrate(t_solve)
+                n_steps = 0
+                while t_end > solver.rk_state.t1:
+                    assert n_steps < solver.max_num_steps, 'max_num_steps exceeded ({}>={})'.format(
+                        n_steps, solver.max_num_steps)
+                    t_start = solver.rk_state.t1
+                    solver.rk_state = solver._adaptive_step(solver.rk_state)
+                    n_steps += 1
+                    t0, t1, interp_coeff = solver.rk_state.t0, solver.rk_state.t1, solver.rk_state.interp_coeff
+                    if t1 == t_start:
+                        continue  # rejected
+                    t_stop = torch.min(t1, t_end)
+                    t_nodes = (t_start + t_stop) / 2 + (t_stop - t_start) / 2 * nodes
+                    node_weights = (t_stop - t_start).to(y.dtype) / 2 * weights
+                    for t_node, weight in zip(t_nodes, node_weights):
+                        _, y_node, adj_y_node = _flat_to_shape(_interp_evaluate(interp_coeff, t0, t1, t_node), (),
+                                                               aug_shapes)
+                        t_node = -t_node if t_is_reversed else t_node
+                        with torch.enable_grad():
+                            func_eval = func(t_node.to(t.dtype), y_node)
+                            vjp_params = torch.autograd.grad(func_eval, adjoint_params, adj_y_node, allow_unused=True)
+                        for adj_param, vjp_param in zip(adj_params, vjp_params):
+                            if vjp_param is not None:
+                                adj_param.add_(vjp_param, alpha=weight)
+                state = _interp_evaluate(solver.rk_state.interp_coeff, solver.rk_state.t0, solver.rk_state.t1, t_end)
+                return list(_flat_to_shape(state, (), aug_shapes))
 
             ##################################
             #       Solve adjoint ODE        #
@@ -122,13 +193,8 @@ class OdeintAdjointMethod(torch.autograd.Function):
                     aug_state[0] -= dLd_cur_t
                     time_vjps[i] = dLd_cur_t
 
-                # Run the augmented system backwards in time.
-                aug_state = odeint(
-                    augmented_dynamics, tuple(aug_state),
-                    t[i - 1:i + 1].flip(0),
-                    rtol=adjoint_rtol, atol=adjoint_atol, method=adjoint_method, options=adjoint_options
-                )
-                aug_state = [a[1] for a in aug_state]  # extract just the t[i - 1] value
+                # Run the augmented system backwards in time
+                aug_state = solve_interval(t[i], t[i - 1], aug_state)
                 aug_state[1] = y[i - 1]  # update to use our forward-pass estimate of the state
                 aug_state[2] += grad_y[i - 1]  # update any gradients wrt state at this time point
 
@@ -140,7 +206,8 @@ class OdeintAdjointMethod(torch.autograd.Function):
                 time_vjps = torch.cat([time_vjps[0].reshape(-1), torch.zeros_like(_t[1:])])
 
             adj_y = aug_state[2]
-            adj_params = aug_state[3:]
+            if params_in_state:
+                adj_params = aug_state[3:]
 
         return (None, None, adj_y, time_vjps, None, None, None, None, None, None, None, None, None, None, *adj_params)
 
@@ -179,14 +246,7 @@ def odeint_adjoint(func, y0, t, *, rtol=1e-7, atol=1e-9, method=None, options=No
         adjoint_params = tuple(adjoint_params)  # in case adjoint_params is a generator.
 
     # Filter params that don't require gradients.
-    oldlen_ = len(adjoint_params)
     adjoint_params = tuple(p for p in adjoint_params if p.requires_grad)
-    if len(adjoint_params) != oldlen_:
-        # Some params were excluded.
-        # Issue a warning if a user-specified norm is specified.
-        if 'norm' in adjoint_options and callable(adjoint_options['norm']):
-            warnings.warn("An adjoint parameter was passed without requiring gradient. For efficiency this will be "
-                          "excluded from the adjoint pass, and will not appear as a tensor in the adjoint norm.")
 
     # Convert to flattened state.
     shapes, func, y0, t, rtol, atol, method, options, event_fn, decreasing_time = _check_inputs(func, y0, t, rtol, atol, method, options, event_fn, SOLVERS)
@@ -196,7 +256,8 @@ def odeint_adjoint(func, y0, t, *, rtol=1e-7, atol=1e-9, method=None, options=No
     handle_adjoint_norm_(adjoint_options, shapes, state_norm)
 
     ans = OdeintAdjointMethod.apply(shapes, func, y0, t, rtol, atol, method, options, event_fn, adjoint_rtol, adjoint_atol,
-                                    adjoint_method, adjoint_options, t.requires_grad, *adjoint_params)
+                                    adjoint_method, adjoint_options, t.requires_grad,
+                                    *adjoint_params)
 
     if event_fn is None:
         solution = ans
@@ -215,6 +276,155 @@ def odeint_adjoint(func, y0, t, *, rtol=1e-7, atol=1e-9, method=None, options=No
         return event_t, solution
 
 
+class _CheckpointRecord(object):
+    """The accepted steps of a solve, and the states at the start of every step, or of at most `budget` of them. Once
+    the budget is exceeded every other checkpoint is dropped and the spacing doubles, as the number of steps is only
+    known at the end of the solve."""
+
+    def __init__(self, budget=None):
+        assert budget is None or budget >= 1, 'the checkpoint budget must be at least 1, got {}'.format(budget)
+        self.budget = budget
+        self.steps = []
+        self.states = {}  # step index -> state at the start of that step
+        self.stride = 1
+
+    def add(self, t0, y0, dt):
+        index = len(self.steps)
+        self.steps.append((t0, dt))
+        if index % self.stride == 0:
+            self.states[index] = y0
+            if self.budget is not None and len(self.states) > self.budget:
+                self.stride *= 2
+                self.states = {i: y for i, y in self.states.items() if i % self.stride == 0}
+
+
+# solvers whose steps only depend on the state at the start of the step, so any step can be replayed from a checkpoint
+_REPLAYABLE_FIXED_GRID_SOLVERS = (Euler, Midpoint, RK4)
+
+
+def _replay_step(solver, t0, dt, y0, f0):
+    """Repeats an accepted step of `solver`, returning the new state, the derivative there if the solver reuses it and
+    the interpolant the solver reads output times from."""
+    t1 = t0 + dt
+    if isinstance(solver, RKAdaptiveStepsizeODESolver):
+        if f0 is None:
+            f0 = solver.func(t0, y0)
+        y1, f1, _, k = _runge_kutta_step(solver.func, y0, f0, t0, dt, t1, tableau=solver.tableau)
+        interp_coeff = solver._interp_fit(y0, y1, k, dt)
+        return y1, f1, lambda t: _interp_evaluate(interp_coeff, t0, t1, t)
+    dy, _ = solver._step_func(solver.func, t0, dt, t1, y0)
+    y1 = y0 + dy
+    return y1, None, lambda t: solver._linear_interp(t0, t1, y0, y1, t)
+
+
+class OdeintCheckpointMethod(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, shapes, func, y0, t, rtol, atol, method, options, checkpoints, *adjoint_params):
+        solver = SOLVERS[method](func=func, y0=y0, rtol=rtol, atol=atol, **options)
+        assert isinstance(solver, RKAdaptiveStepsizeODESolver) or (
+            isinstance(solver, _REPLAYABLE_FIXED_GRID_SOLVERS) and solver.interp == 'linear'), \
+            'checkpointed gradients need an explicit Runge-Kutta method, got {}'.format(method)
+        # the checkpoints keep the states the solver passes to callback_accept_step, which buffered solvers overwrite
+        solver.buffered = False
+
+        record = _CheckpointRecord(checkpoints)
+        callback_accept_step = func.callback_accept_step
+
+        def record_accept_step(t0, y0, dt):
+            record.add(t0, y0, dt)
+            callback_accept_step(t0, y0, dt)
+
+        func.callback_accept_step = record_accept_step
+        try:
+            with torch.no_grad():
+                solution = solver.integrate(t)
+        finally:
+            func.callback_accept_step = callback_accept_step
+
+        ctx.solver = solver
+        ctx.record = record
+        ctx.adjoint_params = adjoint_params
+        ctx.save_for_backward(t.to(solver.dtype))
+        return solution
+
+    @staticmethod
+    def backward(ctx, grad_y):
+        solver, record, adjoint_params = ctx.solver, ctx.record, ctx.adjoint_params
+        t, = ctx.saved_tensors
+        steps = record.steps
+
+        # each output time is read from the first step that ends at or after it, as in the forward solve
+        step_ends = torch.stack([t0 + dt for t0, dt in steps]) if steps else t[:0]
+        output_steps = {}
+        for i in range(1, len(t)):
+            output_steps.setdefault(int(torch.searchsorted(step_ends, t[i])), []).append(i)
+        n_steps = max(output_steps) + 1 if output_steps else 0
+
+        adj_y = torch.zeros_like(grad_y[0])
+        adj_params = [torch.zeros_like(param) for param in adjoint_params]
+        starts = sorted(i for i in record.states if i < n_steps)
+        for first, last in reversed(list(zip(starts, starts[1:] + [n_steps]))):
+            # recompute the local graph of this segment from its checkpoint and backpropagate through it
+            with torch.enable_grad():
+                y0 = record.states[first].detach().requires_grad_(True)
+                outputs, grad_outputs = [], []
+                y, f = y0, None
+                for j in range(first, last):
+                    t0, dt = steps[j]
+                    y, f, interp = _replay_step(solver, t0, dt, y, f)
+                    for i in output_steps.get(j, []):
+                        outputs.append(interp(t[i]))
+                        grad_outputs.append(grad_y[i])
+                if last < n_steps:
+                    outputs.append(y)
+                    grad_outputs.append(adj_y)
+                vjp_y, *vjp_params = torch.autograd.grad(outputs, (y0,) + tuple(adjoint_params), grad_outputs,
+                                                         allow_unused=True)
+            adj_y = torch.zeros_like(y0) if vjp_y is None else vjp_y
+            for adj_param, vjp_param in zip(adj_params, vjp_params):
+                if vjp_param is not None:
+                    adj_param += vjp_param
+        adj_y = adj_y + grad_y[0]
+
+        return (None, None, adj_y, None, None, None, None, None, None, *adj_params)
+
+
+def odeint_checkpoint(func, y0, t, *, rtol=1e-7, atol=1e-9, method=None, options=None, checkpoints=None,
+                      adjoint_params=None):
+    """Like odeint, but with gradients computed by checkpointing instead of keeping the autograd graph of every stage.
+
+    The forward solve runs without a graph and keeps the state at the start of each accepted step, or of at most
+    `checkpoints` evenly spaced steps. The backward pass replays the steps of each segment between checkpoints from its
+    state, with a graph, and backpropagates through them. The gradients are the exact gradients of the forward
+    solution for the step sizes it took, without the error of the backward solve of odeint_adjoint (odeint also
+    differentiates through the choice of step sizes), at a memory cost of O(checkpoints * state size) plus the graph
+    of one segment. Only explicit Runge-Kutta methods (the adaptive ones, euler, midpoint and rk4) are supported, and
+    no gradients are computed with respect to t.
+
+    By default the gradients flow to the parameters of func and to the tensors that require grad held as attributes by
+    its modules, e.g. attention weights computed before the solve, and through them to whatever they were computed
+    from. Tensors that func closes over otherwise must be passed in `adjoint_params`, as the forward solve builds no
+    graph to them.
+    """
+    if adjoint_params is None and not isinstance(func, nn.Module):
+        raise ValueError('func must be an instance of nn.Module to specify the adjoint parameters; alternatively they '
+                         'can be specified explicitly via the `adjoint_params` argument. If there are no parameters '
+                         'then it is allowable to set `adjoint_params=()`.')
+    if adjoint_params is None:
+        adjoint_params = tuple(find_parameters(func)) + tuple(find_tensor_attributes(func))
+    # each tensor is passed once, or its gradient would be counted for every time it is passed
+    adjoint_params = tuple({id(p): p for p in adjoint_params if p.requires_grad}.values())
+
+    shapes, func, y0, t, rtol, atol, method, options, _, _ = _check_inputs(func, y0, t, rtol, atol, method, options,
+                                                                           None, SOLVERS)
+    solution = OdeintCheckpointMethod.apply(shapes, func, y0, t, rtol, atol, method, options, checkpoints,
+                                            *adjoint_params)
+    if shapes is not None:
+        solution = _flat_to_shape(solution, (len(t),), shapes)
+    return solution
+
+
 def find_parameters(module):
 
     assert isinstance(module, nn.Module)
@@ -232,14 +442,23 @@ def find_parameters(module):
         return list(module.parameters())
 
 
+def find_tensor_attributes(module):
+    """The tensors other than the parameters that require grad and are held as attributes by the module or its
+    submodules, which a function closes over"""
+    assert isinstance(module, nn.Module)
+    return [value for submodule in module.modules() for value in submodule.__dict__.values()
+            if torch.is_tensor(value) and value.requires_grad]
+
+
 def handle_adjoint_norm_(adjoint_options, shapes, state_norm):
     """In-place modifies the adjoint options to choose or wrap the norm function."""
 
-    # This is the default adjoint norm on the backward pass: a mixed norm over the tuple of inputs.
+    # This is the default adjoint norm on the backward pass: a mixed norm over the tuple of inputs. It ignores the
+    # parameter vjps whenever they are part of the state, so it is also the seminorm.
     def default_adjoint_norm(tensor_tuple):
         t, y, adj_y, *adj_params = tensor_tuple
         # (If the state is actually a flattened tuple then this will be unpacked again in state_norm.)
-        return max(t.abs(), state_norm(y), state_norm(adj_y), _mixed_norm(adj_params))
+        return max(t.abs(), state_norm(y), state_norm(adj_y))
 
     if "norm" not in adjoint_options:
         # `adjoint_options` was not explicitly specified by the user. Use the default norm.
@@ -254,18 +473,13 @@ def handle_adjoint_norm_(adjoint_options, shapes, state_norm):
         else:
             # ...and they did specify the norm argument.
             if adjoint_norm == 'seminorm':
-                # They told us they want to use seminorms. Slight modification to plan A: use the default norm,
-                # but ignore the parameter state
-                def adjoint_seminorm(tensor_tuple):
-                    t, y, adj_y, *adj_params = tensor_tuple
-                    # (If the state is actually a flattened tuple then this will be unpacked again in state_norm.)
-                    return max(t.abs(), state_norm(y), state_norm(adj_y))
-                adjoint_options['norm'] = adjoint_seminorm
+                # They told us they want to use seminorms, which the default norm already is.
+                adjoint_options['norm'] = default_adjoint_norm
             else:
                 # And they're using their own custom norm.
                 if shapes is None:
                     # The state on the forward pass was a tensor, not a tuple. We don't need to do anything, they're
-                    # already going to get given the full adjoint state as (t, y, adj_y, adj_params)
+                    # already going to get given the full adjoint state as (t, y, adj_y, *adj_params)
                     pass  # this branch included for clarity
                 else:
                     # This is the bit that is tuple/tensor abstraction-breaking, because the odeint machinery
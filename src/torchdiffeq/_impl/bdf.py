@@ -0,0 +1,202 @@
+import torch
+from .solvers import FixedGridODESolver
+from .misc import _rms_norm
+
+# y_{n+1} = sum_j alpha_j y_{n-j} + beta dt f(t_{n+1}, y_{n+1}) on a uniform grid
+_BDF_COEFFICIENTS = [
+    None,  # order 0
+    ([1.], 1.),
+    ([4 / 3, -1 / 3], 2 / 3),
+    ([18 / 11, -9 / 11, 2 / 11], 6 / 11),
+]
+
+# extrapolates the history to predict y_{n+1}, the starting guess of the Newton iterations
+_EXTRAPOLATION_COEFFICIENTS = [
+    None,
+    [1.],
+    [2., -1.],
+    [3., -3., 1.],
+]
+
+
+def _dot(a, b):
+    return torch.sum(a * b)
+
+
+def _cg(matvec, b, x, tol, max_iters, precond):
+    """Preconditioned conjugate gradients, only valid if matvec is symmetric positive definite."""
+    r = b - matvec(x)
+    z = precond(r)
+    p = z
+    rz = _dot(r, z)
+    for _ in range(max_iters):
+        if _rms_norm(r) <= tol:
+            break
+        ap = matvec(p)
+        step = rz / _dot(p, ap)
+        x = x + step * p
+        r = r - step * ap
+        z = precond(r)
+        rz, rz_old = _dot(r, z), rz
+        p = z + (rz / rz_old) * p
+    return x
+
+
+def _gmres(matvec, b, x, tol, max_iters, precond, restart=10):
+    """Right preconditioned GMRES, restarted every `restart` iterations so only restart + 1 vectors are stored."""
+    n_iters = 0
+    while n_iters < max_iters:
+        r = b - matvec(x)
+        r_norm = _rms_norm(r)
+        if r_norm <= tol:
+            break
+        basis = [r / r_norm]
+        directions = []
+        # the small Hessenberg least squares problem lives on the cpu in double precision
+        hessenberg = torch.zeros(restart + 1, restart, dtype=torch.float64)
+        rhs = torch.zeros(restart + 1, dtype=torch.float64)
+        rhs[0] = float(r_norm)
+        for j in range(min(restart, max_iters - n_iters)):
+            n_iters += 1
+            directions.append(precond(basis[j]))
+            w = matvec(directions[j])
+            # modified Gram-Schmidt, with the rms inner product to match the norm
+            for i in range(j + 1):
+                hessenberg[i, j] = float(_dot(w, basis[i]) / w.numel())
+                w = w - float(hessenberg[i, j]) * basis[i]
+            hessenberg[j + 1, j] = float(_rms_norm(w))
+            coeffs = torch.linalg.lstsq(hessenberg[:j + 2, :j + 1], rhs[:j + 2, None]).solution[:, 0]
+            residual = torch.linalg.norm(hessenberg[:j + 2, :j + 1] @ coeffs - rhs[:j + 2])
+            if residual <= tol or hessenberg[j + 1, j] == 0:
+                break
+            basis.append(w / hessenberg[j + 1, j].item())
+        for coeff, direction in zip(coeffs.tolist(), directions):
+            x = x + coeff * direction
+    return x
+
+
+_LINEAR_SOLVERS = {
+    'gmres': _gmres,
+    'cg': _cg,
+}
+
+
+def _implicit_solve(solver, t1, beta_dt, guess, rhs):
+    """Solves y = rhs + beta_dt * func(t1, y) without building a graph through the iterations, and differentiates it
+    implicitly. The graph is that of one evaluation z = rhs + beta_dt * func(t1, y) at the solution, so gradients
+    reach rhs and everything func depends on: its parameters, and tensors it closes over like x0 or attention weights
+    computed by the block. A hook on z replaces the incoming gradient g by the solution u of the transposed system
+    (I - beta_dt J)^T u = g, solved with vjps through that graph, so memory stays at one evaluation whatever the
+    number of Newton and Krylov iterations."""
+    with torch.no_grad():
+        y = solver._newton(t1, beta_dt, guess, rhs)
+    if not torch.is_grad_enabled():
+        return y
+    y = y.requires_grad_(True)
+    f = solver.func(t1, y)
+    z = rhs + beta_dt * f
+    if not z.requires_grad:
+        return y.detach()
+
+    def implicit_grad(grad_z):
+        def matvec_t(u):
+            return u - beta_dt * torch.autograd.grad(f, y, u, retain_graph=True)[0]
+
+        # there are no Newton corrections after this solve, so it is solved to the same tolerance as the residuals
+        return solver._krylov(matvec_t, grad_z, grad_z, float(_rms_norm(grad_z)) * solver.newton_rtol)
+
+    z.register_hook(implicit_grad)
+    # the value is the Newton solution, z only differs from it by the residual
+    return z + (y - z).detach()
+
+
+class BDF(FixedGridODESolver):
+    """Fixed grid backward differentiation formulae of order 1 (implicit Euler) to 3.
+
+    Each step solves y_{n+1} - beta dt f(t_{n+1}, y_{n+1}) = sum_j alpha_j y_{n-j} with Newton's method, and each
+    Newton update with a matrix-free Krylov method (`linear_solver` gmres, or cg if the Jacobian of func is symmetric)
+    on finite difference Jacobian-vector products of func. Nothing the size of the Jacobian is ever formed, so memory
+    is O(N d) and steps can be far longer than explicit solvers allow on stiff diffusion.
+
+    `preconditioner` optionally maps a residual to an approximate solution of (I - beta dt J) v = r. The first steps,
+    and any step after the step size changes, use lower orders until enough history is available, so bdf3 is only
+    second order accurate overall. Gradients with respect to everything func depends on are computed by implicit
+    differentiation of each step.
+    """
+    order = 2
+
+    def __init__(self, func, y0, linear_solver='gmres', preconditioner=None, max_newton_iters=10,
+                 max_krylov_iters=50, krylov_rtol=1e-3, restart=10, **kwargs):
+        self.rtol = kwargs.get('rtol', 0.)
+        kwargs.pop('max_iters', None)
+        super(BDF, self).__init__(func, y0, **kwargs)
+        assert linear_solver in _LINEAR_SOLVERS, 'linear_solver must be one of {}'.format(list(_LINEAR_SOLVERS))
+        self.linear_solver = linear_solver
+        self.preconditioner = (lambda v: v) if preconditioner is None else preconditioner
+        self.max_newton_iters = max_newton_iters
+        self.max_krylov_iters = max_krylov_iters
+        self.krylov_rtol = krylov_rtol
+        self.restart = restart
+        # residuals can't be resolved below the precision of y
+        self.newton_rtol = max(float(self.rtol), 10 * torch.finfo(y0.dtype).eps)
+        self.history = []
+
+    def _krylov(self, matvec, b, x, tol):
+        if self.linear_solver == 'gmres':
+            return _gmres(matvec, b, x, tol, self.max_krylov_iters, self.preconditioner, self.restart)
+        return _LINEAR_SOLVERS[self.linear_solver](matvec, b, x, tol, self.max_krylov_iters, self.preconditioner)
+
+    def _newton(self, t1, beta_dt, y, rhs):
+        eps = torch.finfo(y.dtype).eps ** 0.5
+        for _ in range(self.max_newton_iters):
+            f = self.func(t1, y)
+            residual = rhs + beta_dt * f - y
+            residual_norm = _rms_norm(residual)
+            y_norm = _rms_norm(y)
+            if residual_norm <= float(self.atol) + self.newton_rtol * y_norm:
+                break
+
+            def matvec(v):
+                # (I - beta dt J) v, with J v by a finite difference scaled to the size of y and v
+                v_norm = _rms_norm(v)
+                if v_norm == 0:
+                    return v
+                h = eps * (1 + y_norm) / v_norm
+                return v - beta_dt * (self.func(t1, y + h * v) - f) / h
+
+            y = y + self._krylov(matvec, residual, torch.zeros_like(y), self.krylov_rtol * float(residual_norm))
+        return y
+
+    def _bdf_step(self, t0, t1, y0):
+        """Advances y0 from t0 to t1, keeping the history of previous steps for the higher orders."""
+        dt = t1 - t0
+        if self.history and not torch.isclose(self.history[0][0], dt):
+            self.history = []
+        ys = [y0] + [y for _, y in self.history]
+        order = min(self.order, len(ys))
+        alphas, beta = _BDF_COEFFICIENTS[order]
+        rhs = sum(alpha * y for alpha, y in zip(alphas, ys))
+        guess = sum(coeff * y.detach() for coeff, y in zip(_EXTRAPOLATION_COEFFICIENTS[order], ys))
+        y1 = _implicit_solve(self, t1, beta * dt, guess, rhs)
+        self.history = [(dt, y0)] + self.history[:max(self.order - 2, 0)]
+        return y1
+
+    def _step_func(self, func, t0, dt, t1, y0):
+        y1 = self._bdf_step(t0, t1, y0)
+        return y1 - y0, None
+
+    def integrate(self, t):
+        self.history = []
+        return super(BDF, self).integrate(t)
+
+
+class BDF1(BDF):
+    order = 1
+
+
+class BDF2(BDF):
+    order = 2
+
+
+class BDF3(BDF):
+    order = 3
@@ -0,0 +1,82 @@
+import math
+import torch
+from .solvers import FixedGridODESolver
+from .misc import Perturb
+
+# below this |z| the phi functions are summed as power series, as the closed forms cancel catastrophically
+_PHI_SERIES_RADIUS = 1.
+_PHI_SERIES_TERMS = 20
+
+
+def _phi(z, order):
+    """phi_0(z) = exp(z), ..., phi_k(z) = (phi_{k-1}(z) - 1 / (k - 1)!) / z elementwise, for k = 0, ..., order."""
+    small = z.abs() < _PHI_SERIES_RADIUS
+    # the closed form is only used where |z| is large, so z_safe avoids dividing by zero elsewhere
+    z_safe = torch.where(small, torch.ones_like(z), z)
+    phis = [torch.exp(z)]
+    for k in range(1, order + 1):
+        closed = (torch.where(small, torch.ones_like(z), phis[-1]) - 1 / math.factorial(k - 1)) / z_safe
+        # phi_k(z) = sum_j z^j / (j + k)!
+        series = torch.zeros_like(z)
+        for j in reversed(range(_PHI_SERIES_TERMS)):
+            series = series * z / (j + k + 1) + 1
+        series = series / math.factorial(k)
+        phis.append(torch.where(small, series, closed))
+    return phis
+
+
+class _ETDSolver(FixedGridODESolver):
+    """Exponential time differencing Runge-Kutta methods for dy/dt = L y + N(t, y), with L diagonal.
+
+    `linear_part` is the diagonal of L as a tensor broadcastable to y, e.g. -alpha for the diffusion functions, and
+    N(t, y) = func(t, y) - L y. The linear part is integrated exactly with exp(dt L) and the phi functions of dt L, and
+    only N is treated explicitly, so the stiffness of L doesn't limit the step size. L is the same for every step.
+    """
+
+    def __init__(self, func, y0, linear_part=None, **kwargs):
+        kwargs.pop('max_iters', None)
+        super(_ETDSolver, self).__init__(func, y0, **kwargs)
+        assert linear_part is not None, 'the {} solver needs the linear_part of func in its options' \
+            .format(self.__class__.__name__)
+        self.linear_part = torch.as_tensor(linear_part, dtype=y0.dtype, device=y0.device)
+
+    def _nonlinear(self, func, t, y, perturb=Perturb.NONE):
+        f = func(t, y, perturb=perturb)
+        return f - self.linear_part * y, f
+
+
+class ETDRK2(_ETDSolver):
+    """Second order exponential Runge-Kutta method of Cox and Matthews, two evaluations of func per step."""
+    order = 2
+
+    def _step_func(self, func, t0, dt, t1, y0):
+        exp_z, phi1, phi2 = _phi(dt * self.linear_part, 2)
+        n0, f0 = self._nonlinear(func, t0, y0, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
+        a = exp_z * y0 + dt * phi1 * n0
+        na, _ = self._nonlinear(func, t1, a, perturb=Perturb.PREV if self.perturb else Perturb.NONE)
+        return a + dt * phi2 * (na - n0) - y0, f0
+
+
+class ETDRK4(_ETDSolver):
+    """Fourth order exponential Runge-Kutta method of Cox and Matthews, four evaluations of func per step."""
+    order = 4
+
+    def _step_func(self, func, t0, dt, t1, y0):
+        half_dt = 0.5 * dt
+        t_half = t0 + half_dt
+        exp_half, phi1_half = _phi(half_dt * self.linear_part, 1)
+        exp_z, phi1, phi2, phi3 = _phi(dt * self.linear_part, 3)
+
+        n0, f0 = self._nonlinear(func, t0, y0, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
+        a = exp_half * y0 + half_dt * phi1_half * n0
+        na, _ = self._nonlinear(func, t_half, a)
+        b = exp_half * y0 + half_dt * phi1_half * na
+        nb, _ = self._nonlinear(func, t_half, b)
+        c = exp_half * a + half_dt * phi1_half * (2 * nb - n0)
+        nc, _ = self._nonlinear(func, t1, c, perturb=Perturb.PREV if self.perturb else Perturb.NONE)
+
+        b0 = phi1 - 3 * phi2 + 4 * phi3
+        b12 = 2 * phi2 - 4 * phi3
+        b3 = 4 * phi3 - phi2
+        y1 = exp_z * y0 + dt * (b0 * n0 + b12 * (na + nb) + b3 * nc)
+        return y1 - y0, f0
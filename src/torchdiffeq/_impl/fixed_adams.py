@@ -1,9 +1,7 @@
-import collections
 import sys
 import torch
 import warnings
 from .solvers import FixedGridODESolver
-from .misc import _compute_error_ratio, _linf_norm
 from .misc import Perturb
 from .rk_common import rk4_alt_step_func
 
@@ -156,16 +154,18 @@ _MAX_ORDER = 12
 _MAX_ITERS = 4
 
 
-# TODO: replace this with PyTorch operations (a little hard because y is a deque being used as a circular buffer)
-def _dot_product(x, y):
-    return sum(xi * yi for xi, yi in zip(x, y))
-
-
 class AdamsBashforthMoulton(FixedGridODESolver):
+    """Adams-Bashforth predictor and Adams-Moulton corrector with up to max_order - 1 previous derivatives.
+
+    The derivatives are kept in a ring buffer stacked along a history axis, newest first from `history_start`, so the
+    predictor and the corrector sums are a single contraction of both sets of coefficients with the buffer. The
+    corrector iterates at most max_iters times per step, and with `nfe_budget` also stops once the evaluations of
+    func left in the solve are needed to take the remaining steps with one corrector evaluation each.
+    """
     order = 4
 
     def __init__(self, func, y0, rtol=1e-3, atol=1e-4, implicit=True, max_iters=_MAX_ITERS, max_order=_MAX_ORDER,
-                 **kwargs):
+                 nfe_budget=None, **kwargs):
         super(AdamsBashforthMoulton, self).__init__(func, y0, rtol=rtol, atol=rtol, **kwargs)
         assert max_order <= _MAX_ORDER, "max_order must be at most {}".format(_MAX_ORDER)
         if max_order < _MIN_ORDER:
@@ -176,49 +176,94 @@ class AdamsBashforthMoulton(FixedGridODESolver):
         self.implicit = implicit
         self.max_iters = max_iters
         self.max_order = int(max_order)
-        self.prev_f = collections.deque(maxlen=self.max_order - 1)
+        self.nfe_budget = nfe_budget
+        # the previous derivatives, history[history_start] is the newest and the next history_len - 1 (mod the length
+        # of the buffer) are older ones
+        self.history = torch.zeros(max(self.max_order - 1, 1), y0.numel(), dtype=y0.dtype, device=y0.device)
+        self.history_start = 0
+        self.history_len = 0
         self.prev_t = None
 
-        self.bashforth = [x.to(y0.device) for x in _BASHFORTH_DIVISOR]
+        # the Bashforth coefficients and the Moulton coefficients of the previous derivatives, padded to the length of
+        # the buffer, for the orders that use them
+        self.coefficients = [None] * self.max_order
+        for order in range(_MIN_ORDER - 1, self.max_order):
+            coefficients = torch.zeros(2, len(self.history), dtype=y0.dtype, device=y0.device)
+            coefficients[0, :order] = _BASHFORTH_DIVISOR[order]
+            coefficients[1, :order] = _MOULTON_DIVISOR[order + 1][1:]
+            self.coefficients[order] = coefficients
         self.moulton = [x.to(y0.device) for x in _MOULTON_DIVISOR]
 
+    def integrate(self, t):
+        # each step needs func for its predictor and at least once for its corrector
+        self.steps_left = len(self.grid_constructor(self.func, self.y0, t)) - 1
+        self.nfe_left = self.nfe_budget
+        return super(AdamsBashforthMoulton, self).integrate(t)
+
     def _update_history(self, t, f):
         if self.prev_t is None or self.prev_t != t:
-            self.prev_f.appendleft(f)
+            self.history_start = (self.history_start - 1) % len(self.history)
+            self.history[self.history_start] = f.reshape(-1)
+            self.history_len = min(self.history_len + 1, len(self.history))
             self.prev_t = t
 
+    def _history_sums(self, order, dt):
+        """The Bashforth and Moulton sums of the previous derivatives times dt, as one contraction of the buffer."""
+        coefficients = (dt * self.coefficients[order].roll(self.history_start, dims=1)).to(self.history.dtype)
+        history = self.history
+        if coefficients.requires_grad:
+            # the buffer is overwritten by the next steps, so it can't be saved for the gradient of the coefficients
+            history = history.clone()
+        return coefficients.matmul(history)
+
+    @torch.no_grad()
     def _has_converged(self, y0, y1):
         """Checks that each element is within the error tolerance."""
-        error_ratio = _compute_error_ratio(torch.abs(y0 - y1), self.rtol, self.atol, y0, y1, _linf_norm)
-        return error_ratio < 1
+        error_tol = torch.max(y0.abs(), y1.abs()).mul_(self.rtol).add_(self.atol)
+        return bool(torch.sub(y0, y1).abs_().sub_(error_tol).amax() < 0)
+
+    def _count_nfe(self, nfe):
+        if self.nfe_left is not None:
+            self.nfe_left -= nfe
+
+    def _max_corrector_iters(self):
+        if self.nfe_left is None:
+            return self.max_iters
+        # the evaluations left after one corrector evaluation in this step and two in each of the following steps
+        spare = self.nfe_left - 1 - 2 * self.steps_left
+        return min(self.max_iters, 1 + max(spare, 0))
 
     def _step_func(self, func, t0, dt, t1, y0):
+        self.steps_left -= 1
         f0 = func(t0, y0, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
         self._update_history(t0, f0)
-        order = min(len(self.prev_f), self.max_order - 1)
+        order = min(self.history_len, self.max_order - 1)
         if order < _MIN_ORDER - 1:
             # Compute using RK4.
-            return rk4_alt_step_func(func, t0, dt, t1, y0, f0=self.prev_f[0], perturb=self.perturb), f0
+            self._count_nfe(4)
+            return rk4_alt_step_func(func, t0, dt, t1, y0, f0=f0, perturb=self.perturb), f0
         else:
-            # Adams-Bashforth predictor.
-            bashforth_coeffs = self.bashforth[order]
-            dy = _dot_product(dt * bashforth_coeffs, self.prev_f).type_as(y0)  # bashforth is float64 so cast back
+            # Adams-Bashforth predictor and the Adams-Moulton sum over the previous derivatives.
+            dy, delta = self._history_sums(order, dt).view(2, *y0.shape)
+            self._count_nfe(1)
 
             # Adams-Moulton corrector.
             if self.implicit:
-                moulton_coeffs = self.moulton[order + 1]
-                delta = dt * _dot_product(moulton_coeffs[1:], self.prev_f).type_as(y0)  # moulton is float64 so cast back
+                moulton_coeff = (dt * self.moulton[order + 1][0]).type_as(y0)
                 converged = False
-                for _ in range(self.max_iters):
+                max_iters = self._max_corrector_iters()
+                for _ in range(max_iters):
                     dy_old = dy
                     f = func(t1, y0 + dy, perturb=Perturb.PREV if self.perturb else Perturb.NONE)
-                    dy = (dt * (moulton_coeffs[0]) * f).type_as(y0) + delta  # moulton is float64 so cast back
+                    self._count_nfe(1)
+                    dy = moulton_coeff * f + delta
                     converged = self._has_converged(dy_old, dy)
                     if converged:
                         break
                 if not converged:
-                    warnings.warn('Functional iteration did not converge. Solution may be incorrect.')
-                    self.prev_f.pop()
+                    if max_iters == self.max_iters:
+                        warnings.warn('Functional iteration did not converge. Solution may be incorrect.')
+                    self.history_len -= 1
                 self._update_history(t0, f)
             return dy, f0
 
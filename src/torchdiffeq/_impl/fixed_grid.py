@@ -1,3 +1,4 @@
+import torch
 from .solvers import FixedGridODESolver
 from .rk_common import rk4_alt_step_func
 from .misc import Perturb
@@ -5,14 +6,19 @@ from .misc import Perturb
 
 class Euler(FixedGridODESolver):
     order = 1
+    n_stage_buffers = 0
 
     def _step_func(self, func, t0, dt, t1, y0):
         f0 = func(t0, y0, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
         return dt * f0, f0
 
+    def _buffered_step_func(self, func, t0, dt, t1, y, stages):
+        y.add_(func(t0, y, perturb=Perturb.NEXT if self.perturb else Perturb.NONE), alpha=dt)
+
 
 class Midpoint(FixedGridODESolver):
     order = 2
+    n_stage_buffers = 1
 
     def _step_func(self, func, t0, dt, t1, y0):
         half_dt = 0.5 * dt
@@ -20,17 +26,30 @@ class Midpoint(FixedGridODESolver):
         y_mid = y0 + f0 * half_dt
         return dt * func(t0 + half_dt, y_mid), f0
 
+    def _buffered_step_func(self, func, t0, dt, t1, y, stages):
+        y_mid, = stages
+        f0 = func(t0, y, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
+        torch.add(y, f0, alpha=0.5 * dt, out=y_mid)
+        y.add_(func(t0 + 0.5 * dt, y_mid), alpha=dt)
+
 
 class RK4(FixedGridODESolver):
     order = 4
+    n_stage_buffers = 1
 
     def _step_func(self, func, t0, dt, t1, y0):
         f0 = func(t0, y0, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
         return rk4_alt_step_func(func, t0, dt, t1, y0, f0=f0, perturb=self.perturb), f0
-    
-class GGear2(FixedGridODESolver):
-    order = 2
 
-    def _step_func(self, func, t0, dt, t1, y0):
-        f0 = func(t0, y0, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
-        return dt * f0, f0
+    def _buffered_step_func(self, func, t0, dt, t1, y, stages):
+        """rk4_alt_step_func, building each stage in the same buffer and updating y in place."""
+        stage, = stages
+        k1 = func(t0, y, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
+        torch.add(y, k1, alpha=dt / 3, out=stage)
+        k2 = func(t0 + dt / 3, stage)
+        torch.add(y, k2, alpha=dt, out=stage).add_(k1, alpha=-dt / 3)
+        k3 = func(t0 + dt * 2 / 3, stage)
+        torch.add(y, k1, alpha=dt, out=stage).add_(k2, alpha=-dt).add_(k3, alpha=dt)
+        k4 = func(t1, stage, perturb=Perturb.PREV if self.perturb else Perturb.NONE)
+        # y + dt / 8 (k1 + 3 (k2 + k3) + k4)
+        y.add_(k1, alpha=dt / 8).add_(k2, alpha=3 * dt / 8).add_(k3, alpha=3 * dt / 8).add_(k4, alpha=dt / 8)
@@ -0,0 +1,101 @@
+import math
+import torch
+from .solvers import FixedGridODESolver
+from .misc import Perturb, _rms_norm
+from .bdf import _cg, _gmres
+
+
+class _LinearImplicitSolve(torch.autograd.Function):
+    """Solves (I - h_gamma L) y = rhs for the linear operator L v = implicit_part(t, v, *tensors) without building a
+    graph through the Krylov iterations. The backward pass solves the transposed system with vjps of L and
+    differentiates L y with respect to the tensors it is built from, like the implicit steps of the bdf solvers."""
+
+    @staticmethod
+    def forward(ctx, solver, t, h_gamma, guess, rhs, *tensors):
+        with torch.no_grad():
+            y = solver._krylov(lambda v: v - h_gamma * solver.implicit_part(t, v, *tensors), rhs, guess)
+        ctx.solver = solver
+        ctx.t = t
+        ctx.h_gamma = h_gamma
+        ctx.save_for_backward(y, *tensors)
+        return y
+
+    @staticmethod
+    def backward(ctx, grad_y):
+        solver, t, h_gamma = ctx.solver, ctx.t, ctx.h_gamma
+        y, *tensors = ctx.saved_tensors
+        with torch.enable_grad():
+            v = torch.zeros_like(y).requires_grad_(True)
+            tensors = [tensor.detach().requires_grad_(needs_grad)
+                       for tensor, needs_grad in zip(tensors, ctx.needs_input_grad[5:])]
+            # L is linear, so L v at v = 0 gives the graph of L^T without depending on y
+            lv = solver.implicit_part(t, v, *tensors)
+            ly = solver.implicit_part(t, y, *tensors)
+
+        def matvec_t(u):
+            return u - h_gamma * torch.autograd.grad(lv, v, u, retain_graph=True)[0]
+
+        u = solver._krylov(matvec_t, grad_y, grad_y)
+        requires_grad = [tensor for tensor in tensors if tensor.requires_grad]
+        grads = iter(torch.autograd.grad(ly, requires_grad, h_gamma * u, allow_unused=True) if requires_grad else ())
+        grad_tensors = [next(grads) if tensor.requires_grad else None for tensor in tensors]
+        return (None, None, None, None, u, *grad_tensors)
+
+
+class ARS222(FixedGridODESolver):
+    """The second order, L-stable implicit-explicit Runge-Kutta method ARS(2,2,2) of Ascher, Ruuth and Spiteri.
+
+    func is split as func(t, y) = implicit_part(t, y, *implicit_tensors) + (func(t, y) - implicit_part(...)), where
+    the implicit part is linear in y, e.g. diffusion on the fixed part of a graph, and is treated implicitly, while
+    the rest, e.g. attention, is treated explicitly. Each step evaluates func twice and solves two linear systems
+    (I - gamma dt L) y = r with a matrix-free Krylov method (`linear_solver` cg if L is symmetric, otherwise gmres),
+    each starting from the previous stage. Gradients with respect to implicit_tensors come from implicit
+    differentiation of the linear solves.
+    """
+    order = 2
+    gamma = 1 - 1 / math.sqrt(2)
+    delta = 1 - 1 / (2 * gamma)
+
+    def __init__(self, func, y0, implicit_part=None, implicit_tensors=(), linear_solver='gmres', linear_rtol=1e-6,
+                 max_krylov_iters=100, restart=20, **kwargs):
+        kwargs.pop('max_iters', None)
+        super(ARS222, self).__init__(func, y0, **kwargs)
+        assert implicit_part is not None, 'the imex solver needs the implicit_part of func in its options'
+        assert linear_solver in ['cg', 'gmres'], 'linear_solver must be cg or gmres, got {}'.format(linear_solver)
+        self.implicit_part = implicit_part
+        self.implicit_tensors = tuple(implicit_tensors)
+        self.linear_solver = linear_solver
+        # the linear systems can't be solved below the precision of y
+        self.linear_rtol = max(linear_rtol, 10 * torch.finfo(y0.dtype).eps)
+        self.max_krylov_iters = max_krylov_iters
+        self.restart = restart
+
+    def _krylov(self, matvec, b, x):
+        tol = float(self.atol) + self.linear_rtol * float(_rms_norm(b))
+        if self.linear_solver == 'cg':
+            return _cg(matvec, b, x, tol, self.max_krylov_iters, lambda v: v)
+        return _gmres(matvec, b, x, tol, self.max_krylov_iters, lambda v: v, self.restart)
+
+    def _split(self, func, t, y, perturb=Perturb.NONE):
+        """The explicit and implicit parts of func at (t, y)"""
+        f = func(t, y, perturb=perturb)
+        f_implicit = self.implicit_part(t, y, *self.implicit_tensors)
+        return f - f_implicit, f_implicit, f
+
+    def _solve(self, t, h_gamma, guess, rhs):
+        return _LinearImplicitSolve.apply(self, t, h_gamma, guess.detach(), rhs, *self.implicit_tensors)
+
+    def _step_func(self, func, t0, dt, t1, y0):
+        gamma, delta = self.gamma, self.delta
+        h_gamma = gamma * dt
+        t_mid = t0 + h_gamma
+
+        f0_explicit, _, f0 = self._split(func, t0, y0, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
+        rhs = y0 + h_gamma * f0_explicit
+        y_mid = self._solve(t_mid, h_gamma, y0, rhs)
+        f_mid_explicit, f_mid_implicit, _ = self._split(func, t_mid, y_mid)
+
+        rhs = y0 + dt * (delta * f0_explicit + (1 - delta) * f_mid_explicit + (1 - gamma) * f_mid_implicit)
+        # the method is stiffly accurate, so the last stage is the new state
+        y1 = self._solve(t1, h_gamma, y_mid, rhs)
+        return y1 - y0, f0
@@ -77,15 +77,44 @@ def _compute_error_ratio(error_estimate, rtol, atol, y0, y1, norm):
 
 
 @torch.no_grad()
-def _optimal_step_size(last_step, error_ratio, safety, ifactor, dfactor, order):
-    """Calculate the optimal size for the next step."""
+def _fused_error_ratio(error_estimate, rtol, atol, y0, y1):
+    """_compute_error_ratio with the rms norm, in the dtype of the state, reusing one buffer for the tolerance and the
+    scaled error and reducing with a single vector norm."""
+    error_tol = torch.max(y0.abs(), y1.abs())
+    error_tol.mul_(rtol.to(y0.dtype)).add_(atol.to(y0.dtype))
+    torch.div(error_estimate, error_tol, out=error_tol)
+    return torch.linalg.vector_norm(error_tol) / math.sqrt(error_tol.numel())
+
+
+@torch.no_grad()
+def _optimal_step_size(last_step, error_ratio, safety, ifactor, dfactor, order, prev_error_ratios=(1., 1.),
+                       gains=(0., 1., 0.)):
+    """Calculate the optimal size for the next step.
+
+    With gains (pcoeff, icoeff, dcoeff) the step is scaled by the PID controller of Soderlind,
+
+        safety * e_n^(-(pcoeff + icoeff + dcoeff) / order) * e_{n-1}^((pcoeff + 2 dcoeff) / order)
+               * e_{n-2}^(-dcoeff / order),
+
+    where e_n is error_ratio and e_{n-1}, e_{n-2} are the prev_error_ratios of the last two accepted steps. The
+    default gains give the I controller safety * e_n^(-1 / order).
+    """
     if error_ratio == 0:
         return last_step * ifactor
     if error_ratio < 1:
         dfactor = torch.ones((), dtype=last_step.dtype, device=last_step.device)
+    elif error_ratio > 1:
+        # a rejected step is never followed by a longer one
+        ifactor = torch.ones((), dtype=last_step.dtype, device=last_step.device)
     error_ratio = error_ratio.type_as(last_step)
+    pcoeff, icoeff, dcoeff = gains
     exponent = torch.tensor(order, dtype=last_step.dtype, device=last_step.device).reciprocal()
-    factor = torch.min(ifactor, torch.max(safety / error_ratio ** exponent, dfactor))
+    factor = safety / error_ratio ** (exponent * (pcoeff + icoeff + dcoeff))
+    if pcoeff != 0 or dcoeff != 0:
+        prev_error_ratio, prev_prev_error_ratio = prev_error_ratios
+        factor = factor * prev_error_ratio ** (exponent * (pcoeff + 2 * dcoeff)) / prev_prev_error_ratio ** (
+            exponent * dcoeff)
+    factor = torch.min(ifactor, torch.max(factor, dfactor))
     return last_step * factor
 
 
@@ -189,7 +218,72 @@ class _PerturbFunc(torch.nn.Module):
         return self.base_func(t, y)
 
 
+_all_callback_names = ['callback_step', 'callback_accept_step', 'callback_reject_step']
+_all_adjoint_callback_names = [name + '_adjoint' for name in _all_callback_names]
+_null_callback = lambda *args, **kwargs: None
+
+
+def _tuple_options(options, shapes, y0):
+    """Normalises the solver options that depend on the shapes of a tupled state, in place."""
+    # For exponential integrators, the linear part is given for each tensor in the state.
+    try:
+        linear_part = options['linear_part']
+    except KeyError:
+        pass
+    else:
+        options['linear_part'] = torch.cat([torch.as_tensor(part, dtype=y0.dtype, device=y0.device)
+                                            .expand(shape).reshape(-1) for part, shape in zip(linear_part, shapes)])
+
+    # For imex solvers, the implicit part takes and returns tuples like func.
+    try:
+        implicit_part = options['implicit_part']
+    except KeyError:
+        pass
+    else:
+        options['implicit_part'] = lambda t, y, *tensors: torch.cat(
+            [f_.reshape(-1) for f_ in implicit_part(t, _flat_to_shape(y, (), shapes), *tensors)])
+
+
+def _reverse_options(options):
+    """Negates the time values and time dependent functions of the solver options, in place."""
+    # For fixed step solvers.
+    try:
+        _grid_constructor = options['grid_constructor']
+    except KeyError:
+        pass
+    else:
+        options['grid_constructor'] = lambda func, y0, t: -_grid_constructor(func, y0, -t)
+
+    # For exponential integrators.
+    try:
+        options['linear_part'] = -options['linear_part']
+    except KeyError:
+        pass
+
+    # For imex solvers.
+    try:
+        _implicit_part = options['implicit_part']
+    except KeyError:
+        pass
+    else:
+        options['implicit_part'] = lambda t, y, *tensors: -_implicit_part(-t, y, *tensors)
+
+    # For multirate solvers.
+    try:
+        _row_func = options['row_func']
+    except KeyError:
+        pass
+    else:
+        options['row_func'] = lambda t, y, rows: -_row_func(-t, y, rows)
+
+    # For RK solvers.
+    _flip_option(options, 'step_t')
+    _flip_option(options, 'jump_t')
+
+
 def _check_inputs(func, y0, t, rtol, atol, method, options, event_fn, SOLVERS):
+    # Save the func before it gets wrapped, so its callbacks can be forwarded to the solver.
+    original_func = func
 
     if event_fn is not None:
         if len(t) != 2:
@@ -243,6 +337,8 @@ def _check_inputs(func, y0, t, rtol, atol, method, options, event_fn, SOLVERS):
             return norm(y)
         options['norm'] = _norm
 
+        _tuple_options(options, shapes, y0)
+
     else:
         if 'norm' in options:
             # No need to change the norm function.
@@ -270,17 +366,7 @@ def _check_inputs(func, y0, t, rtol, atol, method, options, event_fn, SOLVERS):
         if event_fn is not None:
             event_fn = _ReverseFunc(event_fn)
 
-        # For fixed step solvers.
-        try:
-            _grid_constructor = options['grid_constructor']
-        except KeyError:
-            pass
-        else:
-            options['grid_constructor'] = lambda func, y0, t: -_grid_constructor(func, y0, -t)
-
-        # For RK solvers.
-        _flip_option(options, 'step_t')
-        _flip_option(options, 'jump_t')
+        _reverse_options(options)
 
     # Can only do after having normalised time
     _assert_increasing('t', t)
@@ -300,6 +386,36 @@ def _check_inputs(func, y0, t, rtol, atol, method, options, event_fn, SOLVERS):
     # Add perturb argument to func.
     func = _PerturbFunc(func)
 
+    # Add callbacks to the wrapped func. All callbacks take the arguments (t0, y0, dt).
+    callback_names = set()
+    for callback_name in _all_callback_names:
+        try:
+            callback = getattr(original_func, callback_name)
+        except AttributeError:
+            setattr(func, callback_name, _null_callback)
+        else:
+            if callback is not _null_callback:
+                callback_names.add(callback_name)
+                if is_tuple:
+                    def callback(t0, y0, dt, _callback=callback):
+                        y0 = _flat_to_shape(y0, (), shapes)
+                        return _callback(t0, y0, dt)
+                if t_is_reversed:
+                    def callback(t0, y0, dt, _callback=callback):
+                        return _callback(-t0, y0, dt)
+            setattr(func, callback_name, callback)
+    for callback_name in _all_adjoint_callback_names:
+        try:
+            callback = getattr(original_func, callback_name)
+        except AttributeError:
+            pass
+        else:
+            setattr(func, callback_name, callback)
+
+    invalid_callbacks = callback_names - SOLVERS[method].valid_callbacks()
+    if len(invalid_callbacks) > 0:
+        warnings.warn("Solver '{}' does not support callbacks {}".format(SOLVERS[method], invalid_callbacks))
+
     return shapes, func, y0, t, rtol, atol, method, options, event_fn, t_is_reversed
 
 
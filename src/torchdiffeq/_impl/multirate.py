@@ -0,0 +1,79 @@
+import math
+import torch
+from .solvers import FixedGridODESolver
+from .misc import Perturb
+
+
+class MultirateHeun(FixedGridODESolver):
+    """Multirate explicit trapezoidal (Heun) method with local time stepping over the rows of y, e.g. graph nodes.
+
+    Each step of size dt takes a Heun step for every row, and the difference to the embedded Euler step estimates the
+    local error of each row. A row whose error exceeds the tolerance by a factor r is put in rate class
+    m = ceil(log4(r)), at most max_levels - 1, and is recomputed with 2^m substeps of dt / 2^m, slowest class first.
+    While a class is substepped the rows of the slower classes are linearly interpolated between their values at the
+    start and end of the step, so they only enter through their contributions to the active rows. The classes are
+    recomputed at every step, so a handful of stiff rows, e.g. high degree nodes, no longer force small steps on every
+    row.
+
+    `row_func(t, y, rows)` evaluates func on the given rows only, e.g. aggregating over the edges into those rows. It
+    defaults to evaluating func on every row and selecting the rows, which gives the same result at no saving.
+    `row_sources(rows, num_rows)` gives the sorted rows of a state with num_rows rows that row_func reads to evaluate
+    `rows`, e.g. the rows and their neighbours. With it, only those rows are interpolated, once per rate class of a
+    step rather than on every substep, and row_func is given the state on those rows only, in that order.
+    """
+    order = 2
+
+    def __init__(self, func, y0, row_func=None, row_sources=None, max_levels=4, **kwargs):
+        self.rtol = kwargs.get('rtol', 0.)
+        kwargs.pop('max_iters', None)
+        super(MultirateHeun, self).__init__(func, y0, **kwargs)
+        self.row_func = (lambda t, y, rows: func(t, y)[rows]) if row_func is None else row_func
+        self.row_sources = row_sources
+        self.max_levels = max_levels
+
+    def _levels(self, y0, y1, error):
+        """The rate class of each row, from its error relative to the tolerance."""
+        scale = self.atol + self.rtol * torch.max(y0.abs(), y1.abs())
+        ratio = (error / scale).reshape(len(y0), -1).pow(2).mean(dim=1).sqrt()
+        # the error of the embedded Euler step is O(dt^2), so each halving of the step divides it by 4
+        levels = torch.ceil(torch.log(ratio.clamp(min=1.)) / math.log(4))
+        return levels.clamp(max=self.max_levels - 1).long()
+
+    def _substep(self, t0, dt, y0, y1, start, level, rows):
+        """Advances `rows`, the rows at or above `level`, from `start` at time t0 by dt, with the other rows
+        interpolated between y0 and y1 over the whole step. Returns their values at t0 + dt."""
+        h = dt / 2 ** level
+        # the rows row_func reads and the positions of `rows` among them are the same for every substep
+        if self.row_sources is None:
+            positions = rows
+        else:
+            sources = self.row_sources(rows, len(y0))
+            positions = torch.searchsorted(sources, rows)
+            y0, y1 = y0[sources], y1[sources]
+        dy = y1 - y0
+        for i in range(2 ** level):
+            s = t0 + i * h
+            # the slower rows at the start of this substep and at its end
+            y_start = y0 + (s - t0) / dt * dy
+            y_end = y0 + (s + h - t0) / dt * dy
+            y_start[positions] = start
+            k1 = self.row_func(s, y_start, rows)
+            y_end[positions] = start + h * k1
+            k2 = self.row_func(s + h, y_end, rows)
+            start = start + h / 2 * (k1 + k2)
+        return start
+
+    def _step_func(self, func, t0, dt, t1, y0):
+        f0 = func(t0, y0, perturb=Perturb.NEXT if self.perturb else Perturb.NONE)
+        y_euler = y0 + dt * f0
+        f1 = func(t1, y_euler, perturb=Perturb.PREV if self.perturb else Perturb.NONE)
+        y1 = y0 + dt / 2 * (f0 + f1)
+        levels = self._levels(y0, y1, dt / 2 * (f1 - f0))
+
+        # slowest class first, each class is recomputed from the start of the step with the slower classes known
+        for level in range(1, int(levels.max()) + 1):
+            rows = torch.nonzero(levels >= level).squeeze(1)
+            if len(rows) == 0:
+                continue
+            y1 = y1.index_put((rows,), self._substep(t0, dt, y0, y1, y0[rows], level, rows))
+        return y1 - y0, f0
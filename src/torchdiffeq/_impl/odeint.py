@@ -4,11 +4,19 @@ from .dopri5 import Dopri5Solver
 from .bosh3 import Bosh3Solver
 from .adaptive_heun import AdaptiveHeunSolver
 from .fehlberg2 import Fehlberg2
-from .fixed_grid import Euler, Midpoint, RK4, GGear2
+from .fixed_grid import Euler, Midpoint, RK4
 from .fixed_adams import AdamsBashforth, AdamsBashforthMoulton
 from .dopri8 import Dopri8Solver
 from .scipy_wrapper import ScipyWrapperODESolver
-from .misc import _check_inputs, _flat_to_shape
+from .expm_multiply import ExpmMultiplySolver
+from .chebyshev import ChebyshevSolver
+from .bdf import BDF1, BDF2, BDF3
+from .etd import ETDRK2, ETDRK4
+from .imex import ARS222
+from .multirate import MultirateHeun
+from .parareal import PararealSolver
+from .solvers import FixedGridODESolver
+from .misc import _check_inputs, _flat_to_shape, _reverse_options, _tuple_options
 
 SOLVERS = {
     'dopri8': Dopri8Solver,
@@ -19,13 +27,26 @@ SOLVERS = {
     'euler': Euler,
     'midpoint': Midpoint,
     'rk4': RK4,
-    'gear2': GGear2, 
+    'etdrk2': ETDRK2,
+    'etdrk4': ETDRK4,
+    'ars222': ARS222,
+    'imex': ARS222,
+    'multirate': MultirateHeun,
+    'implicit_euler': BDF1,
+    'bdf2': BDF2,
+    'bdf3': BDF3,
+    # Gear's methods are the backward differentiation formulae
+    'gear2': BDF2,
+    'gear3': BDF3,
     'explicit_adams': AdamsBashforth,
     'implicit_adams': AdamsBashforthMoulton,
     # Backward compatibility: use the same name as before
     'fixed_adams': AdamsBashforthMoulton,
     # ~Backwards compatibility
     'scipy_solver': ScipyWrapperODESolver,
+    'expm_multiply': ExpmMultiplySolver,
+    'chebyshev': ChebyshevSolver,
+    'parareal': PararealSolver,
 }
 
 
@@ -91,6 +112,50 @@ def odeint(func, y0, t, *, rtol=1e-7, atol=1e-9, method=None, options=None, even
         return event_t, solution
 
 
+class ODESolverPlan(object):
+    """The validated inputs of repeated odeint solves of `func` over the times `t`, from states with the shapes, dtype
+    and device of `y0`.
+
+    The plan checks the inputs and wraps func once, and for fixed grid methods with a step_size it builds the time
+    grid once. `solve(y0, options)` then only instantiates the solver and integrates, with `options` updating the
+    options of the plan, e.g. those that change between solves like the linear part of the exponential integrators.
+    They are normalised for tupled states and reversed time like the options of odeint. The arguments are those of
+    odeint, without events.
+    """
+
+    def __init__(self, func, y0, t, *, rtol=1e-7, atol=1e-9, method=None, options=None):
+        self.shapes, self.func, y0, self.t, self.rtol, self.atol, self.method, self.options, _, self.t_is_reversed = \
+            _check_inputs(func, y0, t, rtol, atol, method, options, None, SOLVERS)
+        self.solver = SOLVERS[self.method]
+        self.y0_shape = y0.shape
+
+        step_size = self.options.get('step_size')
+        if issubclass(self.solver, FixedGridODESolver) and step_size is not None:
+            time_grid = FixedGridODESolver._grid_constructor_from_step_size(step_size)(self.func, y0, self.t)
+            del self.options['step_size']
+            self.options['grid_constructor'] = lambda func, y0, t: time_grid.to(t.device)
+
+    def solve(self, y0, options=None):
+        if self.shapes is not None:
+            y0 = torch.cat([y0_.reshape(-1) for y0_ in y0])
+        assert y0.shape == self.y0_shape, 'y0 has shape {} but the plan is for {}'.format(y0.shape, self.y0_shape)
+        if options:
+            options = options.copy()
+            if self.shapes is not None:
+                _tuple_options(options, self.shapes, y0)
+            if self.t_is_reversed:
+                _reverse_options(options)
+            options = dict(self.options, **options)
+        else:
+            options = self.options
+
+        solver = self.solver(func=self.func, y0=y0, rtol=self.rtol, atol=self.atol, **options)
+        solution = solver.integrate(self.t)
+        if self.shapes is not None:
+            solution = _flat_to_shape(solution, (len(self.t),), self.shapes)
+        return solution
+
+
 def odeint_event(func, y0, t0, *, event_fn, reverse_time=False, odeint_interface=odeint, **kwargs):
     """Automatically links up the gradient from the event time."""
 
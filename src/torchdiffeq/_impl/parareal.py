@@ -0,0 +1,133 @@
+import os
+import torch
+import torch.multiprocessing as mp
+from .misc import _handle_unused_kwargs, _rms_norm
+
+# the fine solve of the current parareal solver, set before the worker processes are forked so that they inherit func
+# instead of pickling it
+_FINE_SOLVE = None
+
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _fine_solve_in_worker(args):
+    with torch.no_grad():
+        return _FINE_SOLVE(*args)
+
+
+class PararealSolver(object):
+    """Parallel-in-time integration with the parareal method of Lions, Maday and Turinici.
+
+    [t0, t1] is split into `slices` equal slices. A cheap coarse solver G (`coarse_method` with `step_size`, or one
+    step per slice if step_size is None) sweeps over the slices, then each iteration runs the fine solver F
+    (`fine_method` with rtol, atol and `fine_options`) on every slice in parallel, from the current states at the slice
+    boundaries, and corrects the boundary states in a coarse sweep
+
+        U_{n+1} <- G(U_n) + F(U_n^old) - G(U_n^old)
+
+    until the boundary states change by less than the tolerance, or for at most `max_parareal_iters` iterations.
+    After k iterations the first k slices are exact, so slices stops it at the latest and the result is that of the
+    fine solver. The fine solves run in `workers` processes forked for each integrate call, which inherit func and
+    return their states through shared memory. Evaluations of func in the workers are not counted in its nfe.
+
+    The workers don't build autograd graphs, so when gradients are needed, or the state is on a gpu, or workers is 1,
+    the slices are solved one after the other in this process, which gives the same result.
+    """
+
+    def __init__(self, func, y0, rtol, atol, coarse_method='rk4', step_size=None, fine_method='dopri5',
+                 fine_options=None, slices=None, workers=None, max_parareal_iters=None, norm=_rms_norm,
+                 **unused_kwargs):
+        unused_kwargs.pop('max_iters', None)
+        _handle_unused_kwargs(self, unused_kwargs)
+        del unused_kwargs
+
+        from .odeint import SOLVERS
+        assert coarse_method in SOLVERS and fine_method in SOLVERS, \
+            'unknown parareal solvers {} and {}'.format(coarse_method, fine_method)
+        self.func = func
+        self.y0 = y0
+        self.rtol = rtol
+        self.atol = atol
+        self.coarse_solver = SOLVERS[coarse_method]
+        self.coarse_options = {} if step_size is None else {'step_size': step_size}
+        self.fine_solver = SOLVERS[fine_method]
+        self.fine_options = {} if fine_options is None else fine_options
+        self.workers = os.cpu_count() if workers is None else workers
+        self.slices = self.workers if slices is None else slices
+        self.max_parareal_iters = self.slices if max_parareal_iters is None else max_parareal_iters
+        self.norm = norm
+
+    @classmethod
+    def valid_callbacks(cls):
+        return set()
+
+    def _coarse_solve(self, y0, t0, t1):
+        solver = self.coarse_solver(func=self.func, y0=y0, rtol=self.rtol, atol=self.atol, norm=self.norm,
+                                    **self.coarse_options)
+        return solver.integrate(torch.stack([t0, t1]))[-1]
+
+    def _fine_solve(self, y0, t):
+        solver = self.fine_solver(func=self.func, y0=y0, rtol=self.rtol, atol=self.atol, norm=self.norm,
+                                  **self.fine_options)
+        return solver.integrate(t)
+
+    def _error_ratio(self, y, y_old):
+        return self.norm((y - y_old) / (self.atol + self.rtol * torch.max(y.abs(), y_old.abs())))
+
+    def integrate(self, t):
+        global _FINE_SOLVE
+        boundaries = torch.linspace(float(t[0]), float(t[-1]), self.slices + 1, dtype=t.dtype, device=t.device)
+        boundaries[-1] = t[-1]
+        # each slice is solved at its boundaries and at the output times inside it
+        slice_times = [torch.cat([boundaries[n:n + 1], t[(t > boundaries[n]) & (t < boundaries[n + 1])],
+                                  boundaries[n + 1:n + 2]]) for n in range(self.slices)]
+
+        states = [self.y0]
+        coarse = []
+        for n in range(self.slices):
+            coarse.append(self._coarse_solve(states[n], boundaries[n], boundaries[n + 1]))
+            states.append(coarse[n])
+
+        in_parallel = self.workers > 1 and self.y0.device.type == 'cpu' and not (
+            torch.is_grad_enabled() and self.y0.requires_grad)
+        pool = None
+        if in_parallel:
+            _FINE_SOLVE = self._fine_solve
+            num_threads = max(1, torch.get_num_threads() // self.workers)
+            pool = mp.get_context('fork').Pool(min(self.workers, self.slices), _init_worker, (num_threads,))
+        try:
+            trajectories = [None] * self.slices
+            for k in range(self.max_parareal_iters):
+                # the slices before k start from exact states, so their fine solutions no longer change
+                args = [(states[n], slice_times[n]) for n in range(k, self.slices)]
+                if in_parallel:
+                    fine = pool.map(_fine_solve_in_worker, args)
+                else:
+                    fine = [self._fine_solve(*arg) for arg in args]
+                trajectories[k:] = fine
+
+                error_ratio = 0.
+                for n in range(k, self.slices):
+                    # the start of slice k hasn't changed, so neither has its coarse solution
+                    g = coarse[n] if n == k else self._coarse_solve(states[n], boundaries[n], boundaries[n + 1])
+                    state = g + trajectories[n][-1] - coarse[n]
+                    coarse[n] = g
+                    error_ratio = max(error_ratio, float(self._error_ratio(state, states[n + 1])))
+                    states[n + 1] = state
+                if error_ratio <= 1:
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _FINE_SOLVE = None
+
+        solution = torch.empty(len(t), *self.y0.shape, dtype=self.y0.dtype, device=self.y0.device)
+        solution[0] = self.y0
+        # the slice of each output time, with the times on a boundary at the end of the slice before it
+        slice_index = torch.searchsorted(boundaries, t[1:]).clamp(1, self.slices) - 1
+        for j, n in enumerate(slice_index.tolist(), 1):
+            solution[j] = trajectories[n][(slice_times[n] == t[j]).nonzero()[-1, 0]]
+        return solution
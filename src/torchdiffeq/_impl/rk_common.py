@@ -4,6 +4,8 @@ import torch
 from .event_handling import find_event
 from .interp import _interp_evaluate, _interp_fit
 from .misc import (_compute_error_ratio,
+                   _fused_error_ratio,
+                   _rms_norm,
                    _select_initial_step,
                    _optimal_step_size)
 from .misc import Perturb
@@ -13,6 +15,25 @@ from .solvers import AdaptiveStepsizeEventODESolver
 _ButcherTableau = collections.namedtuple('_ButcherTableau', 'alpha, beta, c_sol, c_error')
 
 
+# The copies of the class tableaux on each device and dtype, keyed by the ids of the class tableau and mid, which the
+# values keep alive.
+_DEVICE_TABLEAUX = {}
+
+
+def _device_tableau(tableau, mid, device, dtype):
+    key = (id(tableau), id(mid), device, dtype)
+    try:
+        return _DEVICE_TABLEAUX[key][1]
+    except KeyError:
+        pass
+    device_tableau = _ButcherTableau(alpha=tableau.alpha.to(device=device, dtype=dtype),
+                                     beta=[b.to(device=device, dtype=dtype) for b in tableau.beta],
+                                     c_sol=tableau.c_sol.to(device=device, dtype=dtype),
+                                     c_error=tableau.c_error.to(device=device, dtype=dtype))
+    _DEVICE_TABLEAUX[key] = ((tableau, mid), (device_tableau, mid.to(device=device, dtype=dtype)))
+    return _DEVICE_TABLEAUX[key][1]
+
+
 _RungeKuttaState = collections.namedtuple('_RungeKuttaState', 'y1, f1, t0, t1, dt, interp_coeff')
 # Saved state of the Runge Kutta solver.
 #
@@ -114,6 +135,38 @@ def rk4_alt_step_func(func, t0, dt, t1, y0, f0=None, perturb=False):
     return (k1 + 3 * (k2 + k3) + k4) * dt * 0.125
 
 
+class StepSizeMemory(object):
+    """Carries the step sizes of one solve over to the next, for repeated solves of slowly changing dynamics such as
+    the same ODE block in successive training epochs. A solver given a `step_memory` skips _select_initial_step and
+    starts from the step the controller proposed after its first accepted step last time, i.e. its own estimate of the
+    best first step, and counts its rejected steps."""
+
+    def __init__(self):
+        self.first_step = None
+        self.first_accepted = False  # whether the latest solve has accepted a step
+        self.n_rejected = 0
+        self.n_warm_starts = 0
+
+    def start(self):
+        """Returns the step size to start a new solve with, or None on the first solve."""
+        if self.first_step is not None:
+            self.n_warm_starts += 1
+        self.first_accepted = False
+        return self.first_step
+
+    def accept(self, dt, dt_next):
+        if not self.first_accepted:
+            self.first_step = dt_next.detach()
+            self.first_accepted = True
+
+    def reject(self, dt):
+        self.n_rejected += 1
+
+    def reset_counts(self):
+        self.n_rejected = 0
+        self.n_warm_starts = 0
+
+
 class RKAdaptiveStepsizeODESolver(AdaptiveStepsizeEventODESolver):
     order: int
     tableau: _ButcherTableau
@@ -128,6 +181,11 @@ class RKAdaptiveStepsizeODESolver(AdaptiveStepsizeEventODESolver):
                  dfactor=0.2,
                  max_num_steps=2 ** 31 - 1,
                  dtype=torch.float64,
+                 step_memory=None,
+                 pcoeff=0.,
+                 icoeff=1.,
+                 dcoeff=0.,
+                 fused_norm=False,
                  **kwargs):
         super(RKAdaptiveStepsizeODESolver, self).__init__(dtype=dtype, y0=y0, **kwargs)
 
@@ -140,31 +198,43 @@ class RKAdaptiveStepsizeODESolver(AdaptiveStepsizeEventODESolver):
         self.rtol = torch.as_tensor(rtol, dtype=dtype, device=device)
         self.atol = torch.as_tensor(atol, dtype=dtype, device=device)
         self.first_step = None if first_step is None else torch.as_tensor(first_step, dtype=dtype, device=device)
+        self.step_memory = step_memory
         self.safety = torch.as_tensor(safety, dtype=dtype, device=device)
         self.ifactor = torch.as_tensor(ifactor, dtype=dtype, device=device)
         self.dfactor = torch.as_tensor(dfactor, dtype=dtype, device=device)
         self.max_num_steps = torch.as_tensor(max_num_steps, dtype=torch.int32, device=device)
         self.dtype = dtype
+        # the gains of the PID step size controller, the defaults give the I controller
+        self.gains = (pcoeff, icoeff, dcoeff)
+        # the fused error ratio only replaces the default rms norm
+        self.fused_norm = fused_norm and self.norm is _rms_norm
 
         self.step_t = None if step_t is None else torch.as_tensor(step_t, dtype=dtype, device=device)
         self.jump_t = None if jump_t is None else torch.as_tensor(jump_t, dtype=dtype, device=device)
 
-        # Copy from class to instance to set device
-        self.tableau = _ButcherTableau(alpha=self.tableau.alpha.to(device=device, dtype=y0.dtype),
-                                       beta=[b.to(device=device, dtype=y0.dtype) for b in self.tableau.beta],
-                                       c_sol=self.tableau.c_sol.to(device=device, dtype=y0.dtype),
-                                       c_error=self.tableau.c_error.to(device=device, dtype=y0.dtype))
-        self.mid = self.mid.to(device=device, dtype=y0.dtype)
+        # Copy from class to instance to set device, once per device and dtype
+        self.tableau, self.mid = _device_tableau(self.tableau, self.mid, device, y0.dtype)
+
+    @classmethod
+    def valid_callbacks(cls):
+        return super(RKAdaptiveStepsizeODESolver, cls).valid_callbacks() | {'callback_step',
+                                                                           'callback_accept_step',
+                                                                           'callback_reject_step'}
 
     def _before_integrate(self, t):
         t0 = t[0]
         f0 = self.func(t[0], self.y0)
-        if self.first_step is None:
+        warm_step = None if self.step_memory is None else self.step_memory.start()
+        if self.first_step is not None:
+            first_step = self.first_step
+        elif warm_step is not None:
+            first_step = warm_step.to(self.dtype)
+        else:
             first_step = _select_initial_step(self.func, t[0], self.y0, self.order - 1, self.rtol, self.atol,
                                               self.norm, f0=f0)
-        else:
-            first_step = self.first_step
         self.rk_state = _RungeKuttaState(self.y0, f0, t[0], t[0], first_step, [self.y0] * 5)
+        # the error ratios of the last two accepted steps, for the PID controller
+        self.prev_error_ratios = (1., 1.)
 
         # Handle step_t and jump_t arguments.
         if self.step_t is None:
@@ -252,6 +322,7 @@ class RKAdaptiveStepsizeODESolver(AdaptiveStepsizeEventODESolver):
         # Must be arranged as doing all the step_t handling, then all the jump_t handling, in case we
         # trigger both. (i.e. interleaving them would be wrong.)
 
+        self.func.callback_step(t0, y0, dt)
         y1, f1, y1_error, k = _runge_kutta_step(self.func, y0, f0, t0, dt, t1, tableau=self.tableau)
         # dtypes:
         # y1.dtype == self.y0.dtype
@@ -262,7 +333,10 @@ class RKAdaptiveStepsizeODESolver(AdaptiveStepsizeEventODESolver):
         ########################################################
         #                     Error Ratio                      #
         ########################################################
-        error_ratio = _compute_error_ratio(y1_error, self.rtol, self.atol, y0, y1, self.norm)
+        if self.fused_norm:
+            error_ratio = _fused_error_ratio(y1_error, self.rtol, self.atol, y0, y1)
+        else:
+            error_ratio = _compute_error_ratio(y1_error, self.rtol, self.atol, y0, y1, self.norm)
         accept_step = error_ratio <= 1
         # dtypes:
         # error_ratio.dtype == self.dtype
@@ -271,6 +345,7 @@ class RKAdaptiveStepsizeODESolver(AdaptiveStepsizeEventODESolver):
         #                   Update RK State                    #
         ########################################################
         if accept_step:
+            self.func.callback_accept_step(t0, y0, dt)
             t_next = t1
             y_next = y1
             interp_coeff = self._interp_fit(y0, y_next, k, dt)
@@ -285,10 +360,20 @@ class RKAdaptiveStepsizeODESolver(AdaptiveStepsizeEventODESolver):
                 f1 = self.func(t_next, y_next, perturb=Perturb.NEXT)
             f_next = f1
         else:
+            self.func.callback_reject_step(t0, y0, dt)
             t_next = t0
             y_next = y0
             f_next = f0
-        dt_next = _optimal_step_size(dt, error_ratio, self.safety, self.ifactor, self.dfactor, self.order)
+        dt_next = _optimal_step_size(dt, error_ratio, self.safety, self.ifactor, self.dfactor, self.order,
+                                     self.prev_error_ratios, self.gains)
+        if accept_step:
+            # bounded below like the previous error in the PI controller of Hairer's dopri5
+            self.prev_error_ratios = (max(error_ratio, 1e-4), self.prev_error_ratios[0])
+        if self.step_memory is not None:
+            if accept_step:
+                self.step_memory.accept(dt, dt_next)
+            else:
+                self.step_memory.reject(dt)
         rk_state = _RungeKuttaState(y_next, f_next, t0, t_next, dt_next, interp_coeff)
         return rk_state
 
@@ -22,6 +22,10 @@ class ScipyWrapperODESolver(metaclass=abc.ABCMeta):
         self.solver = solver
         self.func = convert_func_to_numpy(func, self.shape, self.device, self.dtype)
 
+    @classmethod
+    def valid_callbacks(cls):
+        return set()
+
     def integrate(self, t):
         if t.numel() == 1:
             return torch.tensor(self.y0)[None].to(self.device, self.dtype)
@@ -50,9 +50,20 @@ class AdaptiveStepsizeEventODESolver(AdaptiveStepsizeODESolver, metaclass=abc.AB
 
 
 class FixedGridODESolver(metaclass=abc.ABCMeta):
+    """Solvers that step through a fixed time grid.
+
+    With `buffered`, solvers that implement _buffered_step_func(func, t0, dt, t1, y, stages), which takes a step from y
+    in place with dt a float, integrate without building a graph, e.g. at inference and in the forward pass of the
+    adjoint method, by updating one state tensor and `n_stage_buffers` stage tensors in place, allocated once per
+    solve. The time grid and the output times are copied to the host once, instead of synchronising on every step. The
+    states passed to the callbacks are then overwritten by the following steps. The other solvers reject `buffered`.
+    """
     order: int
+    # the number of stage tensors of _buffered_step_func, None if the solver doesn't implement it
+    n_stage_buffers = None
 
-    def __init__(self, func, y0, step_size=None, grid_constructor=None, interp="linear", perturb=False, **unused_kwargs):
+    def __init__(self, func, y0, step_size=None, grid_constructor=None, interp="linear", perturb=False, buffered=False,
+                 **unused_kwargs):
         self.atol = unused_kwargs.pop('atol')
         unused_kwargs.pop('rtol', None)
         unused_kwargs.pop('norm', None)
@@ -66,6 +77,9 @@ class FixedGridODESolver(metaclass=abc.ABCMeta):
         self.step_size = step_size
         self.interp = interp
         self.perturb = perturb
+        self.buffered = buffered
+        if buffered and self.n_stage_buffers is None:
+            raise ValueError("{} has no buffered mode.".format(self.__class__.__name__))
 
         if step_size is None:
             if grid_constructor is None:
@@ -91,11 +105,18 @@ class FixedGridODESolver(metaclass=abc.ABCMeta):
             return t_infer
         return _grid_constructor
 
+    @classmethod
+    def valid_callbacks(cls):
+        # every fixed grid step is accepted, so callback_accept_step fires after each step
+        return {'callback_step', 'callback_accept_step'}
+
     @abc.abstractmethod
     def _step_func(self, func, t0, dt, t1, y0):
         pass
 
     def integrate(self, t):
+        if self.buffered and self.interp == "linear" and not torch.is_grad_enabled():
+            return self._integrate_buffered(t)
         time_grid = self.grid_constructor(self.func, self.y0, t)
         assert time_grid[0] == t[0] and time_grid[-1] == t[-1]
 
@@ -106,7 +127,9 @@ class FixedGridODESolver(metaclass=abc.ABCMeta):
         y0 = self.y0
         for t0, t1 in zip(time_grid[:-1], time_grid[1:]):
             dt = t1 - t0
+            self.func.callback_step(t0, y0, dt)
             dy, f0 = self._step_func(self.func, t0, dt, t1, y0)
+            self.func.callback_accept_step(t0, y0, dt)
             y1 = y0 + dy
 
             while j < len(t) and t1 >= t[j]:
@@ -122,6 +145,43 @@ class FixedGridODESolver(metaclass=abc.ABCMeta):
 
         return solution
 
+    def _integrate_buffered(self, t):
+        # the only host synchronisation of the solve
+        t_host = t.cpu()
+        time_grid = self.grid_constructor(self.func, self.y0, t_host)
+        assert time_grid[0] == t_host[0] and time_grid[-1] == t_host[-1]
+        grid, t_list = time_grid.tolist(), t_host.tolist()
+        time_grid = time_grid.to(self.device)
+        dts = time_grid[1:] - time_grid[:-1]
+
+        solution = torch.empty(len(t), *self.y0.shape, dtype=self.y0.dtype, device=self.y0.device)
+        solution[0] = self.y0
+        y = self.y0.clone()
+        y_prev = None
+        stages = [torch.empty_like(y) for _ in range(self.n_stage_buffers)]
+
+        j = 1
+        for i in range(len(grid) - 1):
+            t0, t1 = time_grid[i], time_grid[i + 1]
+            dt = grid[i + 1] - grid[i]
+            # the state at the start of the step is only kept if an output time falls inside the step
+            if j < len(t) and t_list[j] < grid[i + 1]:
+                if y_prev is None:
+                    y_prev = torch.empty_like(y)
+                y_prev.copy_(y)
+            self.func.callback_step(t0, y, dts[i])
+            self._buffered_step_func(self.func, t0, dt, t1, y, stages)
+            self.func.callback_accept_step(t0, y, dts[i])
+
+            while j < len(t) and grid[i + 1] >= t_list[j]:
+                if t_list[j] == grid[i + 1]:
+                    solution[j] = y
+                else:
+                    torch.lerp(y_prev, y, (t_list[j] - grid[i]) / dt, out=solution[j])
+                j += 1
+
+        return solution
+
     def integrate_until_event(self, t0, event_fn):
         assert self.step_size is not None, "Event handling for fixed step solvers currently requires `step_size` to be provided in options."
 
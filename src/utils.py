@@ -172,6 +172,7 @@ from typing import Optional
 import torch
 from torch import Tensor
 from torch_scatter import scatter, segment_csr, gather_csr
+import torch_sparse
 
 
 # https://twitter.com/jon_barron/status/1387167648669048833?s=12
@@ -208,6 +209,238 @@ def squareplus(src: Tensor, index: Optional[Tensor], ptr: Optional[Tensor] = Non
   return out / (out_sum + 1e-16)
 
 
+class EdgeCSR(object):
+  r"""CSR pointers for both endpoints of an edge index, so segment reductions over either end of the
+    edges can use :obj:`segment_csr` instead of scattering by an unsorted index.
+
+    For each direction :obj:`norm_idx` (0 = source, 1 = target) this stores the pointer :obj:`ptr[norm_idx]`
+    into the edges sorted by that endpoint and the permutation :obj:`perm[norm_idx]` that sorts them, which is
+    :obj:`None` if the edges are already sorted that way. Blocks sort their edges by source once, so row
+    normalisation never permutes.
+
+    Args:
+        edge_index (LongTensor): The edge indices.
+        num_nodes (int, optional): The number of nodes. (default: :obj:`None`)
+    """
+
+  def __init__(self, edge_index: Tensor, num_nodes: Optional[int] = None):
+    self.edge_index = edge_index
+    self.num_nodes = maybe_num_nodes(edge_index, num_nodes)
+    self.ptr = []
+    self.perm = []
+    for index in edge_index:
+      if index.numel() > 1 and bool((index[1:] < index[:-1]).any()):
+        perm = torch.argsort(index, stable=True)
+        index = index[perm]
+      else:
+        perm = None
+      counts = torch.bincount(index, minlength=self.num_nodes)
+      self.ptr.append(torch.cat([counts.new_zeros(1), torch.cumsum(counts, dim=0)]))
+      self.perm.append(perm)
+
+  def matches(self, edge_index: Tensor) -> bool:
+    return self.edge_index is edge_index
+
+  def normalise(self, fn, src: Tensor, norm_idx: int) -> Tensor:
+    r"""Applies the segment normalisation :obj:`fn(src, index, ptr)` (:obj:`softmax` or :obj:`squareplus`)
+      over the edges grouped by endpoint :obj:`norm_idx`."""
+    perm = self.perm[norm_idx]
+    if perm is None:
+      return fn(src, None, self.ptr[norm_idx])
+    out = torch.empty_like(src)
+    out[perm] = fn(src[perm], None, self.ptr[norm_idx])
+    return out
+
+  def segment_sum(self, src: Tensor, norm_idx: int) -> Tensor:
+    r"""Sums :obj:`src` over the edges grouped by endpoint :obj:`norm_idx` and broadcasts the sums back to
+      the edges, like :obj:`scatter(src, index, reduce='sum')[index]`."""
+    perm = self.perm[norm_idx]
+    ptr = self.ptr[norm_idx]
+    if perm is None:
+      return gather_csr(segment_csr(src, ptr, reduce='sum'), ptr)
+    out = torch.empty_like(src)
+    out[perm] = gather_csr(segment_csr(src[perm], ptr, reduce='sum'), ptr)
+    return out
+
+
+def get_edge_csr(edge_csr: Optional[EdgeCSR], edge_index: Tensor, num_nodes: Optional[int] = None) -> EdgeCSR:
+  r"""Returns :obj:`edge_csr` if it was built for :obj:`edge_index`, otherwise builds a new one. Rewiring assigns
+    new edge index tensors, which invalidates the cache."""
+  if edge_csr is not None and edge_csr.matches(edge_index):
+    return edge_csr
+  return EdgeCSR(edge_index, num_nodes)
+
+
+def get_multihead_index(edge_index: Tensor, heads: int) -> Tensor:
+  r"""Indexes the heads of a multihead attention as the columns of a single sparse matrix.
+
+    Edge :math:`(i, j)` of head :math:`h` becomes the entry :math:`(i, j * H + h)` of a
+    :obj:`num_nodes x (num_nodes * heads)` matrix. The entries are ordered like a flattened
+    :obj:`[E, heads]` attention tensor so the attention can be passed as values without copying.
+
+    Args:
+        edge_index (LongTensor): The edge indices.
+        heads (int): The number of attention heads.
+
+    :rtype: :class:`LongTensor`
+    """
+  head_range = torch.arange(heads, dtype=edge_index.dtype, device=edge_index.device)
+  row = edge_index[0].repeat_interleave(heads)
+  col = (edge_index[1].unsqueeze(1) * heads + head_range).view(-1)
+  return torch.stack([row, col], dim=0)
+
+
+def multihead_spmm(multihead_index: Tensor, attention: Tensor, values: Tensor) -> Tensor:
+  r"""Computes the mean over heads of the per head sparse aggregations :math:`\frac{1}{H}\sum_h A_h V_h`
+    in a single spmm, without materialising the :obj:`[heads, num_nodes, d]` stack of aggregations.
+
+    Args:
+        multihead_index (LongTensor): The output of :meth:`get_multihead_index`.
+        attention (Tensor): The attention weights with shape :obj:`[E, heads]`.
+        values (Tensor): The per head values with shape :obj:`[num_nodes, heads, d]`.
+
+    :rtype: :class:`Tensor`
+    """
+  num_nodes, heads, d = values.shape
+  mean_attention = attention.reshape(-1) / heads
+  return torch_sparse.spmm(multihead_index, mean_attention, num_nodes, num_nodes * heads,
+                           values.reshape(num_nodes * heads, d))
+
+
+class CSRCache(object):
+  r"""The csr matrix of the last graph multiplied by :func:`csr_spmm` with this cache, and the csr matrix of its
+    transpose. The matrices are rebuilt when the edge index or weight tensors are replaced or modified in place.
+    Functions whose graph is fixed over many products keep one, e.g. the ODE function of a :class:`GNNEnsemble`."""
+
+  def __init__(self):
+    self.edge_index = None
+    self.weights = None
+    self.versions = None
+    self.adj = None
+    self.adj_t = None
+
+  def matrices(self, edge_index: Tensor, weights: Tensor, num_nodes: int):
+    versions = (edge_index._version, weights._version)
+    if self.edge_index is not edge_index or self.weights is not weights or self.versions != versions:
+      adj = torch.sparse_coo_tensor(edge_index, weights.detach(), (num_nodes, num_nodes)).coalesce()
+      self.edge_index, self.weights, self.versions = edge_index, weights, versions
+      self.adj, self.adj_t = adj.to_sparse_csr(), adj.t().coalesce().to_sparse_csr()
+    return self.adj, self.adj_t
+
+
+class CSRSpmm(torch.autograd.Function):
+  r"""The product of a fixed csr matrix and :obj:`x`, differentiable in :obj:`x`."""
+
+  @staticmethod
+  def forward(ctx, adj, adj_t, x):
+    ctx.adj, ctx.adj_t = adj, adj_t
+    return adj @ x
+
+  @staticmethod
+  def backward(ctx, grad):
+    return None, None, CSRSpmm.apply(ctx.adj_t, ctx.adj, grad)
+
+
+def csr_spmm(edge_index: Tensor, weights: Tensor, num_nodes: int, x: Tensor, csr_cache: CSRCache) -> Tensor:
+  r"""Computes :math:`A X` like :func:`torch_sparse.spmm` for edge weights that don't need gradients, with a csr
+    matrix instead of gathering and scattering over the edges. The csr matrices of the graph are kept in
+    :obj:`csr_cache`, which makes repeated products with wide :obj:`x` several times faster.
+
+    Args:
+        edge_index (LongTensor): The edge indices.
+        weights (Tensor): The edge weights with shape :obj:`[E]`.
+        num_nodes (int): The number of nodes.
+        x (Tensor): The node features with shape :obj:`[num_nodes, d]`.
+        csr_cache (CSRCache): The csr matrices of the last graph.
+
+    :rtype: :class:`Tensor`
+    """
+  adj, adj_t = csr_cache.matrices(edge_index, weights, num_nodes)
+  return CSRSpmm.apply(adj, adj_t, x)
+
+
+class SharedSpmm(torch.autograd.Function):
+  r"""The sparse product of :func:`shared_spmm`, with a vmap rule that multiplies the features of all the vmapped
+    states by a shared sparse matrix at once instead of one state after the other."""
+
+  @staticmethod
+  def forward(edge_index, weights, num_nodes, x, csr_cache):
+    return torch_sparse.spmm(edge_index, weights, num_nodes, num_nodes, x)
+
+  @staticmethod
+  def setup_context(ctx, inputs, output):
+    edge_index, weights, num_nodes, x, csr_cache = inputs
+    # x is only needed by the gradient of the weights
+    ctx.save_for_backward(edge_index, weights, x if ctx.needs_input_grad[1] else None)
+    ctx.num_nodes = num_nodes
+    ctx.csr_cache = csr_cache
+
+  @staticmethod
+  def backward(ctx, grad):
+    edge_index, weights, x = ctx.saved_tensors
+    grad_weights = grad_x = None
+    if ctx.needs_input_grad[1]:
+      grad_weights = (grad[edge_index[0]] * x[edge_index[1]]).sum(dim=-1)
+    if ctx.needs_input_grad[3]:
+      grad_x = SharedSpmm.apply(edge_index.flip(0), weights, ctx.num_nodes, grad, None)
+    return None, grad_weights, None, grad_x, None
+
+  @staticmethod
+  def vmap(info, in_dims, edge_index, weights, num_nodes, x, csr_cache):
+    index_dim, weights_dim, _, x_dim, _ = in_dims
+    if index_dim is not None or weights_dim is not None:
+      # the states have their own sparse matrices, so they are multiplied one by one
+      def member(tensor, dim, k):
+        return tensor if dim is None else tensor.select(dim, k)
+
+      out = [SharedSpmm.apply(member(edge_index, index_dim, k), member(weights, weights_dim, k), num_nodes,
+                              member(x, x_dim, k), csr_cache) for k in range(info.batch_size)]
+      return torch.stack(out), 0
+    # [num_nodes, batch, d] -> [num_nodes, batch * d], which is a view when the batch is the second dimension
+    x = x.movedim(x_dim, 1)
+    spmm = SharedSpmm.apply if weights.requires_grad or csr_cache is None else csr_spmm
+    out = spmm(edge_index, weights, num_nodes, x.reshape(num_nodes, -1), csr_cache)
+    return out.view(x.shape), 1
+
+
+def shared_spmm(edge_index: Tensor, weights: Tensor, num_nodes: int, x: Tensor,
+                csr_cache: Optional[CSRCache] = None) -> Tensor:
+  r"""Computes the sparse product :math:`A X` of the :obj:`num_nodes x num_nodes` matrix
+    :obj:`(edge_index, weights)` and :obj:`x`, like :func:`torch_sparse.spmm`. Under :func:`torch.func.vmap`
+    a matrix that isn't vmapped is shared by the states, whose features are concatenated and multiplied in a
+    single spmm, with :func:`csr_spmm` if the weights don't need gradients and there is a :obj:`csr_cache`. This
+    needs torch 2, the functions that aren't vmapped use :func:`torch_sparse.spmm` directly.
+
+    Args:
+        edge_index (LongTensor): The edge indices.
+        weights (Tensor): The edge weights with shape :obj:`[E]`.
+        num_nodes (int): The number of nodes.
+        x (Tensor): The node features with shape :obj:`[num_nodes, d]`.
+        csr_cache (CSRCache, optional): The csr matrices of the shared graph. (default: :obj:`None`)
+
+    :rtype: :class:`Tensor`
+    """
+  return SharedSpmm.apply(edge_index, weights, num_nodes, x, csr_cache)
+
+
+def spectral_radius_bound(edge_index: Tensor, edge_weight: Tensor, num_nodes: Optional[int] = None) -> float:
+  r"""Bounds the spectral radius of the sparse matrix :obj:`(edge_index, edge_weight)` by the smaller of its
+    largest absolute row and column sums, which is 1 for random walk normalised adjacencies.
+
+    Args:
+        edge_index (LongTensor): The edge indices.
+        edge_weight (Tensor): The edge weights with shape :obj:`[E]`.
+        num_nodes (int, optional): The number of nodes. (default: :obj:`None`)
+
+    :rtype: float
+    """
+  num_nodes = maybe_num_nodes(edge_index, num_nodes)
+  abs_weight = edge_weight.detach().abs()
+  row_sums = scatter(abs_weight, edge_index[0], dim=0, dim_size=num_nodes, reduce='sum')
+  col_sums = scatter(abs_weight, edge_index[1], dim=0, dim_size=num_nodes, reduce='sum')
+  return min(row_sums.max().item(), col_sums.max().item())
+
+
 # Counter of forward and backward passes.
 class Meter(object):
 
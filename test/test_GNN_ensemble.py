@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Test the GNN ensembles
+"""
+import copy
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import unittest
+import torch
+import torch.nn.functional as F
+from torch.func import vmap
+import torch_sparse
+
+from data import get_dataset, set_train_val_test_split
+from GNN import GNN
+import GNN_ensemble
+from GNN_ensemble import GNNEnsemble
+from utils import get_rw_adj, shared_spmm, CSRCache
+from test_params import OPT
+
+
+class EnsembleTests(unittest.TestCase):
+  def setUp(self):
+    self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    opt = {'dataset': 'Cora', 'self_loop_weight': 1, 'hidden_dim': 6, 'block': 'constant', 'function': 'laplacian',
+           'add_source': True, 'method': 'rk4', 'step_size': 0.5, 'time': 2, 'data_norm': 'rw', 'max_iters': 100,
+           'input_dropout': 0., 'dropout': 0., 'beltrami': False, 'max_nfe': 10000}
+    self.opt = {**OPT, **opt}
+    self.dataset = get_dataset(self.opt, '../data', False)
+    self.data = self.dataset.data.to(self.device)
+    self.size = 3
+
+  def tearDown(self) -> None:
+    pass
+
+  def get_models(self):
+    return [GNN(self.opt, self.dataset, device=self.device) for _ in range(self.size)]
+
+  def test_forward(self):
+    models = self.get_models()
+    ensemble = GNNEnsemble(models)
+    self.assertEqual(len(list(ensemble.parameters())), len(list(models[0].parameters())))
+    ensemble.eval()
+    out = ensemble(self.data.x)
+    self.assertEqual(out.shape, (self.size, self.data.num_nodes, self.dataset.num_classes))
+    for k, model in enumerate(models):
+      model.eval()
+      self.assertTrue(torch.allclose(out[k], model(self.data.x), atol=1e-5))
+
+  def test_gradients(self):
+    models = self.get_models()
+    ensemble = GNNEnsemble(models)
+    ensemble.train()
+    logits = ensemble(self.data.x)
+    mask = self.data.train_mask
+    sum(F.cross_entropy(member_logits[mask], self.data.y[mask]) for member_logits in logits).backward()
+    # each member gets the gradient of its own loss
+    for k, model in enumerate(models):
+      model.train()
+      F.cross_entropy(model(self.data.x)[mask], self.data.y[mask]).backward()
+      for name, param in model.named_parameters():
+        if param.grad is None:
+          # not used by the laplacian function
+          continue
+        self.assertTrue(torch.allclose(getattr(ensemble, name.replace('.', '__')).grad[k], param.grad, atol=1e-5))
+
+  def test_train(self):
+    self.opt['method'] = 'dopri5'
+    models = self.get_models()
+    ensemble = GNNEnsemble(models)
+    datas = [set_train_val_test_split(seed, copy.copy(self.dataset.data), num_development=1500).to(self.device)
+             for seed in range(self.size)]
+    self.assertFalse(torch.equal(datas[0].train_mask, datas[1].train_mask))
+    optimizer = torch.optim.Adam(ensemble.parameters(), lr=0.01)
+    losses = [GNN_ensemble.train_ensemble(ensemble, optimizer, datas) for _ in range(3)]
+    self.assertTrue(losses[-1] < losses[0])
+    self.assertTrue(ensemble.fm.sum > 0)
+    accs = GNN_ensemble.test_ensemble(ensemble, datas)
+    self.assertEqual([len(split_accs) for split_accs in accs], [self.size] * 3)
+    # the trained members can be taken out of the ensemble
+    ensemble.eval()
+    out = ensemble(self.data.x)
+    model = ensemble.unstack()[1]
+    model.eval()
+    self.assertTrue(torch.allclose(out[1], model(self.data.x), atol=1e-4))
+    ensemble.load_member_state_dict(ensemble.member_state_dict(1))
+    self.assertTrue(torch.allclose(ensemble.m1__weight[0], model.m1.weight))
+
+  def test_shared_spmm(self):
+    edge_index, edge_weight = get_rw_adj(self.data.edge_index, norm_dim=1, fill_value=1,
+                                         num_nodes=self.data.num_nodes, dtype=self.data.x.dtype)
+    num_nodes = self.data.num_nodes
+    x = torch.rand(self.size, num_nodes, 4, device=self.device, requires_grad=True)
+    weights = edge_weight.expand(self.size, -1).clone().requires_grad_()
+    expected = torch.stack([torch_sparse.spmm(edge_index, edge_weight, num_nodes, num_nodes, member) for member in x])
+    # a shared graph with fixed weights, and a graph with weights for each member that need gradients
+    out = vmap(shared_spmm, in_dims=(None, None, None, 0))(edge_index, edge_weight, num_nodes, x)
+    self.assertTrue(torch.allclose(out, expected, atol=1e-6))
+    # with a csr cache the fixed weights are multiplied as a csr matrix, which is built once
+    csr_cache = CSRCache()
+    csr_spmm = vmap(shared_spmm, in_dims=(None, None, None, 0, None))
+    csr_spmm(edge_index, edge_weight, num_nodes, x, csr_cache)
+    adj = csr_cache.adj
+    out_csr = csr_spmm(edge_index, edge_weight, num_nodes, x, csr_cache)
+    self.assertTrue(csr_cache.adj is adj)
+    self.assertTrue(torch.allclose(out_csr, expected, atol=1e-6))
+    grad_x, = torch.autograd.grad(out_csr.square().sum(), x)
+    expected_grad_x, = torch.autograd.grad(expected.square().sum(), x, retain_graph=True)
+    self.assertTrue(torch.allclose(grad_x, expected_grad_x, atol=1e-5))
+    out_weights = vmap(shared_spmm, in_dims=(None, 0, None, 0))(edge_index, weights, num_nodes, x)
+    self.assertTrue(torch.allclose(out_weights, expected, atol=1e-6))
+    grad_x, = torch.autograd.grad(out.square().sum(), x)
+    expected_grad_x, = torch.autograd.grad(expected.square().sum(), x)
+    self.assertTrue(torch.allclose(grad_x, expected_grad_x, atol=1e-5))
+    grad_weights, = torch.autograd.grad(out_weights.square().sum(), weights)
+    expected_grad_weights = torch.stack([torch.autograd.grad(
+      torch_sparse.spmm(edge_index, w, num_nodes, num_nodes, member).square().sum(), w)[0]
+      for w, member in zip(edge_weight.expand(self.size, -1).clone().requires_grad_(), x)])
+    self.assertTrue(torch.allclose(grad_weights, expected_grad_weights, atol=1e-5))
+
+
+if __name__ == '__main__':
+  unittest.main()
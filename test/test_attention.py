@@ -107,6 +107,28 @@ class AttentionTests:
     print(out.shape)
     #self.assertTrue(out.shape == (dataset.data.num_nodes, dataset.num_features))
     
+
+class GATScoreTests(unittest.TestCase):
+  def test_decomposed_scores(self):
+    edge = tensor([[0, 2, 2, 1, 0], [1, 0, 1, 2, 0]])
+    x = torch.rand((3, 4))
+    opt = {**OPT, 'heads': 2, 'attention_dim': 8, 'leaky_relu_slope': 0.2, 'attention_norm_idx': 0}
+    att_layer = SpGraphAttentionLayer(4, 4, opt, torch.device('cpu'))
+    attention, _ = att_layer(x, edge)
+    attention.sum(dim=1).pow(2).sum().backward()
+    grads = att_layer.a.grad.clone(), att_layer.W.grad.clone()
+    att_layer.zero_grad()
+    # reference: score the concatenated features of both ends of every edge
+    h = torch.mm(x, att_layer.W).view(-1, att_layer.h, att_layer.d_k).transpose(1, 2)
+    edge_h = torch.cat((h[edge[0, :], :, :], h[edge[1, :], :, :]), dim=1).transpose(0, 1)
+    edge_e = att_layer.leakyrelu(torch.sum(att_layer.a * edge_h, dim=0))
+    ref_attention = softmax(edge_e, edge[opt['attention_norm_idx']])
+    ref_attention.sum(dim=1).pow(2).sum().backward()
+    self.assertTrue(torch.allclose(attention, ref_attention))
+    self.assertTrue(torch.allclose(grads[0], att_layer.a.grad, atol=1e-6))
+    self.assertTrue(torch.allclose(grads[1], att_layer.W.grad, atol=1e-6))
+
+
 ob = AttentionTests()
 ob.setUp()
 ob.test_function()
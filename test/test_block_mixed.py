@@ -79,6 +79,21 @@ class MixedODEBlockTests(unittest.TestCase):
     mixed_att_test = (1 - gamma) * att_arr + gamma * rw_arr
     self.assertTrue(np.allclose(mixed_att, mixed_att_test))
 
+  def test_imex(self):
+    self.opt['heads'] = 1
+    self.opt['hidden_dim'] = 2
+    self.opt['time'] = 3.
+    self.opt['method'] = 'imex'
+    self.opt['step_size'] = 0.05
+    gnn = GNN(self.opt, DummyDataset(self.data, 3), device=self.device)
+    odeblock = gnn.odeblock
+    odeblock.gamma.data.fill_(0.5)
+    odeblock.set_x0(self.x)
+    out = odeblock(self.x)
+    # the attention is treated explicitly and the gamma weighted Laplacian implicitly
+    self.opt['method'] = 'dopri5'
+    self.assertTrue(torch.allclose(out, odeblock(self.x), atol=1e-3))
+
   def test_block_cora(self):
     data = self.dataset.data
     self.opt['hidden_dim'] = self.dataset.num_features
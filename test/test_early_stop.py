@@ -17,6 +17,7 @@ from function_laplacian_diffusion import LaplacianODEFunc
 from GNN_early import GNNEarly
 from block_constant import ConstantODEblock
 from utils import get_rw_adj
+from early_stop_solver_with_gear2 import EarlyStopEvaluator
 from test_params import OPT
 
 
@@ -67,10 +68,25 @@ class EarlyStopTests(unittest.TestCase):
     gnn.eval()
     gnn.set_solver_m2()
     gnn.set_solver_data(data)
-    out = odeblock(data.x)
+    # as in test(), without the graph of the early stopping solve
+    with torch.no_grad():
+      out = odeblock(data.x)
     print('ode block out', out)
     self.assertTrue(data.x.shape == out.shape)
 
+  def test_gnn_best_state(self):
+    data = self.dataset.data
+    gnn = GNNEarly(self.opt, self.dataset, device=self.device)
+    gnn.eval()
+    with torch.no_grad():
+      gnn(data.x)
+      z = gnn.forward_ODE(data.x, None)
+    # the embedding of the eval model is the state kept at the best val time, not the state at the end of the solve
+    integrator = gnn.odeblock.test_integrator
+    self.assertTrue(z is integrator.best_state)
+    self.assertEqual(integrator.evaluator.accuracies(z[integrator.evaluator.rows]).tolist(),
+                     integrator.evaluator.best()[:3])
+
   def test_rk4(self):
     data = self.dataset.data
     t = 1
@@ -99,6 +115,68 @@ class EarlyStopTests(unittest.TestCase):
     print('ode block out', out)
     self.assertTrue(data.x.shape == out.shape)
 
+  def test_gear2(self):
+    data = self.dataset.data
+    self.opt['method'] = 'gear2'
+    self.opt['step_size'] = 0.5
+    gnn = GNNEarly(self.opt, self.dataset, device=self.device)
+    odeblock = gnn.odeblock
+    gnn.train()
+    out = odeblock(data.x)
+    self.assertTrue(data.x.shape == out.shape)
+    gnn.eval()
+    gnn.set_solver_m2()
+    gnn.set_solver_data(data)
+    out = odeblock(data.x)
+    self.assertTrue(data.x.shape == out.shape)
+    self.assertTrue(odeblock.test_integrator.solver.best_val > 0)
+
+  def test_evaluator(self):
+    data = self.dataset.data
+    evaluator = EarlyStopEvaluator(data)
+    m2 = nn.Linear(data.num_features, self.dataset.num_classes)
+    evaluator.reset(m2.weight.data, m2.bias.data)
+    z = torch.randn(data.x.shape)
+    with torch.no_grad():
+      pred = m2(torch.relu(z)).argmax(dim=1)
+    accs = [pred[mask].eq(data.y[mask]).sum().item() / mask.sum().item()
+            for mask in (data.train_mask, data.val_mask, data.test_mask)]
+    self.assertTrue(torch.allclose(evaluator.accuracies(z[evaluator.rows]),
+                                   torch.tensor(accs, dtype=torch.float64)))
+    # the best accuracies only change when the val accuracy improves
+    evaluator.update(z, torch.tensor(1.))
+    evaluator.update(z, torch.tensor(2.))
+    self.assertTrue(torch.allclose(torch.tensor(evaluator.best(), dtype=torch.float64),
+                                   torch.tensor(accs + [1.], dtype=torch.float64)))
+
+  def test_dense_evaluator(self):
+    data = self.dataset.data
+    good = 10 * nn.functional.one_hot(data.y, self.dataset.num_classes).float()
+    bad = 10 * nn.functional.one_hot((data.y + 1) % self.dataset.num_classes, self.dataset.num_classes).float()
+    # a quadratic step from and to the wrong classes that passes through the right ones at its middle
+    coefficients = [bad, 4 * (good - bad), -4 * (good - bad)]
+    eye = torch.eye(self.dataset.num_classes)
+    for points, best in [(1, [0., 0., 0., 0.]), (4, [1., 1., 1., 0.25])]:
+      evaluator = EarlyStopEvaluator(data, points)
+      evaluator.reset(eye, torch.zeros(self.dataset.num_classes))
+      evaluator.update(bad, torch.tensor(1.), torch.tensor(0.), coefficients)
+      self.assertEqual(evaluator.best(), best)
+    self.assertTrue(torch.allclose(evaluator.best_y, bad + 0.75 * (good - bad)))
+
+  def test_solver_reuse(self):
+    self.opt['method'] = 'rk4'
+    gnn = GNNEarly(self.opt, self.dataset, device=self.device)
+    gnn.eval()
+    gnn(self.dataset.data.x)
+    integrator = gnn.odeblock.test_integrator
+    solver = integrator.solver
+    best_val = solver.best_val
+    gnn(self.dataset.data.x)
+    # the second pass solves again with the same solver and the same decoder, instead of copies of them
+    self.assertTrue(integrator.solver is solver)
+    self.assertEqual(solver.best_val, best_val)
+    self.assertEqual(integrator.m2_weight.data_ptr(), gnn.m2.weight.data_ptr())
+
   def test_gnn(self):
     gnn = GNNEarly(self.opt, self.dataset, device=self.device)
     gnn.train()
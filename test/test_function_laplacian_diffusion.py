@@ -15,9 +15,13 @@ from data import get_dataset
 from function_laplacian_diffusion import LaplacianODEFunc
 from GNN import GNN
 from block_constant import ConstantODEblock
+from base_classes import ODEFunc, MAX_SOLVER_PLANS, STEP_CONTROLLERS
 from torch_geometric.data import Data
 from torch_geometric.utils import to_dense_adj
 from utils import get_rw_adj, get_sym_adj
+from torchdiffeq import odeint, odeint_adjoint
+from torchdiffeq._impl.chebyshev import ChebyshevSolver
+from torchdiffeq._impl.misc import _optimal_step_size, _fused_error_ratio, _compute_error_ratio, _rms_norm
 from test_params import OPT
 
 
@@ -55,6 +59,21 @@ class FunctionLaplacianDiffusionTests(unittest.TestCase):
   def tearDown(self) -> None:
     pass
 
+  def assertMatchesHeatKernel(self, opt, atol, inference=False, msg=None):
+    """Solves the block built from opt from self.x, and compares the solution to exp(time * alpha (A - I)) x, the
+    solution of the laplacian diffusion. Returns the block"""
+    gnn = GNN(opt, DummyDataset(self.data, 3), device=self.device)
+    gnn.train(not inference)
+    odeblock = gnn.odeblock
+    func = odeblock.odefunc
+    odeblock.set_x0(self.x)
+    with torch.set_grad_enabled(not inference):
+      out = odeblock(self.x)
+    adj = to_dense_adj(func.edge_index, edge_attr=func.edge_weight).squeeze()
+    generator = torch.sigmoid(func.alpha_train) * (adj - torch.eye(3))
+    self.assertTrue(torch.allclose(out, torch.linalg.matrix_exp(opt['time'] * generator) @ self.x, atol=atol), msg)
+    return odeblock
+
   def test_block_toy(self):
     # construct a pyg dataset
     num_nodes = 3
@@ -84,6 +103,290 @@ class FunctionLaplacianDiffusionTests(unittest.TestCase):
     self.assertTrue(np.allclose(test_sym_adj, sym_adj.numpy().squeeze()))
     print('sym adjacency', sym_adj)
 
+  def test_expm_multiply(self):
+    self.assertMatchesHeatKernel({**self.opt, 'method': 'expm_multiply', 'time': 3.}, atol=1e-5)
+
+  def test_chebyshev(self):
+    opt = {**self.opt, 'method': 'chebyshev', 'time': 3.}
+    odeblock = self.assertMatchesHeatKernel(opt, atol=1e-5)
+    func = odeblock.odefunc
+    # the number of terms is fixed by the time and the tolerance
+    n_terms = len(ChebyshevSolver(func, self.x, odeblock.rtol, odeblock.atol,
+                                  spectral_interval=func.spectral_interval(odeblock.adj_bound)).coefficients(3.)[0])
+    self.assertEqual(func.nfe, n_terms)
+    # the other functions have no spectral interval, and the mixed attention can have a complex spectrum
+    with self.assertRaises(NotImplementedError):
+      GNN({**opt, 'function': 'transformer'}, DummyDataset(self.data, 3), device=self.device)
+    with self.assertRaises(NotImplementedError):
+      GNN({**opt, 'block': 'mixed'}, DummyDataset(self.data, 3), device=self.device)
+    # beta_train starts at 0, where the source term is zero but has a gradient
+    grads = []
+    for method in ['chebyshev', 'dopri5']:
+      gnn = GNN({**opt, 'method': method, 'add_source': True}, DummyDataset(self.data, 3), device=self.device)
+      gnn.odeblock.set_x0(self.x)
+      gnn.odeblock(self.x).sum().backward()
+      grads.append(gnn.odeblock.odefunc.beta_train.grad)
+    self.assertTrue(grads[1].abs() > 1)
+    self.assertTrue(torch.allclose(grads[0], grads[1], rtol=1e-4))
+
+  def test_bdf(self):
+    for method in ['implicit_euler', 'bdf2', 'bdf3']:
+      self.assertMatchesHeatKernel({**self.opt, 'method': method, 'time': 3., 'step_size': 0.05}, atol=1e-2,
+                                   msg=method)
+
+  def test_bdf_gradients(self):
+    # func closes over w, which isn't one of its parameters, like the attention weights computed by the blocks
+    adj = to_dense_adj(self.edge1).squeeze().double() / 2
+    x = self.x.double()
+    w = torch.tensor(0.7, dtype=torch.float64, requires_grad=True)
+    t = torch.tensor([0., 1.], dtype=torch.float64)
+
+    def func(t, y):
+      return w * (adj @ y) - y
+
+    for method in ['implicit_euler', 'bdf2']:
+      def loss():
+        return odeint(func, x, t, method=method, options=dict(step_size=0.25), rtol=1e-12, atol=1e-12)[-1].pow(2).sum()
+
+      grad, = torch.autograd.grad(loss(), w)
+      eps = 1e-4
+      with torch.no_grad():
+        w += eps
+        up = loss()
+        w -= 2 * eps
+        down = loss()
+        w += eps
+      self.assertTrue(torch.isclose(grad, (up - down) / (2 * eps), rtol=1e-6), method)
+
+  def test_etdrk(self):
+    for method, step_size in [('etdrk2', 0.1), ('etdrk4', 0.5)]:
+      self.assertMatchesHeatKernel({**self.opt, 'method': method, 'time': 3., 'step_size': step_size}, atol=1e-2,
+                                   msg=method)
+
+    # a function without a linear part is rejected when the block is built
+    class NonlinearODEFunc(ODEFunc):
+      def __init__(self, in_features, out_features, opt, data, device):
+        super(NonlinearODEFunc, self).__init__(opt, data, device)
+
+      def forward(self, t, x):
+        return torch.tanh(x)
+
+    for method in ['etdrk2', 'imex']:
+      with self.assertRaises(NotImplementedError):
+        ConstantODEblock(NonlinearODEFunc, [], {**self.opt, 'method': method}, self.data, self.device)
+
+  def test_multirate(self):
+    odeblock = self.assertMatchesHeatKernel({**self.opt, 'method': 'multirate', 'time': 3., 'step_size': 0.1},
+                                            atol=1e-2)
+    func = odeblock.odefunc
+    # the rows aggregate over the edges into them only
+    rows = tensor([0, 2])
+    self.assertTrue(torch.allclose(func.forward_rows(0., self.x, rows), func(0., self.x)[rows]))
+    # given the state on the rows they read only, here node 1 and the rows themselves
+    rows = tensor([0])
+    sources = func.row_sources(rows, 3)
+    self.assertEqual(sources.tolist(), [0, 1])
+    self.assertTrue(torch.allclose(func.forward_rows(0., self.x[sources], rows), func(0., self.x)[rows]))
+    options = odeblock.add_func_options({'step_size': 0.1}, self.x)
+    self.assertTrue(options['row_sources'] == func.row_sources)
+    outs = []
+    for row_sources in [func.row_sources, None]:
+      func.nfe = 0
+      # a tolerance that puts some of the rows in faster rate classes
+      outs.append(odeint(func, self.x, tensor([0, 3.]), method='multirate',
+                         options=dict(options, row_sources=row_sources), atol=1e-4, rtol=0)[1])
+    self.assertTrue(torch.allclose(*outs))
+
+  def test_parareal(self):
+    opt = {**self.opt, 'method': 'parareal', 'time': 3., 'step_size': 0.5, 'parareal_slices': 3,
+           'parareal_workers': 2}
+    # the slices are solved by dopri5 in worker processes
+    self.assertMatchesHeatKernel(opt, atol=1e-5, inference=True)
+
+  def test_step_controller(self):
+    for step_controller in ['pi', 'pid']:
+      opt = {**self.opt, 'method': 'dopri5', 'time': 3., 'step_controller': step_controller, 'fused_norm': True}
+      self.assertMatchesHeatKernel(opt, atol=1e-5, msg=step_controller)
+
+    last_step = tensor(0.1, dtype=torch.float64)
+    safety, ifactor, dfactor = tensor([0.9, 10., 0.2], dtype=torch.float64)
+    prev_error_ratios = tuple(tensor([0.8, 1.2], dtype=torch.float64))
+    for step_controller, (pcoeff, icoeff, dcoeff) in STEP_CONTROLLERS.items():
+      # the controller of Soderlind with the error ratios e_n = 0.5, e_{n-1} = 0.8, e_{n-2} = 1.2 of a 5th order method
+      expected = 0.1 * 0.9 * 0.5 ** (-(pcoeff + icoeff + dcoeff) / 5) * 0.8 ** ((pcoeff + 2 * dcoeff) / 5) \
+                 * 1.2 ** (-dcoeff / 5)
+      step = _optimal_step_size(last_step, tensor(0.5, dtype=torch.float64), safety, ifactor, dfactor, 5, prev_error_ratios,
+                                (pcoeff, icoeff, dcoeff))
+      self.assertAlmostEqual(step.item(), expected, places=12, msg=step_controller)
+      # a rejected step never grows, although here the small e_{n-2} would grow it with the derivative gain
+      for error_ratio in [1.0001, 1.5, 100.]:
+        step = _optimal_step_size(last_step, tensor(error_ratio, dtype=torch.float64), tensor(1.), ifactor, dfactor,
+                                  5, tuple(tensor([1., 1e-4], dtype=torch.float64)), (pcoeff, icoeff, dcoeff))
+        self.assertLessEqual(step.item(), last_step.item(), step_controller)
+        self.assertGreaterEqual(step.item(), dfactor.item() * last_step.item(), step_controller)
+
+    # the fused error ratio is the rms norm of the scaled error
+    torch.manual_seed(0)
+    y0, y1, error = torch.randn(3, 10, 4)
+    rtol, atol = tensor(1e-3, dtype=torch.float64), tensor(1e-6, dtype=torch.float64)
+    self.assertTrue(torch.allclose(_fused_error_ratio(error, rtol, atol, y0, y1),
+                                   _compute_error_ratio(error, rtol, atol, y0, y1, _rms_norm)))
+
+  def test_buffered(self):
+    for method in ['euler', 'midpoint', 'rk4']:
+      opt = {**self.opt, 'method': method, 'time': 3., 'step_size': 0.25}
+      gnn = GNN(opt, DummyDataset(self.data, 3), device=self.device)
+      odeblock = gnn.odeblock
+      odeblock.set_x0(self.x)
+      gnn.eval()
+      with torch.no_grad():
+        out = odeblock(self.x)
+        odeblock.opt['buffered'] = True
+        # the steps update the state in place, with the output between the last two steps interpolated
+        odeblock.t = tensor([0, 2.9])
+        self.assertTrue(torch.allclose(odeblock(self.x), odeint(odeblock.odefunc, self.x, odeblock.t, method=method,
+                                                                options={'step_size': 0.25})[1]))
+        odeblock.t = tensor([0, 3.])
+        self.assertTrue(torch.allclose(odeblock(self.x), out))
+    # the other solvers have no buffered mode
+    for method in ['dopri5', 'implicit_adams']:
+      with self.assertRaises(NotImplementedError):
+        GNN({**self.opt, 'method': method, 'buffered': True}, DummyDataset(self.data, 3), device=self.device)
+    with self.assertRaises(ValueError):
+      odeint(lambda t, x: -x, self.x, tensor([0, 1.]), method='implicit_adams', options={'buffered': True})
+
+  def test_adams(self):
+    odeblock = self.assertMatchesHeatKernel({**self.opt, 'method': 'implicit_adams', 'time': 3., 'step_size': 0.05},
+                                            atol=1e-4)
+    func = odeblock.odefunc
+    # 2 rk4 steps and 58 adams steps, the corrector only iterates while the steps left fit in max_nfe
+    func.nfe = 0
+    odeblock.opt['max_nfe'] = 2 * 60 + 3 * 3
+    odeblock(self.x)
+    self.assertEqual(func.nfe, odeblock.opt['max_nfe'])
+
+  def test_warm_start(self):
+    opt = {**self.opt, 'method': 'dopri5', 'time': 3.}
+    gnn = GNN(opt, DummyDataset(self.data, 3), device=self.device)
+    odeblock = gnn.odeblock
+    odeblock.set_x0(self.x)
+    nfes = []
+    for _ in range(2):
+      odeblock(self.x)
+      nfes.append(gnn.getNFE())
+      gnn.resetNFE()
+    # the second solve starts from the step size the first one found, instead of selecting one
+    self.assertEqual(odeblock.get_step_stats(), (0, 1))
+    self.assertTrue(nfes[1] < nfes[0])
+    self.assertEqual(odeblock.get_step_stats(reset=True), (0, 1))
+    self.assertEqual(odeblock.get_step_stats(), (0, 0))
+
+  def test_checkpoint(self):
+    # the attention block computes the attention weights before the solve, and the function closes over them
+    for block in ['constant', 'attention']:
+      opt = {**self.opt, 'block': block, 'method': 'rk4', 'step_size': 0.25, 'grad_mode': 'checkpoint',
+             'checkpoints': 2}
+      gnn = GNN(opt, DummyDataset(self.data, 3), device=self.device)
+      odeblock = gnn.odeblock
+      x = torch.rand(3, opt['hidden_dim'])
+      odeblock.set_x0(x)
+      grads = []
+      for integrator in (odeblock.train_integrator, odeint):
+        odeblock.train_integrator = integrator
+        odeblock.zero_grad()
+        odeblock(x).pow(2).sum().backward()
+        grads.append([torch.zeros_like(param) if param.grad is None else param.grad.clone()
+                      for param in odeblock.parameters()])
+      # replaying the 4 steps from 2 checkpoints gives the gradient of backpropagating through the solver
+      self.assertTrue(all(torch.allclose(grad, reference, atol=1e-6) for grad, reference in zip(*grads)), block)
+    with self.assertRaises(ValueError):
+      GNN({**self.opt, 'grad_mode': 'checkpoint', 'adjoint': True, 'adjoint_method': 'rk4', 'tol_scale_adjoint': 1},
+          DummyDataset(self.data, 3), device=self.device)
+
+  def test_adjoint(self):
+    opt = {**self.opt, 'method': 'dopri5', 'time': 3., 'adjoint': True, 'adjoint_method': 'dopri5',
+           'adjoint_step_size': 1, 'tol_scale_adjoint': 1}
+    gnn = GNN(opt, DummyDataset(self.data, 3), device=self.device)
+    odeblock = gnn.odeblock
+    odeblock.set_x0(self.x)
+    grads = []
+    for adjoint in (True, False):
+      odeblock.opt['adjoint'] = adjoint
+      odeblock.train_integrator = odeint_adjoint if adjoint else odeint
+      odeblock.zero_grad()
+      odeblock(self.x).pow(2).sum().backward()
+      grads.append(odeblock.odefunc.alpha_train.grad.clone())
+    # the parameter vjps are integrated by quadrature outside the adjoint state
+    self.assertTrue(torch.allclose(grads[0], grads[1], rtol=1e-4))
+
+  def test_adjoint_quadrature(self):
+    class ForcedDecay(nn.Module):
+      def __init__(self):
+        super(ForcedDecay, self).__init__()
+        self.w = nn.Parameter(torch.tensor(0.1, dtype=torch.float64))
+
+      def forward(self, t, y):
+        return -self.w * y + torch.cos(3 * t)
+
+    func = ForcedDecay()
+    y0 = tensor([1.], dtype=torch.float64)
+    t = tensor([0., 40.], dtype=torch.float64)
+    # the vjp of w oscillates over the single long output interval, which the adaptive solver integrates on each of
+    # its steps, and the fixed grid solver carries in its state
+    for method, options in [('dopri5', None), ('rk4', {'step_size': 0.05})]:
+      grads = []
+      for integrator in (odeint_adjoint, odeint):
+        func.zero_grad()
+        integrator(func, y0, t, method=method, options=options, rtol=1e-10, atol=1e-10)[-1].sum().backward()
+        grads.append(func.w.grad.clone())
+      self.assertTrue(torch.allclose(grads[0], grads[1], rtol=1e-6), method)
+
+  def test_adjoint_nfe(self):
+    opt = {**self.opt, 'method': 'rk4', 'step_size': 0.1, 'adjoint': True, 'adjoint_method': 'rk4',
+           'adjoint_step_size': 0.1, 'tol_scale_adjoint': 1, 'max_nfe': 1000}
+    gnn = GNN(opt, DummyDataset(self.data, 3), device=self.device)
+    odeblock = gnn.odeblock
+    odeblock.set_x0(self.x)
+    out = odeblock(self.x)
+    odeblock.odefunc.nfe = 0
+    out.pow(2).sum().backward()
+    # the parameter vjps are computed from the stage evaluations of the 10 backward steps, not from extra evaluations
+    self.assertEqual(odeblock.odefunc.nfe, 4 * 10)
+    self.assertIsNotNone(odeblock.odefunc.alpha_train.grad)
+
+  def test_solver_plan(self):
+    for method in ['rk4', 'etdrk4', 'dopri5']:
+      opt = {**self.opt, 'method': method, 'time': 3., 'step_size': 0.25}
+      gnn = GNN(opt, DummyDataset(self.data, 3), device=self.device)
+      odeblock = gnn.odeblock
+      odeblock.set_x0(self.x)
+      for alpha in [0., 1.]:
+        # the linear part of etdrk4 depends on alpha, so it is passed to each solve of the plan
+        odeblock.odefunc.alpha_train.data.fill_(alpha)
+        options = odeblock.add_step_options(odeblock.add_func_options({'step_size': 0.25}, self.x))
+        out = odeint(odeblock.odefunc, self.x, odeblock.t, method=method, options=options, atol=odeblock.atol,
+                     rtol=odeblock.rtol)[1]
+        self.assertTrue(torch.allclose(odeblock(self.x), out))
+      self.assertEqual(len(odeblock.solver_plans), 1)
+      # the plans are cached on the times of the block
+      odeblock.t = tensor([0, 2.])
+      out = odeint(odeblock.odefunc, self.x, odeblock.t, method=method, options=options, atol=odeblock.atol,
+                   rtol=odeblock.rtol)[1]
+      self.assertTrue(torch.allclose(odeblock(self.x), out))
+      self.assertEqual(len(odeblock.solver_plans), 2)
+    # a plan for each number of nodes, e.g. of the batches of mini-batch training, up to MAX_SOLVER_PLANS of them
+    for num_nodes in range(1, 2 * MAX_SOLVER_PLANS):
+      x = torch.rand(num_nodes, self.x.shape[1])
+      odeblock.odefunc.edge_index = torch.stack([torch.arange(num_nodes), torch.arange(num_nodes)])
+      odeblock.odefunc.edge_weight = torch.ones(num_nodes)
+      odeblock.set_x0(x)
+      odeblock(x)
+      self.assertTrue(len(odeblock.solver_plans) <= MAX_SOLVER_PLANS)
+    # the plan of the last solve is kept and reused
+    plans = {id(plan) for _, plan in odeblock.solver_plans.values()}
+    odeblock(x)
+    self.assertEqual({id(plan) for _, plan in odeblock.solver_plans.values()}, plans)
+
   def test_block_cora(self):
     data = self.dataset.data
     self.opt['hidden_dim'] = self.dataset.num_features
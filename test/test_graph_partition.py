@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Test the mini-batch training on graph partitions
+"""
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import unittest
+import torch
+
+from data import get_dataset
+from GNN import GNN
+from GNN_early import GNNEarly
+import graph_partition
+from graph_partition import ClusterLoader, partition_graph
+from test_params import OPT
+
+
+class GraphPartitionTests(unittest.TestCase):
+  def setUp(self):
+    self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    opt = {'dataset': 'Cora', 'self_loop_weight': 1, 'hidden_dim': 16, 'heads': 2, 'attention_dim': 16,
+           'method': 'rk4', 'step_size': 1, 'time': 2, 'max_nfe': 100000, 'earlystopxT': 2, 'use_flux': False,
+           'new_edges': 'random', 'sparsify': 'S_hat', 'rw_addD': 0.02, 'rw_rmvR': 0.02, 'beltrami': False,
+           'function': 'laplacian'}
+    self.opt = {**OPT, **opt}
+    self.dataset = get_dataset(self.opt, '../data', False)
+    self.data = self.dataset.data.to(self.device)
+    self.num_parts = 8
+
+  def tearDown(self) -> None:
+    pass
+
+  def test_partition(self):
+    part = partition_graph(self.data.edge_index, self.data.num_nodes, self.num_parts)
+    self.assertEqual(part.shape, (self.data.num_nodes,))
+    counts = torch.bincount(part, minlength=self.num_parts)
+    self.assertEqual(len(counts), self.num_parts)
+    self.assertTrue(counts.max() < self.data.num_nodes / 2)
+    # the clusters keep more of the edges than a random partition
+    row, col = self.data.edge_index.cpu()
+    self.assertTrue((part[row] == part[col]).float().mean() > 1 / self.num_parts)
+
+  def test_loader(self):
+    loader = ClusterLoader(self.data, self.num_parts, clusters_per_batch=2)
+    self.assertEqual(len(loader), self.num_parts // 2)
+    batches = list(loader)
+    self.assertEqual(len(batches), len(loader))
+    n_id = torch.cat([batch.n_id for batch in batches])
+    self.assertTrue(torch.equal(n_id.sort()[0], torch.arange(self.data.num_nodes, device=self.device)))
+    edges = set(map(tuple, self.data.edge_index.t().tolist()))
+    for batch in batches:
+      self.assertEqual(batch.x.shape, (len(batch.n_id), self.data.num_features))
+      self.assertTrue(batch.edge_index.max() < len(batch.n_id))
+      # the edges of the batch are edges of the graph between its nodes
+      global_edges = batch.n_id[batch.edge_index]
+      self.assertTrue(set(map(tuple, global_edges.t().tolist())) <= edges)
+      self.assertTrue(torch.equal(batch.train_mask, self.data.train_mask[batch.n_id]))
+
+  def test_train(self):
+    loader = ClusterLoader(self.data, self.num_parts, clusters_per_batch=2)
+    for block in ['constant', 'mixed', 'attention', 'hard_attention']:
+      for model_class in [GNN, GNNEarly]:
+        opt = {**self.opt, 'block': block}
+        model = model_class(opt, self.dataset, device=self.device).to(self.device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+        losses = [graph_partition.train_partitioned(model, optimizer, loader) for _ in range(3)]
+        self.assertTrue(losses[-1] < losses[0], '{} {}'.format(block, model_class.__name__))
+        self.assertTrue(model.fm.sum > 0)
+        accs = graph_partition.test_partitioned(model, loader)
+        self.assertEqual(len(accs), 3)
+        self.assertTrue(all(0 <= acc <= 1 for acc in accs))
+        # the block was left with the graph of the last batch
+        self.assertTrue(model.odeblock.odefunc.edge_index.max() < self.data.num_nodes)
+
+  def test_rewiring_inference(self):
+    loader = ClusterLoader(self.data, self.num_parts, clusters_per_batch=2, shuffle=False)
+    opt = {**self.opt, 'block': 'rewire_attention'}
+    model = GNN(opt, self.dataset, device=self.device).to(self.device)
+    accs = graph_partition.test_partitioned(model, loader)
+    self.assertTrue(all(0 <= acc <= 1 for acc in accs))
+    # the nodes of the block are those of the last batch
+    last_batch = list(loader)[-1]
+    self.assertEqual(model.odeblock.num_nodes, len(last_batch.n_id))
+
+  def test_set_graph(self):
+    model = GNN({**self.opt, 'block': 'attention'}, self.dataset, device=self.device)
+    edge_index = model.odeblock.odefunc.edge_index.clone()
+    batch = next(iter(ClusterLoader(self.data, self.num_parts)))
+    model.odeblock.set_graph(batch)
+    self.assertTrue(model.odeblock.odefunc.edge_index.max() < len(batch.n_id))
+    model.odeblock.set_graph(self.data)
+    self.assertTrue(torch.equal(model.odeblock.odefunc.edge_index, edge_index))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -14,10 +14,12 @@ from torch import nn
 import torch_sparse
 from torch_geometric.utils import softmax, to_dense_adj
 
-from function_transformer_attention import SpGraphTransAttentionLayer, ODEFuncTransformerAtt
+from function_transformer_attention import SpGraphTransAttentionLayer, ODEFuncTransformerAtt, edge_dot, \
+  edge_sq_dist, unit_norm
 from data import get_dataset
 from test_params import OPT
-from utils import ROOT_DIR
+from utils import ROOT_DIR, get_multihead_index, multihead_spmm, squareplus, EdgeCSR, get_edge_csr, DummyData
+from torchdiffeq import odeint, odeint_adjoint
 
 class AttentionTests(unittest.TestCase):
   def setUp(self):
@@ -120,6 +122,114 @@ class AttentionTests(unittest.TestCase):
     ax2 = torch_sparse.spmm(self.edge, mean_attention, self.x.shape[0], self.x.shape[0], self.x)
     self.assertTrue(torch.all(torch.isclose(ax1,ax2)))
 
+  def test_multihead_spmm(self):
+    heads = 4
+    attention = torch.rand((self.edge.shape[1], heads))
+    v = torch.rand((self.x.shape[0], 3, heads))
+    ax1 = torch.mean(torch.stack(
+        [torch_sparse.spmm(self.edge, attention[:, idx], self.x.shape[0], self.x.shape[0], v[:, :, idx]) for idx in
+         range(heads)], dim=0), dim=0)
+    ax2 = multihead_spmm(get_multihead_index(self.edge, heads), attention, v.transpose(1, 2))
+    self.assertTrue(ax2.shape == (self.x.shape[0], 3))
+    self.assertTrue(torch.allclose(ax1, ax2))
+
+  def test_edge_scores(self):
+    n_nodes, d_k, heads = 5, 3, 2
+    edge = torch.randint(0, n_nodes, (2, 12))
+    q = torch.rand((n_nodes, d_k, heads), dtype=torch.double, requires_grad=True)
+    k = torch.rand((n_nodes, d_k, heads), dtype=torch.double, requires_grad=True)
+    src = q[edge[0, :], :, :]
+    dst_k = k[edge[1, :], :, :]
+    self.assertTrue(torch.allclose(edge_dot(q, k, edge), torch.sum(src * dst_k, dim=1)))
+    self.assertTrue(torch.allclose(edge_sq_dist(q, k, edge), torch.sum((src - dst_k) ** 2, dim=1)))
+    cos = torch.nn.CosineSimilarity(dim=1, eps=1e-5)
+    self.assertTrue(torch.allclose(edge_dot(unit_norm(q), unit_norm(k), edge), cos(src, dst_k)))
+    self.assertTrue(torch.autograd.gradcheck(lambda a, b: edge_dot(a, b, edge), (q, k)))
+    self.assertTrue(torch.autograd.gradcheck(lambda a, b: edge_sq_dist(a, b, edge), (q, k)))
+
+  def test_edge_csr(self):
+    prods = torch.rand((self.edge.shape[1], 2))
+    edge_csr = EdgeCSR(self.edge, self.x.shape[0])
+    for norm_idx in [0, 1]:
+      index = self.edge[norm_idx]
+      self.assertTrue(torch.allclose(edge_csr.normalise(softmax, prods, norm_idx), softmax(prods, index)))
+      self.assertTrue(torch.allclose(edge_csr.normalise(squareplus, prods, norm_idx), squareplus(prods, index)))
+      sums = torch.zeros((self.x.shape[0], 2)).index_add_(0, index, prods)[index]
+      self.assertTrue(torch.allclose(edge_csr.segment_sum(prods, norm_idx), sums))
+    self.assertTrue(get_edge_csr(edge_csr, self.edge) is edge_csr)
+    self.assertFalse(get_edge_csr(edge_csr, self.edge.clone()) is edge_csr)
+
+  def test_attention_refresh(self):
+    data = DummyData(self.edge, None, self.x.shape[0])
+    opt = {**self.opt, 'attention_refresh': 'nfe', 'attention_refresh_k': 3}
+    func = ODEFuncTransformerAtt(self.x.shape[1], self.x.shape[1], opt, data, self.device)
+    out = [func(0, self.x) for _ in range(6)]
+    self.assertTrue(func.nfe == 6 and func.nfe_cached == 4)
+    self.assertTrue(all(torch.allclose(out[0], o) for o in out))
+    func.x0 = self.x.clone()  # a new solve always recomputes
+    func(0, self.x)
+    self.assertTrue(func.nfe_cached == 4)
+
+    opt = {**self.opt, 'attention_refresh': 'step'}
+    func = ODEFuncTransformerAtt(self.x.shape[1], self.x.shape[1], opt, data, self.device)
+    odeint(func, self.x, torch.tensor([0, 1.]), method='rk4', options={'step_size': 0.25})
+    # one full evaluation at the start of each of the four steps
+    self.assertTrue(func.nfe == 16 and func.nfe_cached == 12)
+
+    opt = {**self.opt, 'attention_refresh': 'threshold', 'attention_refresh_tol': 0.1}
+    func = ODEFuncTransformerAtt(self.x.shape[1], self.x.shape[1], opt, data, self.device)
+    func(0, self.x)
+    func(0, 1.01 * self.x)
+    self.assertTrue(func.nfe_cached == 1)
+    func(0, 2 * self.x)
+    self.assertTrue(func.nfe_cached == 1)
+
+  def test_attention_refresh_buffered(self):
+    data = DummyData(self.edge, None, self.x.shape[0])
+    nfe_cached = []
+    for buffered in [False, True]:
+      opt = {**self.opt, 'attention_refresh': 'threshold', 'attention_refresh_tol': 0.02}
+      torch.manual_seed(0)
+      func = ODEFuncTransformerAtt(self.x.shape[1], self.x.shape[1], opt, data, self.device)
+      with torch.no_grad():
+        odeint(func, self.x, torch.tensor([0, 3.]), method='rk4', options={'step_size': 0.25, 'buffered': buffered})
+      nfe_cached.append(func.nfe_cached)
+    # the buffered solver updates the state in place, which mustn't move the cached x along with it
+    self.assertTrue(nfe_cached[0] == nfe_cached[1] < func.nfe - 2)
+
+  def test_attention_refresh_adjoint(self):
+    data = DummyData(self.edge, None, self.x.shape[0])
+    grads = {}
+    for policy in ['always', 'nfe', 'step', 'threshold']:
+      opt = {**self.opt, 'attention_refresh': policy, 'attention_refresh_k': 3, 'attention_refresh_tol': 0.1,
+             'adjoint': True}
+      torch.manual_seed(0)
+      func = ODEFuncTransformerAtt(self.x.shape[1], self.x.shape[1], opt, data, self.device)
+      x = self.x.clone().requires_grad_(True)
+      out = odeint_adjoint(func, x, torch.tensor([0, 1.]), method='rk4', options={'step_size': 0.25},
+                           adjoint_options={'step_size': 0.25})
+      nfe_cached = func.nfe_cached
+      out[-1].pow(2).sum().backward()
+      # the forward pass reuses the cached attention, the adjoint pass recomputes it on every evaluation
+      self.assertTrue(nfe_cached > 0 or policy == 'always', policy)
+      self.assertEqual(func.nfe_cached, nfe_cached)
+      grads[policy] = x.grad
+    for policy in ['nfe', 'step', 'threshold']:
+      self.assertTrue(torch.allclose(grads[policy], grads['always'], rtol=1e-2), policy)
+
+  def test_packed_projections(self):
+    att_layer = SpGraphTransAttentionLayer(self.x.shape[1], self.x.shape[1], self.opt, self.device)
+    legacy = {name: nn.Linear(self.x.shape[1], self.opt['attention_dim']) for name in ['Q', 'K', 'V']}
+    state_dict = {key: value for key, value in att_layer.state_dict().items() if not key.startswith('QKV')}
+    for name, linear in legacy.items():
+      state_dict[name + '.weight'], state_dict[name + '.bias'] = linear.weight.data, linear.bias.data
+    att_layer.load_state_dict(state_dict)
+    q, k, v = att_layer.project(self.x, 'QKV')
+    for name, projection in zip(['Q', 'K', 'V'], [q, k, v]):
+      self.assertTrue(torch.allclose(getattr(att_layer, name).weight, legacy[name].weight))
+      expected = legacy[name](self.x).view(-1, att_layer.h, att_layer.d_k).transpose(1, 2)
+      self.assertTrue(torch.allclose(projection, expected))
+
   def test_two_way_edge(self):
     dataset = get_dataset(self.opt, f'{ROOT_DIR}/data', False)
     edge = dataset.data.edge_index